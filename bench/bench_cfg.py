@@ -0,0 +1,64 @@
+"""
+Compare config parser throughput
+
+Each parser engine reads the generated config, and then the config is
+converted to each of the other formats (see pyppi.formats) and read back
+from that, so the rates are all in lines of the line format per second.
+
+USAGE:
+    bench_cfg.py [-p PACKAGES] [-v VERSIONS] [-r ROUNDS]
+
+OPTIONS:
+    -p PACKAGES     Number of packages in the generated config  [default: 2000]
+    -v VERSIONS     Number of versions per package  [default: 50]
+    -r ROUNDS       Best of ROUNDS timings is reported  [default: 3]
+
+This is free and unencumbered software released into the public domain.
+For more information, please visit <http://unlicense.org/>.
+"""
+from docopt import docopt
+from gen_cfg import write_cfg
+from pyppi import formats
+import pyppi.__main__ as pmain
+import tempfile
+import time
+
+
+# -----------------------------------------------------------------------------
+def main():
+    """
+    Generate a config, then time each parser engine on it
+    """
+    opts = docopt(__doc__)
+    with tempfile.TemporaryDirectory() as tmpd:
+        cfgfile = "{}/bench.cfg".format(tmpd)
+        nlines = write_cfg(cfgfile, int(opts['-p']), int(opts['-v']))
+        runs = [(engine, cfgfile, engine)
+                for engine in sorted(pmain.cfg_engines)]
+        cfg = pmain.read_cfg_file(cfgfile)
+        for fmt in formats.FORMATS[1:]:
+            fmtfile = "{}/bench.{}".format(tmpd, fmt)
+            pmain.write_atomic(fmtfile, formats.write(cfg, fmt))
+            runs.append((fmt, fmtfile, None))
+        for (label, filename, engine) in runs:
+            elapsed = min(timed(filename, engine)
+                          for _ in range(int(opts['-r'])))
+            print("{:>10s}: {:10.0f} lines/sec ({} lines in {:.3f}s)"
+                  .format(label, nlines / elapsed, nlines, elapsed))
+
+
+# -----------------------------------------------------------------------------
+def timed(cfgfile, engine):
+    """
+    Return the seconds taken to read *cfgfile* with *engine*
+    """
+    start = time.perf_counter()
+    pmain.read_cfg_file(cfgfile, engine=engine)
+    return time.perf_counter() - start
+
+
+# -----------------------------------------------------------------------------
+if __name__ == "__main__":
+    main()
+
+# ==TAGGABLE==
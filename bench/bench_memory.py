@@ -0,0 +1,84 @@
+"""
+Measure the memory a parsed config takes
+
+USAGE:
+    bench_memory.py [-p PACKAGES] [-v VERSIONS] [-m MINPY] [-s SEED]
+
+OPTIONS:
+    -p PACKAGES     Number of packages in the generated config  [default: 2000]
+    -v VERSIONS     Versions per package, a count or LOW:HIGH (see gen_cfg.py)
+                    [default: 50]
+    -m MINPY        Fraction of releases with a minpy line  [default: 0.5]
+    -s SEED         Seed for the generated config  [default: 1]
+
+A config of the given shape is generated and parsed with each parser
+engine while tracemalloc watches. The memory held by the result is reported
+along with what the same data takes when each release is a plain dict, as
+it was before releases became pyppi.__main__.release objects.
+
+This is free and unencumbered software released into the public domain.
+For more information, please visit <http://unlicense.org/>.
+"""
+from docopt import docopt
+from gen_cfg import versions_option, write_cfg
+import pyppi.__main__ as pmain
+import tempfile
+import tracemalloc
+
+
+# -----------------------------------------------------------------------------
+def main():
+    """
+    Generate a config, then report the memory each representation takes
+    """
+    opts = docopt(__doc__)
+    with tempfile.TemporaryDirectory() as tmpd:
+        cfgfile = "{}/bench.cfg".format(tmpd)
+        write_cfg(cfgfile, int(opts['-p']), versions_option(opts['-v']),
+                  float(opts['-m']), seed=int(opts['-s']))
+        for engine in sorted(pmain.cfg_engines):
+            pmain.read_cfg_file(cfgfile, engine)    # imports, interned strings
+            (cfg, size) = measured(pmain.read_cfg_file, cfgfile, engine)
+            nrel = sum(len(_) for _ in cfg['packages'].values())
+            report(engine, size, nrel)
+        (_, size) = measured(as_dicts, cfgfile)
+        report("dicts", size, nrel)
+
+
+# -----------------------------------------------------------------------------
+def measured(func, *args):
+    """
+    Return func(*args) and the number of bytes still allocated for it
+    """
+    tracemalloc.start()
+    rval = func(*args)
+    (size, _) = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return (rval, size)
+
+
+# -----------------------------------------------------------------------------
+def as_dicts(cfgfile):
+    """
+    Parse *cfgfile* and return the config with each release as a dict
+    """
+    cfg = pmain.read_cfg_file(cfgfile)
+    return {'root': cfg['root'],
+            'packages': {pkg: [dict(_) for _ in pkg_l]
+                         for (pkg, pkg_l) in cfg['packages'].items()}}
+
+
+# -----------------------------------------------------------------------------
+def report(label, size, nrel):
+    """
+    Print *size* bytes for *nrel* releases under *label*
+    """
+    print("{:>10s}: {:12,d} bytes, {:6.1f} bytes/release"
+          .format(label, size, size / nrel))
+
+
+# -----------------------------------------------------------------------------
+if __name__ == "__main__":
+    main()
+
+# ==TAGGABLE==
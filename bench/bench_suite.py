@@ -0,0 +1,212 @@
+"""
+Time the main pyppi operations on a generated config and report JSON
+
+USAGE:
+    bench_suite.py [-p PACKAGES] [-v VERSIONS] [-m MINPY] [-s SEED]
+                   [-r ROUNDS] [-o OUTPUT] [--no-cpush]
+
+OPTIONS:
+    -p PACKAGES     Number of packages in the generated config  [default: 2000]
+    -v VERSIONS     Versions per package, a count or LOW:HIGH (see gen_cfg.py)
+                    [default: 1:50]
+    -m MINPY        Fraction of releases with a minpy line  [default: 0.5]
+    -s SEED         Seed for the generated config  [default: 1]
+    -r ROUNDS       Number of timed rounds of each operation  [default: 3]
+    -o OUTPUT       Write the JSON report to OUTPUT instead of stdout
+    --no-cpush      Skip the cpush timings, which need git
+
+The report holds the config shape, the pyppi and python versions, and for
+each operation the time of every round along with the best and the mean.
+Operations:
+
+    read_cfg_file.<engine>  parse the config with each parser engine
+    load_cfg.cached         load the config through its cache
+    build_dirs              create root and the package directories
+    build.full              build_index_htmls into an empty root
+    build.noop              build_index_htmls when nothing has changed
+    index_out_of_date       compare the config with the build manifest
+    cpush.full              'pyppi cpush' of a new index to a local bare
+                            git remote: build, git add, commit, and push
+    cpush.update            'pyppi cpush' after one release is added
+
+Reports from two releases can be compared operation by operation to spot
+regressions.
+
+This is free and unencumbered software released into the public domain.
+For more information, please visit <http://unlicense.org/>.
+"""
+from docopt import docopt
+from gen_cfg import versions_option, write_cfg
+import json
+import os
+import platform
+import pyppi.__main__ as pmain
+from pyppi import version
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+
+GIT_ENV = {'GIT_AUTHOR_NAME': "pyppi bench",
+           'GIT_AUTHOR_EMAIL': "bench@localhost",
+           'GIT_COMMITTER_NAME': "pyppi bench",
+           'GIT_COMMITTER_EMAIL': "bench@localhost"}
+
+
+# -----------------------------------------------------------------------------
+def main():
+    """
+    Generate a config, time each operation on it, and report the results
+    """
+    opts = docopt(__doc__)
+    shape = {'packages': int(opts['-p']),
+             'versions': versions_option(opts['-v']),
+             'minpy': float(opts['-m']),
+             'seed': int(opts['-s'])}
+    rounds = int(opts['-r'])
+    report = {'pyppi': version._v,
+              'python': platform.python_version(),
+              'platform': platform.platform(),
+              'time': time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+              'shape': shape,
+              'results': {}}
+    with tempfile.TemporaryDirectory() as tmpd:
+        report['shape']['lines'] = bench_build(tmpd, shape, rounds,
+                                               report['results'])
+        if not opts['--no-cpush']:
+            bench_cpush(tmpd, shape, rounds, report['results'])
+
+    text = json.dumps(report, indent=2, sort_keys=True) + "\n"
+    if opts['-o']:
+        with open(opts['-o'], 'w') as wbl:
+            wbl.write(text)
+    else:
+        sys.stdout.write(text)
+
+
+# -----------------------------------------------------------------------------
+def bench_build(tmpd, shape, rounds, results):
+    """
+    Time parsing, loading, and building the index for a config of *shape*
+    in *tmpd*, adding the timings to *results*. Return the number of lines
+    in the config.
+    """
+    cfgfile = os.path.join(tmpd, "bench.cfg")
+    root = os.path.join(tmpd, "pypi")
+    nlines = write_cfg(cfgfile, shape['packages'], shape['versions'],
+                       shape['minpy'], root=root, seed=shape['seed'])
+    (cfg, cfghash) = pmain.load_cfg(cfgfile)
+
+    def clear():
+        """
+        Remove the index built by the last round
+        """
+        shutil.rmtree(root, ignore_errors=True)
+
+    for engine in sorted(pmain.cfg_engines):
+        results['read_cfg_file.' + engine] = timed(
+            rounds, pmain.read_cfg_file, cfgfile, engine=engine)
+    results['load_cfg.cached'] = timed(rounds, pmain.load_cfg, cfgfile)
+    results['build_dirs'] = timed(rounds, pmain.build_dirs, cfg, setup=clear)
+    results['build.full'] = timed(rounds, pmain.build_index_htmls, cfg,
+                                  cfghash, quiet=True, setup=clear)
+    results['build.noop'] = timed(rounds, pmain.build_index_htmls, cfg,
+                                  cfghash, quiet=True)
+    results['index_out_of_date'] = timed(rounds, pmain.index_out_of_date,
+                                         cfgfile, cfg)
+    clear()
+    return nlines
+
+
+# -----------------------------------------------------------------------------
+def bench_cpush(tmpd, shape, rounds, results):
+    """
+    Time 'pyppi cpush' into a git work tree in *tmpd* whose origin is a
+    local bare repository, adding the timings to *results*
+    """
+    base = os.path.join(tmpd, "cpush")
+    work = os.path.join(base, "work")
+    cfgfile = os.path.join(work, "index.cfg")
+    os.environ.update(GIT_ENV)
+
+    def fresh_repo():
+        """
+        Set up the remote and a work tree holding only the config
+        """
+        shutil.rmtree(base, ignore_errors=True)
+        os.makedirs(base)
+        git(base, "init", "-q", "--bare", "remote.git")
+        git(base, "clone", "-q", "remote.git", "work")
+        write_cfg(cfgfile, shape['packages'], shape['versions'],
+                  shape['minpy'], root="pypi", seed=shape['seed'])
+        git(work, "add", "index.cfg")
+        git(work, "commit", "-q", "-m", "config")
+        git(work, "push", "-q", "-u", "origin", "HEAD")
+
+    def pushed_repo():
+        """
+        Set up a work tree whose index has been pushed, then add a release
+        to the config
+        """
+        fresh_repo()
+        cpush(work, cfgfile, "initial index")
+        with open(cfgfile, 'a') as abl:
+            abl.write("\npackage    added\n"
+                      "    version    1.0\n"
+                      "    url        https://x/added-1.0.tar.gz\n")
+        git(work, "commit", "-q", "-m", "add a release", "index.cfg")
+
+    results['cpush.full'] = timed(rounds, cpush, work, cfgfile, "bench",
+                                  setup=fresh_repo)
+    results['cpush.update'] = timed(rounds, cpush, work, cfgfile, "bench",
+                                    setup=pushed_repo)
+
+
+# -----------------------------------------------------------------------------
+def cpush(work, cfgfile, message):
+    """
+    Run 'pyppi cpush' on *cfgfile* in git work tree *work*
+    """
+    cwd = os.getcwd()
+    os.chdir(work)
+    try:
+        pmain.dispatch(pmain.__doc__, argv=["cpush", "-q", "-m", message,
+                                            os.path.basename(cfgfile)])
+    finally:
+        os.chdir(cwd)
+
+
+# -----------------------------------------------------------------------------
+def git(where, *args):
+    """
+    Run git with *args* in directory *where*, failing loudly
+    """
+    subprocess.run(("git",) + args, cwd=where, check=True,
+                   stdout=subprocess.DEVNULL)
+
+
+# -----------------------------------------------------------------------------
+def timed(rounds, func, *args, setup=None, **kw):
+    """
+    Call func(*args, **kw) *rounds* times, calling *setup* (untimed) before
+    each, and return the timings
+    """
+    times = []
+    for _ in range(rounds):
+        if setup:
+            setup()
+        start = time.perf_counter()
+        func(*args, **kw)
+        times.append(time.perf_counter() - start)
+    return {'best': min(times),
+            'mean': sum(times) / len(times),
+            'rounds': times}
+
+
+# -----------------------------------------------------------------------------
+if __name__ == "__main__":
+    main()
+
+# ==TAGGABLE==
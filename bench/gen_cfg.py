@@ -0,0 +1,86 @@
+"""
+Generate a synthetic pyppi config of a given shape
+
+USAGE:
+    gen_cfg.py FILENAME [-p PACKAGES] [-v VERSIONS] [-m MINPY] [-s SEED]
+               [--root ROOT]
+
+OPTIONS:
+    -p PACKAGES     Number of packages  [default: 2000]
+    -v VERSIONS     Versions per package, either a count or LOW:HIGH for a
+                    log-uniform spread between the two  [default: 50]
+    -m MINPY        Fraction of releases with a minpy line  [default: 0.5]
+    -s SEED         Seed for the random choices  [default: 1]
+    --root ROOT     Root named in the config  [default: pypi]
+
+With a spread like -v 1:50000, most packages get a handful of versions and a
+few get thousands, which is the shape real indexes have. The same options
+and seed always give the same file.
+
+This is free and unencumbered software released into the public domain.
+For more information, please visit <http://unlicense.org/>.
+"""
+from docopt import docopt
+import random
+
+
+MINPY_CHOICES = ["2.7", "3.6", "3.8", "3.10"]
+
+
+# -----------------------------------------------------------------------------
+def main():
+    """
+    Write the config described by the command line
+    """
+    opts = docopt(__doc__)
+    nlines = write_cfg(opts['FILENAME'], int(opts['-p']),
+                       versions_option(opts['-v']), float(opts['-m']),
+                       root=opts['--root'], seed=int(opts['-s']))
+    print("wrote {} lines to {}".format(nlines, opts['FILENAME']))
+
+
+# -----------------------------------------------------------------------------
+def versions_option(value):
+    """
+    Turn the -v value, 'N' or 'LOW:HIGH', into a (low, high) pair
+    """
+    (low, _, high) = value.partition(":")
+    return (int(low), int(high or low))
+
+
+# -----------------------------------------------------------------------------
+def write_cfg(cfgfile, npkgs, nvers, minpy=0.5, root="pypi", seed=1):
+    """
+    Write a config with *npkgs* packages to *cfgfile* and return the number
+    of lines written. *nvers* is the number of versions per package or a
+    (low, high) pair to spread them log-uniformly over. About *minpy* of the
+    releases get a minpy line.
+    """
+    rng = random.Random(seed)
+    (low, high) = nvers if isinstance(nvers, tuple) else (nvers, nvers)
+    nlines = 1
+    with open(cfgfile, 'w') as wbl:
+        wbl.write("root     {}\n".format(root))
+        for pdx in range(npkgs):
+            count = low
+            if high > low:
+                count = int(low * (high / low) ** rng.random())
+            wbl.write("\npackage    pkg{}    # generated\n".format(pdx))
+            for vdx in range(count):
+                wbl.write("    version    1.{}\n".format(vdx))
+                wbl.write("    url        https://x/pkg{0}-1.{1}.tar.gz"
+                          "#egg=pkg{0}-1.{1}\n".format(pdx, vdx))
+                nlines += 2
+                if rng.random() < minpy:
+                    wbl.write("    minpy      {}\n"
+                              .format(rng.choice(MINPY_CHOICES)))
+                    nlines += 1
+            nlines += 2
+    return nlines
+
+
+# -----------------------------------------------------------------------------
+if __name__ == "__main__":
+    main()
+
+# ==TAGGABLE==
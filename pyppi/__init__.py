@@ -1,9 +1,231 @@
 """
 Build a python package index conforming to PEP 503
 
-pyppi build [-d] FILENAME
+pyppi build [-d] FILENAME [-q] [-j JOBS] [--staged] [--fsync POLICY]
+            [--no-cache] [--json] [--precompress CODECS]
+            [--metrics FILE] [--profile FILE] [--stream] [--only PKG]
+            [--watch] [--debounce SECONDS] [--interval SECONDS]
     Build the python package index based on the contents of FILENAME.
 
+pyppi cpush [-d] -m MESSAGE FILENAME [-q] [-j JOBS] [--staged]
+            [--fsync POLICY] [--no-cache] [--json] [--precompress CODECS]
+            [--metrics FILE] [--profile FILE] [--stream]
+            [--watch] [--debounce SECONDS] [--interval SECONDS]
+            [--push-interval SECONDS]
+    if the build manifest does not match FILENAME and the page options:
+        build
+    if any files staged,
+        complain and die
+    if none of root/*/index.html pending:
+        complain and die
+    git update-index --add --remove root/*/index.html
+    git commit -m MESSAGE
+    git push
+
+With --watch, build and cpush keep running after the first build, with
+the config in memory. Changes to FILENAME or to any fragment it
+includes are noticed through inotify (or by checking those files
+every --interval SECONDS where inotify is not available) and, once no
+change has come for --debounce SECONDS, only the pages of the packages
+whose blocks changed are rendered again.
+cpush --watch commits and pushes what has been built at most once
+every --push-interval SECONDS; a commit or push that fails is reported
+and tried again later. Stop watching with ^C.
+
+cpush runs git directly, never through a shell. The changed pages are
+listed by one 'git status -z' and staged by one
+'git update-index --stdin', however many there are.
+
+Builds are incremental. A manifest in root records a hash of FILENAME,
+the --json and --precompress options, and a hash of each page written.
+cpush builds when any of these differ from what is asked for. Only
+pages whose content changed, or that have gone missing, are rewritten
+and pages for packages no longer in FILENAME are removed.
+With -j JOBS, pages are rendered and written by a pool of JOBS threads.
+The resulting tree and manifest do not depend on JOBS. Pages that fail
+are reported together once the others are done.
+
+Each page is written to a temporary file and renamed into place, so
+readers never see a partial page. With --staged, the whole build goes
+to a sibling of root (a hard linked copy of the current tree) that is
+swapped in when the build is done. If root is a symlink, the symlink is
+replaced by one to a new .ROOT.N directory beside it, and the tree it
+pointed at is removed only if it is such a directory; otherwise the two
+directories are exchanged with renameat2(2) where available. A failed
+build leaves root untouched.
+With --fsync pages, each page is flushed to disk before it is renamed.
+With --fsync all, the directories involved are flushed as well.
+
+The parsed contents of FILENAME are cached next to it in
+.FILENAME.pyppi-cache and reused while the size and mtime of FILENAME,
+or failing that its sha256, still match. With --no-cache, FILENAME is
+always parsed and the cache is left alone. The cache, like the block
+index in .FILENAME.pyppi-blocks (see below), is local state that cpush
+does not commit; where FILENAME is in the work tree, keep them out of
+'git status' with .gitignore lines '.*.pyppi-cache' and
+'.*.pyppi-blocks'.
+
+A config can be split into fragments with 'include PATH' lines, where
+PATH is relative to the including file and may be a glob (matches are
+taken in sorted order; a plain PATH must exist). Fragments may include
+others. Each fragment is cached beside itself, so a change to one only
+costs parsing that one; when a lot of fragment text needs parsing, the
+fragments are parsed in parallel by a pool of processes. A package
+listed in two files, a second root line, or a fragment that includes
+itself is reported with the file and line of each.
+
+One config can describe several trees. Each 'variant ROOT' block adds
+a tree at ROOT holding the same packages, filtered by the lines that
+follow it: 'maxpy 3.8' keeps only releases whose minpy is 3.8 or
+lower, and 'allow PKG' and 'deny PKG' (one package per line, repeated
+as needed) keep only the allowed packages and drop the denied ones.
+A package left with no releases is dropped. Every tree is built from
+the one parse and the one set of release hashes, and each tree has its
+own manifest. A page that is the same in several trees is rendered once
+and hard linked rather than written again. cpush commits every tree.
+Release urls relative to the package page resolve inside each tree, so
+variants are best used with absolute or /ROOT/ urls.
+
+With --stream, build and cpush read FILENAME a block at a time and
+write each package's pages as soon as its block ends, so memory holds
+the largest package rather than the whole index. The package names and
+the manifest entries are spilled to temporary files and sorted there,
+and the root pages are rendered from the spilled names at the end. The
+tree and manifest are the ones a build without --stream writes. A
+streamed config must be in the line format, set root before its first
+package, list each package once, and have no variants; --stream does
+not go with --staged or --watch, and cpush --stream always builds.
+
+With --json, each directory also gets an index.json holding the PEP 691
+JSON form of the page (application/vnd.pypi.simple.v1+json), rendered
+in the same pass over the packages as the HTML.
+
+With --precompress gz,br each page also gets index.html.gz and
+index.html.br siblings for web servers that send precompressed files
+(nginx gzip_static/brotli_static). A sibling is only recompressed when
+its page changes. The br codec needs the brotli module.
+
+Release urls that name a local file get its sha256 appended as a
+#sha256= fragment (in the "hashes" of the JSON form) so pip can verify
+downloads and use --require-hashes. A url names a local file if it is a
+file:// url, a root-relative url (/path, resolved the way the root
+page's links are, so /<root>/ is root), or a relative url (resolved
+against the package page). Digests are kept beside root in
+.ROOT.pyppi-dists, keyed on each file's path, size, mtime, and inode,
+so only new or changed files are hashed again; hashing uses the -j JOBS
+threads. Since those keys only hold on this machine, the file is never
+part of the published tree, and it is not written at all when no
+release names a local file. In a cpush work tree, keep it out of 'git
+status' with a .gitignore line '.*.pyppi-dists'.
+
+For a local wheel, the build also writes its .dist-info/METADATA beside
+it as <wheel>.metadata (PEP 658) and marks the anchor with
+data-core-metadata (and data-dist-info-metadata) so pip can resolve
+dependencies without downloading the wheel. Metadata files are only
+written for new or changed wheels, or when one has gone missing.
+
+pyppi scan [-d] DIRECTORY [-q] [-j JOBS] [--root ROOT] [--url PREFIX]
+           [-o OUTPUT] [--build] [--metrics FILE] [--profile FILE]
+    Write a config for the wheels and sdists under DIRECTORY to stdout
+    (or OUTPUT), and with --build, build the index from it. Name,
+    Version, and Requires-Python come from the metadata in each archive,
+    read without unpacking it. Release urls are PREFIX/<path under
+    DIRECTORY>, or without --url, root-relative urls for the files. What
+    is read from each file is kept in the dist cache beside ROOT, so files
+    are only opened again when they change.
+
+With --metrics, build, cpush, and scan report the time spent in each
+phase (loading the config, hashing release files, writing pages, each
+git command, ...) and counts of pages and bytes written, stat calls,
+and subprocess time. With --profile, the whole command runs under
+cProfile; read the dump with 'python -m pstats FILE'.
+
+pyppi add [-d] STORE PACKAGE VERSION [URL] [--minpy MINPY] [--build]
+          [-q] [--json] [--precompress CODECS] [--fsync POLICY]
+    Add a release to STORE, an SQLite database holding an index in
+    place of a config file. With --build, render the pages it changes.
+
+pyppi remove [-d] STORE PACKAGE [VERSION] [--build] [-q] [--json]
+             [--precompress CODECS] [--fsync POLICY]
+    Remove a release, or without VERSION the whole package, from STORE.
+    With --build, render the pages it changes.
+
+pyppi list [-d] STORE [PACKAGE]
+    List the packages in STORE, or the releases of PACKAGE.
+
+pyppi import [-d] FILENAME STORE
+    Replace the contents of STORE, creating it if need be, with the
+    config in FILENAME.
+
+pyppi export [-d] STORE [-o OUTPUT]
+    Write the contents of STORE as a config file to stdout or OUTPUT.
+
+pyppi convert [-d] FILENAME [-o OUTPUT] [--to FORMAT]
+    Write the config in FILENAME, which may be in any format or a
+    store, to stdout or OUTPUT in FORMAT. Include lines are followed,
+    so the result is one file. Converting between formats keeps every
+    package, release, and variant, in order, and root and the variant
+    roots as written, without expanding ~ or environment variables.
+
+pyppi show [-d] FILENAME PACKAGE
+    Write the block of PACKAGE in FILENAME as config lines.
+
+show, build --only, and serve find a package in a config in the line
+format through a block index kept next to it in .FILENAME.pyppi-blocks,
+which records where each package's block starts and ends. The index is
+made again whenever the device, inode, size, or mtime of FILENAME
+change, by a pass that only looks at package, root, include, and
+variant lines. A package is then read by seeking to its block and
+parsing those lines alone. build --only PKG renders the pages of PKG
+and the root pages, removing PKG's pages if it has left FILENAME, and
+records in the manifest that the rest of the tree was not checked, so
+the next build or cpush looks at every page. The root pages it writes
+leave out packages added to FILENAME that have no pages yet. serve
+renders each package page the first time it is asked for. A config
+with include or variant lines, or in another format, is read whole
+instead.
+
+Besides the line format, FILENAME can be JSON, TOML, or marshal (the
+form the config cache uses, behind its own magic bytes), holding the
+root, variants, and packages as pyppi.formats describes. The format is
+recognized by magic bytes, then by the extensions .json, .toml, and
+.marshal, then by a leading '{' for JSON. A marshal config loads about
+as fast as the file can be read and is never cached. Reading TOML needs
+python 3.11 or the tomli module.
+
+A store can be given to build, cpush, and serve in place of FILENAME.
+add and remove change only the rows of one package, so with --build
+they render just that package's pages and the root pages, as long as
+the index was last built from the store as it was before the change
+(otherwise the whole index is built). Each change to a store bumps a
+generation number that stands in for the hash of FILENAME in the build
+manifest. A store has no variants; import refuses a config that has
+any.
+
+pyppi serve [-d] FILENAME [--host HOST] [-p PORT] [--interval SECONDS]
+            [--no-cache] [--upstream URL] [--cache-dir DIR]
+            [--cache-size MB] [--ttl SECONDS]
+    Serve the index described by FILENAME over HTTP without writing any
+    files. Pages are rendered once into memory and served at / and
+    /<pkg>/ (and at /<root>/ and /<root>/<pkg>/, where the root page
+    links point). The HTML or PEP 691 JSON form of each page is chosen
+    from the Accept header. Responses carry an ETag for If-None-Match
+    and are gzipped for clients that accept it. FILENAME and the
+    fragments it includes are checked every SECONDS, and the config is
+    reloaded when any of them changes.
+
+With --upstream URL, serve is also a caching proxy for the simple index
+at URL: a package FILENAME does not list is fetched from URL/<pkg>/.
+Packages in FILENAME are never looked up upstream. Upstream pages are
+kept in DIR (or in memory) up to MB megabytes, least recently used
+first out, and are served from there for --ttl SECONDS, then
+revalidated with If-None-Match/If-Modified-Since. When the upstream
+cannot be reached, the cached page is served. Concurrent requests for
+a page that is not cached share one upstream request, and upstream
+requests reuse a pool of keep-alive connections. Upstream pages are
+passed through as they are, so their file links must be absolute, as
+PyPI's are.
+
 pyppi version [-d]
     Report the pyppi version.
 
@@ -1,27 +1,315 @@
 """
 USAGE:
-    pyppi build [-d] FILENAME
-    pyppi cpush [-d] -m MESSAGE FILENAME
+    pyppi build [-d] FILENAME [-q] [-j JOBS] [--staged] [--fsync POLICY]
+                [--no-cache] [--json] [--precompress CODECS]
+                [--metrics FILE] [--profile FILE] [--stream] [--only PKG]
+                [--watch] [--debounce SECONDS] [--interval SECONDS]
+    pyppi cpush [-d] -m MESSAGE FILENAME [-q] [-j JOBS] [--staged]
+                [--fsync POLICY] [--no-cache] [--json] [--precompress CODECS]
+                [--metrics FILE] [--profile FILE] [--stream]
+                [--watch] [--debounce SECONDS] [--interval SECONDS]
+                [--push-interval SECONDS]
+    pyppi scan [-d] DIRECTORY [-q] [-j JOBS] [--root ROOT] [--url PREFIX]
+               [-o OUTPUT] [--build] [--metrics FILE] [--profile FILE]
+    pyppi add [-d] STORE PACKAGE VERSION [URL] [--minpy MINPY] [--build]
+              [-q] [--json] [--precompress CODECS] [--fsync POLICY]
+    pyppi remove [-d] STORE PACKAGE [VERSION] [--build] [-q] [--json]
+                 [--precompress CODECS] [--fsync POLICY]
+    pyppi list [-d] STORE [PACKAGE]
+    pyppi import [-d] FILENAME STORE
+    pyppi export [-d] STORE [-o OUTPUT]
+    pyppi convert [-d] FILENAME [-o OUTPUT] [--to FORMAT]
+    pyppi show [-d] FILENAME PACKAGE
+    pyppi serve [-d] FILENAME [--host HOST] [-p PORT] [--interval SECONDS]
+                [--no-cache] [--upstream URL] [--cache-dir DIR]
+                [--cache-size MB] [--ttl SECONDS]
     pyppi version [-d]
 
 OPTIONS:
-    -m MESSAGE      Specify MESSAGE for git commit
+    --build                 Build the index from the scanned config, or
+                            after add or remove, the pages they change
+    --cache-dir DIR         Keep the pages serve --upstream fetches in DIR
+                            instead of in memory
+    --cache-size MB         Most megabytes of upstream pages to keep
+                            [default: 1024]
+    --debounce SECONDS      With --watch, wait until FILENAME and its
+                            fragments have been left alone this long
+                            before rebuilding
+                            [default: 0.5]
+    --fsync POLICY          Flush written data to disk: none, pages, or all
+                            [default: none]
+    --host HOST             Address for serve to listen on
+                            [default: 127.0.0.1]
+    --interval SECONDS      How often serve (and --watch, without
+                            inotify) checks FILENAME and its fragments
+                            for changes
+                            [default: 2]
+    -j JOBS, --jobs JOBS    Render and write pages (or for scan, read
+                            files) with JOBS threads  [default: 1]
+    --json                  Write PEP 691 index.json pages next to the
+                            index.html pages
+    -m MESSAGE              Specify MESSAGE for git commit
+    --minpy MINPY           Lowest python version the release supports
+    --metrics FILE          Write phase timings and counters to FILE as
+                            JSON, or as a summary to stderr if FILE is -
+    -o OUTPUT, --output OUTPUT
+                            Write the scanned, exported, or converted config
+                            to OUTPUT
+    --no-cache              Parse FILENAME even if it has a valid cache
+    --only PKG              Render only the pages of package PKG and the
+                            root pages
+    -p PORT, --port PORT    Port for serve to listen on  [default: 8000]
+    --precompress CODECS    Also write each page compressed with CODECS, a
+                            comma separated list of gz and br
+    --profile FILE          Run the command under cProfile and dump the
+                            stats to FILE
+    --push-interval SECONDS
+                            With cpush --watch, commit and push at most this
+                            often  [default: 60]
+    -q, --quiet             Do not report each file written or removed
+    --root ROOT             Root of the index scan describes  [default: pypi]
+    --staged                Build into a staging directory next to root and
+                            swap it into place when the build is complete
+    --stream                Build while reading FILENAME, without holding
+                            the whole config in memory
+    --to FORMAT             Format convert writes: text, json, toml, or
+                            marshal (default: from the extension of OUTPUT,
+                            or text)
+    --ttl SECONDS           How long an upstream page is served before it is
+                            revalidated  [default: 600]
+    --upstream URL          Fetch packages FILENAME does not list from the
+                            simple index at URL
+    --url PREFIX            Base url of DIRECTORY for scanned release urls
+    --watch                 After building, keep running and rebuild
+                            whenever FILENAME or a fragment it includes
+                            changes
 
 DESCRIPTION
-    pyppi build [-d] FILENAME
+    pyppi build [-d] FILENAME [-q] [-j JOBS] [--staged] [--fsync POLICY]
+                [--no-cache] [--json] [--precompress CODECS]
+                [--metrics FILE] [--profile FILE] [--stream] [--only PKG]
+                [--watch] [--debounce SECONDS] [--interval SECONDS]
         Build the python package index based on the contents of FILENAME.
 
-    pyppi cpush [-d] -m MESSAGE FILENAME
-        if mtime(root/*/index.html) < mtime(FILENAME):
+    pyppi cpush [-d] -m MESSAGE FILENAME [-q] [-j JOBS] [--staged]
+                [--fsync POLICY] [--no-cache] [--json] [--precompress CODECS]
+                [--metrics FILE] [--profile FILE] [--stream]
+                [--watch] [--debounce SECONDS] [--interval SECONDS]
+                [--push-interval SECONDS]
+        if the build manifest does not match FILENAME and the page options:
             build
         if any files staged,
             complain and die
         if none of root/*/index.html pending:
             complain and die
-        git add root/*/index.html
+        git update-index --add --remove root/*/index.html
         git commit -m MESSAGE
         git push
 
+    With --watch, build and cpush keep running after the first build, with
+    the config in memory. Changes to FILENAME or to any fragment it
+    includes are noticed through inotify (or by checking those files
+    every --interval SECONDS where inotify is not available) and, once no
+    change has come for --debounce SECONDS, only the pages of the packages
+    whose blocks changed are rendered again.
+    cpush --watch commits and pushes what has been built at most once
+    every --push-interval SECONDS; a commit or push that fails is reported
+    and tried again later. Stop watching with ^C.
+
+    cpush runs git directly, never through a shell. The changed pages are
+    listed by one 'git status -z' and staged by one
+    'git update-index --stdin', however many there are.
+
+    Builds are incremental. A manifest in root records a hash of FILENAME,
+    the --json and --precompress options, and a hash of each page written.
+    cpush builds when any of these differ from what is asked for. Only
+    pages whose content changed, or that have gone missing, are rewritten
+    and pages for packages no longer in FILENAME are removed.
+    With -j JOBS, pages are rendered and written by a pool of JOBS threads.
+    The resulting tree and manifest do not depend on JOBS. Pages that fail
+    are reported together once the others are done.
+
+    Each page is written to a temporary file and renamed into place, so
+    readers never see a partial page. With --staged, the whole build goes
+    to a sibling of root (a hard linked copy of the current tree) that is
+    swapped in when the build is done. If root is a symlink, the symlink is
+    replaced by one to a new .ROOT.N directory beside it, and the tree it
+    pointed at is removed only if it is such a directory; otherwise the two
+    directories are exchanged with renameat2(2) where available. A failed
+    build leaves root untouched.
+    With --fsync pages, each page is flushed to disk before it is renamed.
+    With --fsync all, the directories involved are flushed as well.
+
+    The parsed contents of FILENAME are cached next to it in
+    .FILENAME.pyppi-cache and reused while the size and mtime of FILENAME,
+    or failing that its sha256, still match. With --no-cache, FILENAME is
+    always parsed and the cache is left alone. The cache, like the block
+    index in .FILENAME.pyppi-blocks (see below), is local state that cpush
+    does not commit; where FILENAME is in the work tree, keep them out of
+    'git status' with .gitignore lines '.*.pyppi-cache' and
+    '.*.pyppi-blocks'.
+
+    A config can be split into fragments with 'include PATH' lines, where
+    PATH is relative to the including file and may be a glob (matches are
+    taken in sorted order; a plain PATH must exist). Fragments may include
+    others. Each fragment is cached beside itself, so a change to one only
+    costs parsing that one; when a lot of fragment text needs parsing, the
+    fragments are parsed in parallel by a pool of processes. A package
+    listed in two files, a second root line, or a fragment that includes
+    itself is reported with the file and line of each.
+
+    One config can describe several trees. Each 'variant ROOT' block adds
+    a tree at ROOT holding the same packages, filtered by the lines that
+    follow it: 'maxpy 3.8' keeps only releases whose minpy is 3.8 or
+    lower, and 'allow PKG' and 'deny PKG' (one package per line, repeated
+    as needed) keep only the allowed packages and drop the denied ones.
+    A package left with no releases is dropped. Every tree is built from
+    the one parse and the one set of release hashes, and each tree has its
+    own manifest. A page that is the same in several trees is rendered once
+    and hard linked rather than written again. cpush commits every tree.
+    Release urls relative to the package page resolve inside each tree, so
+    variants are best used with absolute or /ROOT/ urls.
+
+    With --stream, build and cpush read FILENAME a block at a time and
+    write each package's pages as soon as its block ends, so memory holds
+    the largest package rather than the whole index. The package names and
+    the manifest entries are spilled to temporary files and sorted there,
+    and the root pages are rendered from the spilled names at the end. The
+    tree and manifest are the ones a build without --stream writes. A
+    streamed config must be in the line format, set root before its first
+    package, list each package once, and have no variants; --stream does
+    not go with --staged or --watch, and cpush --stream always builds.
+
+    With --json, each directory also gets an index.json holding the PEP 691
+    JSON form of the page (application/vnd.pypi.simple.v1+json), rendered
+    in the same pass over the packages as the HTML.
+
+    With --precompress gz,br each page also gets index.html.gz and
+    index.html.br siblings for web servers that send precompressed files
+    (nginx gzip_static/brotli_static). A sibling is only recompressed when
+    its page changes. The br codec needs the brotli module.
+
+    Release urls that name a local file get its sha256 appended as a
+    #sha256= fragment (in the "hashes" of the JSON form) so pip can verify
+    downloads and use --require-hashes. A url names a local file if it is a
+    file:// url, a root-relative url (/path, resolved the way the root
+    page's links are, so /<root>/ is root), or a relative url (resolved
+    against the package page). Digests are kept beside root in
+    .ROOT.pyppi-dists, keyed on each file's path, size, mtime, and inode,
+    so only new or changed files are hashed again; hashing uses the -j JOBS
+    threads. Since those keys only hold on this machine, the file is never
+    part of the published tree, and it is not written at all when no
+    release names a local file. In a cpush work tree, keep it out of 'git
+    status' with a .gitignore line '.*.pyppi-dists'.
+
+    For a local wheel, the build also writes its .dist-info/METADATA beside
+    it as <wheel>.metadata (PEP 658) and marks the anchor with
+    data-core-metadata (and data-dist-info-metadata) so pip can resolve
+    dependencies without downloading the wheel. Metadata files are only
+    written for new or changed wheels, or when one has gone missing.
+
+    pyppi scan [-d] DIRECTORY [-q] [-j JOBS] [--root ROOT] [--url PREFIX]
+               [-o OUTPUT] [--build] [--metrics FILE] [--profile FILE]
+        Write a config for the wheels and sdists under DIRECTORY to stdout
+        (or OUTPUT), and with --build, build the index from it. Name,
+        Version, and Requires-Python come from the metadata in each archive,
+        read without unpacking it. Release urls are PREFIX/<path under
+        DIRECTORY>, or without --url, root-relative urls for the files. What
+        is read from each file is kept in the dist cache beside ROOT, so files
+        are only opened again when they change.
+
+    With --metrics, build, cpush, and scan report the time spent in each
+    phase (loading the config, hashing release files, writing pages, each
+    git command, ...) and counts of pages and bytes written, stat calls,
+    and subprocess time. With --profile, the whole command runs under
+    cProfile; read the dump with 'python -m pstats FILE'.
+
+    pyppi add [-d] STORE PACKAGE VERSION [URL] [--minpy MINPY] [--build]
+              [-q] [--json] [--precompress CODECS] [--fsync POLICY]
+        Add a release to STORE, an SQLite database holding an index in
+        place of a config file. With --build, render the pages it changes.
+
+    pyppi remove [-d] STORE PACKAGE [VERSION] [--build] [-q] [--json]
+                 [--precompress CODECS] [--fsync POLICY]
+        Remove a release, or without VERSION the whole package, from STORE.
+        With --build, render the pages it changes.
+
+    pyppi list [-d] STORE [PACKAGE]
+        List the packages in STORE, or the releases of PACKAGE.
+
+    pyppi import [-d] FILENAME STORE
+        Replace the contents of STORE, creating it if need be, with the
+        config in FILENAME.
+
+    pyppi export [-d] STORE [-o OUTPUT]
+        Write the contents of STORE as a config file to stdout or OUTPUT.
+
+    pyppi convert [-d] FILENAME [-o OUTPUT] [--to FORMAT]
+        Write the config in FILENAME, which may be in any format or a
+        store, to stdout or OUTPUT in FORMAT. Include lines are followed,
+        so the result is one file. Converting between formats keeps every
+        package, release, and variant, in order, and root and the variant
+        roots as written, without expanding ~ or environment variables.
+
+    pyppi show [-d] FILENAME PACKAGE
+        Write the block of PACKAGE in FILENAME as config lines.
+
+    show, build --only, and serve find a package in a config in the line
+    format through a block index kept next to it in .FILENAME.pyppi-blocks,
+    which records where each package's block starts and ends. The index is
+    made again whenever the device, inode, size, or mtime of FILENAME
+    change, by a pass that only looks at package, root, include, and
+    variant lines. A package is then read by seeking to its block and
+    parsing those lines alone. build --only PKG renders the pages of PKG
+    and the root pages, removing PKG's pages if it has left FILENAME, and
+    records in the manifest that the rest of the tree was not checked, so
+    the next build or cpush looks at every page. The root pages it writes
+    leave out packages added to FILENAME that have no pages yet. serve
+    renders each package page the first time it is asked for. A config
+    with include or variant lines, or in another format, is read whole
+    instead.
+
+    Besides the line format, FILENAME can be JSON, TOML, or marshal (the
+    form the config cache uses, behind its own magic bytes), holding the
+    root, variants, and packages as pyppi.formats describes. The format is
+    recognized by magic bytes, then by the extensions .json, .toml, and
+    .marshal, then by a leading '{' for JSON. A marshal config loads about
+    as fast as the file can be read and is never cached. Reading TOML needs
+    python 3.11 or the tomli module.
+
+    A store can be given to build, cpush, and serve in place of FILENAME.
+    add and remove change only the rows of one package, so with --build
+    they render just that package's pages and the root pages, as long as
+    the index was last built from the store as it was before the change
+    (otherwise the whole index is built). Each change to a store bumps a
+    generation number that stands in for the hash of FILENAME in the build
+    manifest. A store has no variants; import refuses a config that has
+    any.
+
+    pyppi serve [-d] FILENAME [--host HOST] [-p PORT] [--interval SECONDS]
+                [--no-cache] [--upstream URL] [--cache-dir DIR]
+                [--cache-size MB] [--ttl SECONDS]
+        Serve the index described by FILENAME over HTTP without writing any
+        files. Pages are rendered once into memory and served at / and
+        /<pkg>/ (and at /<root>/ and /<root>/<pkg>/, where the root page
+        links point). The HTML or PEP 691 JSON form of each page is chosen
+        from the Accept header. Responses carry an ETag for If-None-Match
+        and are gzipped for clients that accept it. FILENAME and the
+        fragments it includes are checked every SECONDS, and the config is
+        reloaded when any of them changes.
+
+    With --upstream URL, serve is also a caching proxy for the simple index
+    at URL: a package FILENAME does not list is fetched from URL/<pkg>/.
+    Packages in FILENAME are never looked up upstream. Upstream pages are
+    kept in DIR (or in memory) up to MB megabytes, least recently used
+    first out, and are served from there for --ttl SECONDS, then
+    revalidated with If-None-Match/If-Modified-Since. When the upstream
+    cannot be reached, the cached page is served. Concurrent requests for
+    a page that is not cached share one upstream request, and upstream
+    requests reuse a pool of keep-alive connections. Upstream pages are
+    passed through as they are, so their file links must be absolute, as
+    PyPI's are.
+
     pyppi version [-d]
         Report the pyppi version.
 
@@ -29,112 +317,551 @@ This is free and unencumbered software released into the public domain.
 For more information, please visit <http://unlicense.org/>.
 """
 from docopt_dispatch import dispatch
-import pdb
+import errno
+import marshal
+import mmap
+import os
+from pyppi import metrics
 from pyppi import version
-from py.path import local as pypath
 import re
-import shutil
+import stat
 import sys
-import tbx
+import time
+import zlib
+
+
+MANIFEST = ".pyppi-manifest"
+PARTIAL_CFGHASH = "partial"
+CFG_CACHE = ".pyppi-cache"
+CFG_CACHE_MAGIC = b"pyppi-cfg-cache 3\n"
+CFG_EXTENSIONS = {'.json': 'json', '.toml': 'toml', '.marshal': 'marshal'}
+CFG_MARSHAL_MAGIC = b"pyppi-cfg-marshal 1\n"
+DIST_CACHE = ".pyppi-dists"
+DIST_CACHE_MAGIC = b"pyppi-dist-cache 1\n"
+STORE_MAGIC = b"SQLite format 3\0"
+FRAGMENT_POOL_BYTES = 4 << 20
+FSYNC_POLICIES = ['none', 'pages', 'all']
+RELEASE_KEYS = ('version', 'url', 'minpy')
+VARIANT_KEYS = (b'maxpy', b'allow', b'deny')
+WRITE_BUFSIZE = 1 << 16
+PAGE_HEAD = ("<!DOCTYPE html>\n"
+             "<html>\n"
+             "  <body>\n")
+PAGE_TAIL = ("  </body>\n"
+             "</html>\n")
+JSON_META = {'api-version': "1.0"}
+JSON_TYPE = "application/vnd.pypi.simple.v1+json"
+CFG_ENGINE = os.environ.get('PYPPI_PARSER', 'fast')
+
+# One config line: an optional key/value pair followed by an optional comment.
+# Tokens are printable ASCII and may not end in '#' so that a '#' followed by
+# whitespace always starts a comment, as in read_cfg_reference(). Anything
+# else lands in the last group and sends the file to the reference parser.
+CFG_LINE_RX = re.compile(rb"^[ \t]*"
+                         rb"(?:([!-~]*[!-\"$-~])[ \t]+"
+                         rb"([!-~]*[!-\"$-~])[ \t]*)?"
+                         rb"(?:#(?:[ \t][^\n]*|(?=\n)))?$"
+                         rb"|^([^\n]+)$", re.M)
+CFG_ODD_RX = re.compile(rb"[\r\x80-\xff]")
 
 
 # -----------------------------------------------------------------------------
 def main():
     """
-    Main entry point
+    Main entry point. 'pyppi version' is answered without parsing the usage.
     """
+    if sys.argv[1:] == ['version']:
+        return pyppi_version(d=False)
     dispatch(__doc__)
 
 
 # -----------------------------------------------------------------------------
 @dispatch.on('build')
+@metrics.instrumented
 def pyppi_build(**kw):                                       # pragma: no cover
     """
     Build the package index from kw['FILENAME']
     """
     conditional_debug(kw['d'])
     filename = kw['FILENAME']
-    print("Reading config file {}".format(filename))
-    cfg = read_cfg_file(filename)
-    build_dirs(cfg)
-    build_index_htmls(cfg)
+    if not kw['quiet']:
+        print("Reading config file {}".format(filename))
+    if kw['stream']:
+        from pyppi import stream
+        stream.run_build(filename, kw)
+        return
+    if kw['only']:
+        run_only(filename, kw['only'], kw)
+        return
+    files = []
+    with metrics.span("load config"):
+        (cfg, cfghash) = load_cfg(filename, cache=not kw['no_cache'],
+                                  files=files)
+    run_build(filename, cfg, kw, cfghash)
+    if kw['watch']:
+        from pyppi import watch
+        watch.run(filename, cfg, kw, files=files)
 
 
 # -----------------------------------------------------------------------------
 @dispatch.on('cpush')
+@metrics.instrumented
 def pyppi_cpush(**kw):
     """
-    if mtime(root/*/index.html) < mtime(FILENAME):
+    if the build manifest does not match FILENAME and the page options:
         build
     if any non pypi files staged,
         complain and die
     if none of root/*/index.html pending:
         complain and die
-    git add root/*/index.html
+    git update-index --add --remove root/*/index.html
     git commit -m MESSAGE
     git push
     """
     conditional_debug(kw['d'])
     filename = kw['FILENAME']
-    cfg = read_cfg_file(filename)
-    if index_out_of_date(filename, cfg):
-        shutil.rmtree(cfg['root'])
-        build_dirs(cfg)
-        build_index_htmls(cfg)
+    if kw['stream']:
+        from pyppi import stream
+        root = stream.run_build(filename, kw)
+        if not commit_pages([root], kw['m']):
+            sys.exit("No pypi index.html files are unstaged")
+        return
+    files = []
+    with metrics.span("load config"):
+        (cfg, cfghash) = load_cfg(filename, cache=not kw['no_cache'],
+                                  files=files)
+    if index_out_of_date(filename, cfg, cfghash, **page_options(kw)):
+        run_build(filename, cfg, kw, cfghash)
 
-    root = cfg['root']
-    (untracked, unstaged, uncommitted) = tbx.git_status()
+    pushed = commit_pages(cfg_roots(cfg), kw['m'])
+    if kw['watch']:
+        from pyppi import watch
+        watch.run(filename, cfg, kw, push=True, files=files)
+    elif not pushed:
+        sys.exit("No pypi index.html files are unstaged")
+
+
+# -----------------------------------------------------------------------------
+@dispatch.on('scan')
+@metrics.instrumented
+def pyppi_scan(**kw):
+    """
+    Generate a config from the distributions under kw['DIRECTORY'] and
+    write it out or build from it
+    """
+    conditional_debug(kw['d'])
+    from pyppi import scan
+    jobs = jobs_option(kw['jobs'])
+    with metrics.span("scan"):
+        cfg = scan.scan_cfg(kw['DIRECTORY'], kw['root'], kw['url'], jobs)
+    text = "".join(cfg_lines(cfg))
+    if kw['output']:
+        write_atomic(kw['output'], text.encode())
+    elif not kw['build']:
+        sys.stdout.write(text)
+    if kw['build']:
+        with metrics.span("build"):
+            build_index_htmls(cfg, cfghash=page_hash(text), jobs=jobs,
+                              quiet=kw['quiet'])
+
+
+# -----------------------------------------------------------------------------
+@dispatch.on('add')
+def pyppi_add(**kw):
+    """
+    Add a release to the store kw['STORE'] and, with --build, render the
+    pages that changed
+    """
+    conditional_debug(kw['d'])
+    from pyppi import store
+    db = store.connect(kw['STORE'])
+    try:
+        before = store.store_hash(db)
+        store.add_release(db, kw['PACKAGE'], kw['VERSION'], kw['URL'],
+                          kw['minpy'])
+        if kw['build']:
+            store.rebuild(kw['STORE'], db, before, [kw['PACKAGE']], kw)
+    finally:
+        db.close()
+
+
+# -----------------------------------------------------------------------------
+@dispatch.on('remove')
+def pyppi_remove(**kw):
+    """
+    Remove a release or a package from the store kw['STORE'] and, with
+    --build, render the pages that changed
+    """
+    conditional_debug(kw['d'])
+    from pyppi import store
+    db = store.connect(kw['STORE'])
+    try:
+        before = store.store_hash(db)
+        store.remove_release(db, kw['PACKAGE'], kw['VERSION'])
+        if kw['build']:
+            store.rebuild(kw['STORE'], db, before, [kw['PACKAGE']], kw)
+    finally:
+        db.close()
+
+
+# -----------------------------------------------------------------------------
+@dispatch.on('list')
+def pyppi_list(**kw):
+    """
+    List the packages in the store kw['STORE'], or the releases of
+    kw['PACKAGE'] as config lines
+    """
+    conditional_debug(kw['d'])
+    from pyppi import store
+    db = store.connect(kw['STORE'])
+    try:
+        pkg = kw['PACKAGE']
+        cfg = store.read_cfg(db, [pkg] if pkg else [])
+    finally:
+        db.close()
+    if not pkg:
+        sys.stdout.write("".join(_ + "\n" for _ in cfg['packages']))
+    elif pkg in cfg['packages']:
+        sys.stdout.write("".join(package_lines(pkg, cfg['packages'][pkg])))
+    else:
+        raise pyppi_error("{} is not in the store".format(pkg))
+
+
+# -----------------------------------------------------------------------------
+@dispatch.on('import')
+def pyppi_import(**kw):
+    """
+    Replace the contents of the store kw['STORE'] with the config in
+    kw['FILENAME']
+    """
+    conditional_debug(kw['d'])
+    from pyppi import store
+    (cfg, _) = load_cfg(kw['FILENAME'], cache=False)
+    db = store.connect(kw['STORE'], create=True)
+    try:
+        store.import_cfg(db, cfg)
+    finally:
+        db.close()
+
+
+# -----------------------------------------------------------------------------
+@dispatch.on('export')
+def pyppi_export(**kw):
+    """
+    Write the contents of the store kw['STORE'] as a config file
+    """
+    conditional_debug(kw['d'])
+    from pyppi import store
+    (cfg, _) = store.load(kw['STORE'])
+    text = "".join(cfg_lines(cfg))
+    if kw['output']:
+        write_atomic(kw['output'], text.encode())
+    else:
+        sys.stdout.write(text)
+
+
+# -----------------------------------------------------------------------------
+@dispatch.on('convert')
+def pyppi_convert(**kw):
+    """
+    Write the config in kw['FILENAME'] in the format kw['to']
+    """
+    conditional_debug(kw['d'])
+    from pyppi import formats
+    fmt = kw['to']
+    if fmt is None:
+        ext = os.path.splitext(kw['output'] or "")[1].lower()
+        fmt = CFG_EXTENSIONS.get(ext, 'text')
+    if fmt not in formats.FORMATS:
+        raise pyppi_error("--to must be one of {}"
+                          .format(", ".join(formats.FORMATS)))
+    (cfg, _) = load_cfg(kw['FILENAME'], cache=False, expand=False)
+    data = formats.write(cfg, fmt)
+    if kw['output']:
+        write_atomic(kw['output'], data)
+    else:
+        sys.stdout.buffer.write(data)
+
+
+# -----------------------------------------------------------------------------
+@dispatch.on('show')
+def pyppi_show(**kw):
+    """
+    Write the block of kw['PACKAGE'] in the config kw['FILENAME'] as
+    config lines
+    """
+    conditional_debug(kw['d'])
+    from pyppi import blocks
+    (filename, pkg) = (kw['FILENAME'], kw['PACKAGE'])
+    index = blocks.load(filename)
+    if index is None:
+        pkg_l = load_cfg(filename)[0]['packages'].get(pkg)
+    else:
+        pkg_l = index.releases(pkg)
+    if pkg_l is None:
+        raise pyppi_error("{} is not in {}".format(pkg, filename))
+    sys.stdout.write("".join(package_lines(pkg, pkg_l)))
+
+
+# -----------------------------------------------------------------------------
+@dispatch.on('serve')
+def pyppi_serve(**kw):                                       # pragma: no cover
+    """
+    Serve the package index described by kw['FILENAME'] over HTTP
+    """
+    conditional_debug(kw['d'])
+    from pyppi import serve
+    try:
+        (port, interval) = (int(kw['port']), float(kw['interval']))
+        (size, ttl) = (float(kw['cache_size']), float(kw['ttl']))
+    except ValueError:
+        raise pyppi_error("--port, --interval, --cache-size and --ttl must"
+                          " be numbers")
+    upstream = None
+    if kw['upstream']:
+        from pyppi import proxy
+        upstream = proxy.upstream(kw['upstream'], kw['cache_dir'],
+                                  int(size * (1 << 20)), ttl)
+    serve.run(kw['FILENAME'], kw['host'], port, interval,
+              cache=not kw['no_cache'], upstream=upstream)
+
+
+# -----------------------------------------------------------------------------
+def run_build(filename, cfg, kw, cfghash=None, changed=None):
+    """
+    Build the index for *cfg*, read from *filename*, as directed by the
+    command line options in *kw*. *cfghash* is the hash of *filename* if
+    the caller already has it. *changed* is passed on to
+    build_index_htmls().
+
+    Each variant the config declares is built after root from the same
+    parse and the same release hashes, filtered as variant_cfg()
+    describes. Pages are rendered once for all the trees that have them
+    and identical pages are hard linked rather than written again (see
+    shared_pages).
+    """
+    if kw['fsync'] not in FSYNC_POLICIES:
+        raise pyppi_error("--fsync must be one of {}"
+                          .format(", ".join(FSYNC_POLICIES)))
+    build = build_staged if kw['staged'] else build_index_htmls
+    opts = {'cfghash': cfghash or file_hash(filename),
+            'jobs': jobs_option(kw['jobs']),
+            'quiet': kw['quiet'],
+            'fsync': kw['fsync'],
+            'changed': changed}
+    opts.update(page_options(kw))
+    variants = cfg.get('variants', {})
+    if cfg['root'] in variants:
+        raise pyppi_error("variant {} is the root".format(cfg['root']))
+    shared = shared_pages() if variants else None
+    with metrics.span("build"):
+        pkg_d = build(cfg, shared=shared, **opts)
+        packages = dict(cfg['packages'], **pkg_d)
+        for vroot in variants:
+            with metrics.span("build variant"):
+                build(variant_cfg(vroot, variants[vroot], packages),
+                      shared=shared, hashed=True, **opts)
+
+
+# -----------------------------------------------------------------------------
+def run_only(filename, pkg, kw):
+    """
+    Render the pages of package *pkg* and the root pages for the config in
+    *filename* as directed by the command line options in *kw*, reading
+    only the block of *pkg* if the config has a block index (see
+    pyppi.blocks). The manifest records PARTIAL_CFGHASH for the config,
+    since the pages of the other packages were not checked against it.
+
+    The root pages list *pkg* and the packages of the config that the
+    manifest has pages for, so they do not link to packages added to the
+    config since the last build, which have no pages yet.
+    """
+    from pyppi import blocks
+    if kw['watch']:
+        raise pyppi_error("--only and --watch cannot be used together")
+    index = blocks.load(filename)
+    if index is None:
+        with metrics.span("load config"):
+            (cfg, _) = load_cfg(filename, cache=not kw['no_cache'])
+    else:
+        with metrics.span("load block"):
+            cfg = index.cfg([pkg])
+    built = {_.split("/")[0] for _ in read_manifest(cfg['root'])['pages']
+             if "/" in _}
+    built.add(pkg)
+    cfg['packages'] = {name: pkg_l for (name, pkg_l) in cfg['packages'].items()
+                       if name in built}
+    run_build(filename, cfg, kw, PARTIAL_CFGHASH, changed={pkg})
+
+
+# -----------------------------------------------------------------------------
+def variant_cfg(root, variant, packages):
+    """
+    Return the config for the variant tree at *root* whose filter is
+    *variant*: the *packages* it allows and does not deny, each with the
+    releases whose minpy is not above its maxpy. A package left with no
+    releases is dropped unless it had none to begin with. A release list
+    the filter leaves whole is the same list object, which is how
+    shared_pages knows the page without rendering it.
+    """
+    allow = {normalize(_) for _ in variant['allow']}
+    deny = {normalize(_) for _ in variant['deny']}
+    maxpy = variant['maxpy'] and py_version(variant['maxpy'])
+    rval = {'root': root, 'packages': {}}
+    for (pkg, pkg_l) in packages.items():
+        name = normalize(pkg)
+        if (allow and name not in allow) or name in deny:
+            continue
+        if maxpy:
+            kept = [_ for _ in pkg_l
+                    if py_version(_.get('minpy', "0")) <= maxpy]
+            if len(kept) < len(pkg_l):
+                pkg_l = kept
+        if pkg_l or not packages[pkg]:
+            rval['packages'][pkg] = pkg_l
+    return rval
+
+
+# -----------------------------------------------------------------------------
+def py_version(value):
+    """
+    Return python version string *value* ("3.6", "3.10.1") as a tuple of
+    ints for comparison. Trailing zeros are dropped, so "3.8.0" and "3.8"
+    compare equal.
+    """
+    rval = [int(_) for _ in re.findall(r"\d+", value)]
+    while rval and rval[-1] == 0:
+        rval.pop()
+    return tuple(rval)
+
+
+# -----------------------------------------------------------------------------
+def cfg_roots(cfg):
+    """
+    Return the roots of the trees built for *cfg*: root, then its variants
+    """
+    return [cfg['root']] + list(cfg.get('variants', {}))
+
+
+# -----------------------------------------------------------------------------
+def commit_pages(roots, message):
+    """
+    Stage the pages under each of *roots* that git reports as new, changed,
+    or deleted, commit them with *message*, and push. Return False, having
+    done nothing, if there are no such pages. Exit if anything else is
+    staged.
+    """
+    (untracked, unstaged, uncommitted) = git_status()
     others = [_ for _ in uncommitted
-              if root not in _ or 'index.html' not in _]
+              if not any(index_file(root, _) for root in roots)]
     if others:
         sys.exit("You have files staged. Please commit them and try again.")
 
-    taddables = [_ for _ in untracked if root in _ and 'index.html' in _]
-    saddables = [_ for _ in unstaged if root in _ and 'index.html' in _]
+    taddables = [_ for _ in untracked
+                 if any(index_file(root, _) for root in roots)]
+    saddables = [_ for _ in unstaged
+                 if any(index_file(root, _) for root in roots)]
     addables = taddables + saddables
     if len(addables) == 0:
-        sys.exit("No pypi index.html files are unstaged")
-    else:
-        git_add(addables)
-
-    git_commit(message=kw['m'])
+        return False
+    git_add(addables)
+    git_commit(message=message)
     git_push()
+    return True
 
 
 # -----------------------------------------------------------------------------
-def index_out_of_date(filename, cfg):
+def index_out_of_date(filename, cfg, cfghash=None, formats=('html',),
+                      compress=()):
     """
-    Return True if mtime(filename) is later than mtime(any index.html under
-    root)
+    Return True if the build manifest under root was not written from the
+    current contents of *filename*, whose hash may be passed in *cfghash*,
+    with page *formats* and codec extensions *compress*. Pages missing from
+    disk are not looked for here; a build puts them back.
     """
-    rval = False
-    cfgfile = pypath(filename)
-    root = cfg['root']
-    idxhtml_l = [pypath("{}/index.html".format(root))]
-    pkg_d = cfg['packages']
-    for pkg in pkg_d:
-        path = "{}/{}/index.html".format(root, pkg)
-        idxhtml_l.append(pypath(path))
+    manifest = read_manifest(cfg['root'])
+    if manifest['config'] != (cfghash or file_hash(filename)):
+        return True
+    return not same_options(manifest, formats, compress)
 
-    for idxh in idxhtml_l:
-        if not idxh.exists():
-            rval = True
-            break
-        elif idxh.mtime() < cfgfile.mtime():
-            rval = True
-            break
 
-    return rval
+# -----------------------------------------------------------------------------
+def page_options(kw):
+    """
+    Return the page formats and codec extensions the command line options
+    in *kw* ask for, as keyword arguments for build_index_htmls()
+    """
+    return {'formats': ['html', 'json'] if kw['json'] else ['html'],
+            'compress': codecs_option(kw['precompress'])}
+
+
+# -----------------------------------------------------------------------------
+def same_options(manifest, formats, compress):
+    """
+    Return True if *manifest* was written by a build of page *formats* with
+    codec extensions *compress*
+    """
+    recorded = (manifest.get('formats'), manifest.get('compress'))
+    return recorded == (sorted(formats), sorted(compress))
+
+
+# -----------------------------------------------------------------------------
+def index_file(root, path):
+    """
+    Return True if *path* is one of the files pyppi generates under *root*
+    """
+    name = os.path.basename(page_of(path))
+    page_names = [_[0] for _ in PAGE_FORMATS.values()]
+    return root in path and (name in page_names or name == MANIFEST)
+
+
+# -----------------------------------------------------------------------------
+def page_of(relpath):
+    """
+    Return the page that *relpath* belongs to: *relpath* itself, or for a
+    compressed sibling, the page it was compressed from
+    """
+    (base, ext) = os.path.splitext(relpath)
+    return base if ext in COMPRESSORS else relpath
+
+
+# -----------------------------------------------------------------------------
+def git_status():
+    """
+    Return the (untracked, unstaged, uncommitted) paths from one 'git status
+    --porcelain -z' run. Paths are relative to the top of the work tree.
+    """
+    with metrics.span("git status", subprocess=True):
+        out = git_run("status", "--porcelain", "-z", "-uall")
+    (untracked, unstaged, uncommitted) = ([], [], [])
+    entries = iter(out.split(b"\0"))
+    for entry in entries:
+        if not entry:
+            continue
+        (state, path) = (entry[:2].decode(), os.fsdecode(entry[3:]))
+        if state[0] in "RC":
+            next(entries)   # the path it was renamed or copied from
+        if state == "??":
+            untracked.append(path)
+            continue
+        if state[0] != " ":
+            uncommitted.append(path)
+        if state[1] != " ":
+            unstaged.append(path)
+    return (untracked, unstaged, uncommitted)
 
 
 # -----------------------------------------------------------------------------
 def git_add(addables):
     """
-    Run 'git add' on the group of paths in *addables*
+    Stage the new, changed, or deleted paths in *addables* by streaming them
+    NUL-terminated through one 'git update-index --stdin', so no argument
+    list or shell is involved however many there are
     """
-    addable_list = " ".join(addables)
-    cmd = "git add {}".format(addable_list)
-    tbx.run(cmd)
+    data = b"".join(os.fsencode(_) + b"\0" for _ in addables)
+    with metrics.span("git add", subprocess=True):
+        git_run("update-index", "--add", "--remove", "-z", "--stdin",
+                data=data)
 
 
 # -----------------------------------------------------------------------------
@@ -142,8 +869,8 @@ def git_commit(message=""):
     """
     Run 'git commit' with *message*
     """
-    cmd = "git commit -m \"{}\"".format(message)
-    tbx.run(cmd)
+    with metrics.span("git commit", subprocess=True):
+        git_run("commit", "-q", "-m", message)
 
 
 # -----------------------------------------------------------------------------
@@ -151,7 +878,24 @@ def git_push():
     """
     Run 'git push'
     """
-    tbx.run("git push")
+    with metrics.span("git push", subprocess=True):
+        git_run("push", "-q")
+
+
+# -----------------------------------------------------------------------------
+def git_run(*args, data=None):
+    """
+    Run git with *args*, without a shell, feeding it *data* on stdin, and
+    return what it writes to stdout. If git fails, raise pyppi_error with
+    its message.
+    """
+    import subprocess
+    result = subprocess.run(("git",) + args, input=data,
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    if result.returncode != 0:
+        raise pyppi_error("git {} failed: {}".format(
+            args[0], result.stderr.decode('utf-8', 'replace').strip()))
+    return result.stdout
 
 
 # -----------------------------------------------------------------------------
@@ -169,6 +913,7 @@ def build_dirs(cfg):
     """
     Create the directories needed for the package index reflected by *pkg*
     """
+    from py.path import local as pypath
     root = pypath(cfg['root'])
     root.ensure_dir()
     for pkg in cfg['packages']:
@@ -176,111 +921,1601 @@ def build_dirs(cfg):
 
 
 # -----------------------------------------------------------------------------
-def build_index_htmls(cfg):
+def build_index_htmls(cfg, cfghash=None, jobs=1, quiet=False, fsync='none',
+                      into=None, formats=('html',), compress=(),
+                      changed=None, shared=None, hashed=False):
     """
-    Write an index.html file for root and for each package
+    Write an index.html file for root and for each package, along with the
+    other page *formats* named (see PAGE_FORMATS) and a sibling of each page
+    for each codec in *compress* (see COMPRESSORS). Pages whose
+    content matches the hash recorded in the build manifest are left alone,
+    pages for packages that have left the config are removed, and the
+    manifest is rewritten to describe the new tree.
+
+    With *jobs* > 1 the pages are rendered and written by a thread pool.
+    Failures are collected and raised together in one pyppi_error after
+    every other page has been handled.
+
+    Pages are rendered for cfg['root'] but written under *into* if that is
+    set, which is how build_staged() fills its staging directory.
+
+    With *changed*, a set of package names, only the root pages and the
+    pages of those packages are rendered. The pages of the other packages
+    still in *cfg* are taken to be as the manifest records them, which is
+    how a build --watch avoids rendering what an edit did not touch. The
+    manifest must then record the same *formats* and *compress*.
+
+    With *shared*, a shared_pages, pages other trees of the same build
+    have are not rendered again and are hard linked when they need writing.
+    With *hashed*, the releases in *cfg* already carry their hashes (see
+    hash_releases) and the dist cache is not used.
+
+    Return the packages rendered, with their releases' hashes.
     """
-    index_html_root(cfg)
-    pkg_d = cfg['packages']
+    root = os.path.abspath(into or cfg['root'])
+    if shared is not None:
+        shared.home = os.path.abspath(cfg['root'])
+    manifest = read_manifest(root)
+    old = manifest['pages']
+    new = {}
+    failed = {}
+    pkgs = cfg
+    if changed is not None:
+        if old and not same_options(manifest, formats, compress):
+            raise pyppi_error("{} was built with other --json or --precompress"
+                              " options; build it whole first".format(root))
+        kept = set(cfg['packages']) - set(changed)
+        new = {relpath: digest for (relpath, digest) in old.items()
+               if "/" in relpath and relpath.split("/")[0] in kept}
+        pkgs = dict(cfg, packages={_: cfg['packages'][_] for _ in changed
+                                   if _ in cfg['packages']})
+    if hashed:
+        (pkg_d, dists) = (pkgs['packages'], None)
+    else:
+        with metrics.span("hash release files"):
+            (pkg_d, dists) = hash_releases(
+                pkgs, read_dist_cache(cfg['root']), jobs)
+
+    kinds = [PAGE_FORMATS[_] for _ in formats]
+    tasks = [(name, root_render, (cfg,))
+             for (name, root_render, _) in kinds]
     for pkg in pkg_d:
-        index_html_package(cfg['root'], pkg, pkg_d[pkg])
+        for (name, _, pkg_render) in kinds:
+            tasks.append(("{}/{}".format(pkg, name), pkg_render,
+                          (pkg, pkg_d[pkg])))
+
+    def build_task(task):
+        """
+        Render and write one page, returning its manifest entries or the
+        exception
+        """
+        (relpath, render, args) = task
+        try:
+            return build_page(root, relpath, render, args, old, quiet, fsync,
+                              compress, shared)
+        except Exception as err:
+            return err
+
+    with metrics.span("write pages"):
+        results = pool_map(build_task, tasks, jobs)
+        for ((relpath, _, _), result) in zip(tasks, results):
+            if isinstance(result, Exception):
+                failed[relpath] = result
+            else:
+                new.update(result)
+
+    with metrics.span("remove pages"):
+        for relpath in old:
+            if relpath not in new and page_of(relpath) not in failed:
+                remove_page(root, relpath, quiet)
+
+    with metrics.span("write manifest"):
+        if dists is not None:
+            write_dist_cache(cfg['root'], dists, fsync)
+        write_manifest(root, {'config': None if failed else cfghash,
+                              'formats': sorted(formats),
+                              'compress': sorted(compress),
+                              'pages': new}, fsync)
+    if failed:
+        msg = "{} page(s) failed:".format(len(failed))
+        for (relpath, err) in failed.items():
+            msg += "\n    {}: {}".format(relpath, err)
+        raise pyppi_error(msg)
+    return pkg_d
 
 
 # -----------------------------------------------------------------------------
-def index_html_root(cfg):
+def build_page(root, relpath, render, args, old, quiet=False, fsync='none',
+               compress=(), shared=None):
     """
-    Write the root package index.html
+    Write the page produced by render(*args) to *relpath* under *root*
+    unless its hash matches the one recorded for it in manifest pages *old*
+    and the file is there, then do the same for its compressed sibling for
+    each codec extension in *compress*. Return the manifest entries for the
+    page and its siblings, which all record the hash of the uncompressed
+    page.
+
+    *render* is a generator of page chunks. It is run once to hash the page
+    and, for the page and each sibling that changed, again to stream it to
+    disk, so the page is never held in memory as a whole. With *shared*
+    (see shared_pages), the hash may come from another tree's page, and a
+    page another tree has written is linked instead of written.
     """
-    root = pypath(cfg['root'])
-    target = root.join("index.html")
-    print("writing file {}".format(target.strpath))
-    payload = ("<!DOCTYPE html>\n"
-               "<html>\n"
-               "  <body>\n")
-    pkg_l = cfg['packages']
-    for pkg in pkg_l:
-        payload += "    <a href=\"/{}/{}/\">{}</a>\n".format(cfg['root'],
-                                                             pkg,
-                                                             pkg)
-    payload += ("  </body>\n"
-                "</html>\n")
-    target.write(payload)
+    old = old or {}
+    if shared is None:
+        digest = page_hash(render(*args))
+    else:
+        digest = shared.digest(relpath, render, args)
+    rval = {}
+    for ext in [""] + list(compress):
+        rval[relpath + ext] = digest
+        if shared is not None:
+            shared.add(relpath + ext, digest)
+        target = os.path.join(str(root), relpath + ext)
+        if old.get(relpath + ext) == digest and os.path.lexists(target):
+            metrics.count('pages_unchanged')
+            continue
+        if shared is not None and shared.link(relpath + ext, digest, target,
+                                              fsync):
+            metrics.count('pages_linked')
+            continue
+        metrics.count('pages_written')
+        if not quiet:
+            print("writing file {}".format(target))
+        data = encoded(render(*args))
+        if ext:
+            data = COMPRESSORS[ext](data)
+        write_atomic(target, data, fsync)
+    return rval
 
 
 # -----------------------------------------------------------------------------
-def index_html_package(root, pkgname, pkg_l):
+class shared_pages(object):
     """
-    Write an index.html for each package in cfg
+    What the trees of one build (root and its variants, built one after
+    another) have in common: the hash of each page rendered, by relative
+    path and release list, and the file that holds each page by relative
+    path and hash
     """
-    target = pypath("{}/{}/index.html".format(root, pkgname))
-    print("writing file {}".format(target.strpath))
-    payload = ("<!DOCTYPE html>\n"
-               "<html>\n"
-               "  <body>\n")
-    for release in pkg_l:
-        payload += "    <a href=\"{}\"".format(release['url'])
-        if 'minpy' in release:
-            payload += " {}=\"&gt;={}\"".format("data-requires-python",
-                                                release['minpy'])
-        payload += ">{}-{}</a>\n".format(pkgname, release['version'])
-    payload += ("  </body>\n"
-                "</html>\n")
-    target.write(payload)
+    def __init__(self):
+        """
+        Start with nothing shared. build_index_htmls() sets self.home to
+        the root of each tree before building it.
+        """
+        self.home = None
+        self.digests = {}
+        self.files = {}
+
+    def digest(self, relpath, render, args):
+        """
+        Return the hash of the page render(*args) at *relpath*, rendering
+        it only if no tree has had a page there from the same list object
+        """
+        key = (relpath, id(args[-1]))
+        hit = self.digests.get(key)
+        if hit is not None and hit[0] is args[-1]:
+            return hit[1]
+        digest = page_hash(render(*args))
+        self.digests[key] = (args[-1], digest)
+        return digest
+
+    def add(self, relpath, digest):
+        """
+        Record that the tree being built has the page *relpath* with hash
+        *digest*, unless an earlier tree already has it
+        """
+        self.files.setdefault((relpath, digest),
+                              os.path.join(self.home, relpath))
+
+    def link(self, relpath, digest, target, fsync='none'):
+        """
+        Hard link *target* to the file of an earlier tree that holds the
+        page *relpath* with hash *digest*, replacing *target* atomically.
+        Return False if there is no such file or it cannot be linked.
+        """
+        source = self.files.get((relpath, digest))
+        if source is None or source == os.path.join(self.home, relpath):
+            return False
+        tmp = "{}.{}.tmp".format(target, os.getpid())
+        try:
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            os.link(source, tmp)
+            os.replace(tmp, target)
+        except OSError:
+            return False
+        if fsync == 'all':
+            fsync_dir(os.path.dirname(target))
+        return True
 
 
 # -----------------------------------------------------------------------------
-def conditional_debug(debug_option):                         # pragma: no cover
+def hash_releases(cfg, cache, jobs=1, metadata=True):
     """
-    Start the debugger if the debug option is True
+    Return a copy of cfg['packages'] in which each release whose url names
+    a local file (see dist_path) has the file's sha256 as 'sha256' and, for
+    a wheel with a PEP 658 metadata file beside it, the sha256 of that file
+    as 'metadata', along with *cache* updated for those files.
+
+    *cache* maps a file path to (size, mtime_ns, inode, facts), where facts
+    is a dict holding 'sha256', 'metadata', and whatever else has been
+    learned about the file (see cached_facts). A file whose size, mtime, and
+    inode match its entry is not read again. The rest are hashed, and with
+    *metadata* True their metadata files written (see core_metadata), by
+    *jobs* threads. Files that are missing are left without a hash and
+    dropped from the cache. Entries for files the config does not name are
+    kept.
     """
-    if debug_option:
-        pdb.set_trace()
+    paths = {}
+    for (pkg, pkg_l) in cfg['packages'].items():
+        for release in pkg_l:
+            path = dist_path(release.get('url', ""), cfg['root'], pkg)
+            if path:
+                paths[release['url']] = path
+
+    dists = dict(cache)
+    stale = []
+    for path in set(paths.values()):
+        dists.pop(path, None)
+        try:
+            info = os.stat(path)
+        except OSError:
+            continue
+        stamp = (info.st_size, info.st_mtime_ns, info.st_ino)
+        facts = cached_facts(cache, path, stamp)
+        if dist_current(path, facts, metadata):
+            dists[path] = stamp + (facts,)
+        elif stat.S_ISREG(info.st_mode):
+            stale.append((path, stamp, facts))
+
+    def dist_task(item):
+        """
+        Hash one file and, if it is a wheel, write its metadata file.
+        Return its cache entry, or None if it cannot be read.
+        """
+        (path, stamp, facts) = item
+        facts = dict(facts)
+        try:
+            if 'sha256' not in facts:
+                facts['sha256'] = file_hash(path)
+                metrics.count('files_hashed')
+        except OSError:
+            return None
+        if metadata and path.endswith('.whl'):
+            try:
+                facts['metadata'] = core_metadata(path)
+            except OSError:
+                pass
+        return stamp + (facts,)
+
+    for ((path, _, _), entry) in zip(stale, pool_map(dist_task, stale, jobs)):
+        if entry:
+            dists[path] = entry
+
+    rval = {}
+    for (pkg, pkg_l) in cfg['packages'].items():
+        rval[pkg] = []
+        for release in pkg_l:
+            path = paths.get(release.get('url'))
+            if path in dists:
+                facts = dists[path][3]
+                release = dict(release, sha256=facts['sha256'])
+                sidecar = path + ".metadata"
+                if facts.get('metadata') and os.path.exists(sidecar):
+                    release['metadata'] = facts['metadata']
+            rval[pkg].append(release)
+    return (rval, dists)
 
 
 # -----------------------------------------------------------------------------
-def read_cfg_file(filename):
+def hashed_block(root, pkg, pkg_l, dists, metadata=True, lock=None):
     """
-    Load config data from *filename*
+    Return the releases *pkg_l* of package *pkg* in the index at *root*
+    with the hashes hash_releases() gives them, updating dist cache *dists*
+    in place for their files only, which keeps the cost of one package
+    independent of the size of the cache. If *lock* is set, *dists* is
+    only touched while holding it, not while the files are hashed.
     """
-    rval = {'root': None,
-            'packages': {}}
-    with open(filename, 'r') as rbl:
-        cpkg = None
-        for line in rbl:
-            # throw away any comment at the end of the line
-            # the '#' must be followed by whitespace to be a valid comment
-            line = re.sub(r"\s*#\s.*$", "", line)
-            # ignore blank lines
-            if re.match(r"^\s*$", line):
-                continue
-            (key, val) = line.split()
-            if ':' in key:
-                msg = "Syntax error in config file: colons not allowed"
-                raise pyppi_error(msg)
-            key = key.strip()
-            val = val.strip()
-            if key == 'root':
-                if rval['root'] is None:
-                    rval['root'] = tbx.expand(val)
-                else:
-                    raise pyppi_error("root was already set")
-            elif key == 'package':
-                rval['packages'][val] = []
-                cpkg = rval['packages'][val]
-            elif key == 'version':
-                cpkg.append({'version': val})
-            elif key == 'url':
-                cpkg[-1]['url'] = val
-            elif key == 'minpy':
-                cpkg[-1]['minpy'] = val
+    import threading
+    paths = {dist_path(_.url, root, pkg) for _ in pkg_l if _.url}
+    paths.discard(None)
+    if not paths:
+        return pkg_l
+    lock = lock or threading.Lock()
+    with lock:
+        cache = {_: dists[_] for _ in paths if _ in dists}
+    (pkg_d, cache) = hash_releases({'root': root, 'packages': {pkg: pkg_l}},
+                                   cache, metadata=metadata)
+    with lock:
+        for path in paths:
+            if path in cache:
+                dists[path] = cache[path]
+            else:
+                dists.pop(path, None)
+    return pkg_d[pkg]
+
+
+# -----------------------------------------------------------------------------
+def dist_current(path, facts, metadata=True):
+    """
+    Return True if the cached *facts* for *path* cover everything a build
+    needs: its sha256 and, with *metadata* True and *path* a wheel, the
+    outcome of writing its metadata file, which must still be in place
+    """
+    if 'sha256' not in facts:
+        return False
+    if not (metadata and path.endswith('.whl')):
+        return True
+    if 'metadata' not in facts:
+        return False
+    return facts['metadata'] is None or os.path.exists(path + ".metadata")
+
+
+# -----------------------------------------------------------------------------
+def core_metadata(path):
+    """
+    Write the core metadata of wheel *path* (its *.dist-info/METADATA) to
+    *path*.metadata as PEP 658 describes and return its sha256, or None if
+    the wheel has no metadata to give. An OSError (say, from a read-only
+    wheelhouse) is passed on so the next build tries again.
+    """
+    import hashlib
+    from pyppi import scan
+    import zipfile
+    try:
+        data = scan.dist_metadata(path)
+    except (zipfile.BadZipFile, pyppi_error):
+        return None
+    write_atomic(path + ".metadata", data)
+    metrics.count('metadata_written')
+    return hashlib.sha256(data).hexdigest()
+
+
+# -----------------------------------------------------------------------------
+def cached_facts(cache, path, stamp):
+    """
+    Return the facts dict that dist cache *cache* holds for *path* if its
+    entry matches *stamp* (size, mtime_ns, inode), or an empty dict
+    """
+    entry = cache.get(path)
+    if entry and tuple(entry[:3]) == stamp:
+        return entry[3]
+    return {}
+
+
+# -----------------------------------------------------------------------------
+def dist_path(url, root, pkgname):
+    """
+    Return the local path of the file that release *url* names, or None if
+    it does not name a local file. file:// urls name the file in their path.
+    A root-relative url is resolved the way the root page's links are, with
+    /<root>/ being *root*. A relative url is resolved against the page for
+    *pkgname*.
+    """
+    from urllib import parse as urlparse
+    parts = urlparse.urlsplit(url)
+    if parts.scheme == 'file':
+        if parts.netloc not in ('', 'localhost'):
+            return None
+        return urlparse.unquote(parts.path)
+    if parts.scheme or parts.netloc or not parts.path:
+        return None
+    path = urlparse.unquote(parts.path)
+    if path.startswith("/"):
+        docroot = os.sep if os.path.isabs(root) else ""
+        return os.path.abspath(os.path.join(docroot, path.lstrip("/")))
+    return os.path.abspath(os.path.join(root, pkgname, path))
+
+
+# -----------------------------------------------------------------------------
+def hashed_url(release):
+    """
+    Return the url of *release* with its sha256, if it has one, in the
+    fragment. An existing fragment (like #egg=...) is kept.
+    """
+    url = release['url']
+    if 'sha256' not in release:
+        return url
+    sep = "&" if "#" in url else "#"
+    return "{}{}sha256={}".format(url, sep, release['sha256'])
+
+
+# -----------------------------------------------------------------------------
+def dist_cache_path(root):
+    """
+    Return the path of the dist cache for *root*. It is kept beside root,
+    not in it, so it is never part of the published tree.
+    """
+    (dirname, basename) = os.path.split(os.path.abspath(str(root)))
+    return os.path.join(dirname, ".{}{}".format(basename, DIST_CACHE))
+
+
+# -----------------------------------------------------------------------------
+def read_dist_cache(root):
+    """
+    Return the dist cache kept for *root*, or an empty one if it is
+    missing or damaged
+    """
+    path = dist_cache_path(root)
+    try:
+        with open(path, 'rb') as rbl:
+            if rbl.read(len(DIST_CACHE_MAGIC)) != DIST_CACHE_MAGIC:
+                return {}
+            rval = marshal.loads(rbl.read())
+        if not isinstance(rval, dict):
+            return {}
+    except (OSError, EOFError, ValueError, TypeError):
+        return {}
     return rval
 
 
 # -----------------------------------------------------------------------------
-class pyppi_error(Exception):
+def write_dist_cache(root, cache, fsync='none'):
     """
-    Error class for errors in this program
+    Store *cache* as the dist cache for *root*, or remove the cache if
+    *cache* is empty. Failure to write the cache is not an error.
+    """
+    path = dist_cache_path(root)
+    try:
+        if cache:
+            write_atomic(path, DIST_CACHE_MAGIC + marshal.dumps(cache), fsync)
+        elif os.path.lexists(path):
+            os.remove(path)
+    except OSError:
+        pass
+
+
+# -----------------------------------------------------------------------------
+def codecs_option(value):
+    """
+    Validate the value of the --precompress option and return the list of
+    sibling extensions it asks for
+    """
+    rval = []
+    for codec in (value or "").split(","):
+        ext = ".{}".format(codec.strip())
+        if ext == ".":
+            continue
+        if ext not in COMPRESSORS:
+            raise pyppi_error("--precompress codecs are {}".format(
+                ", ".join(_[1:] for _ in sorted(COMPRESSORS))))
+        if ext == ".br":
+            try:
+                import brotli                                 # noqa: F401
+            except ImportError:
+                raise pyppi_error("--precompress br needs the brotli module")
+        rval.append(ext)
+    return rval
+
+
+# -----------------------------------------------------------------------------
+def gzip_chunks(chunks):
+    """
+    Generate the gzip stream for the bytes *chunks*. The header carries no
+    timestamp, so the same input always gives the same output.
+    """
+    comp = zlib.compressobj(9, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        out = comp.compress(chunk)
+        if out:
+            yield out
+    yield comp.flush()
+
+
+# -----------------------------------------------------------------------------
+def brotli_chunks(chunks):
+    """
+    Generate the brotli stream for the bytes *chunks*
+    """
+    import brotli
+    comp = brotli.Compressor(quality=11)
+    for chunk in chunks:
+        out = comp.process(chunk)
+        if out:
+            yield out
+    yield comp.finish()
+
+
+# -----------------------------------------------------------------------------
+def write_atomic(path, data, fsync='none'):
+    """
+    Write *data* (bytes or an iterable of bytes, which is written as it is
+    produced) to *path* by way of a temporary file in the same
+    directory that is then renamed over *path*. Readers see the old content
+    or the new, never a partial file, and a hard link to the old file keeps
+    the old content. With *fsync* 'pages' or 'all', the data is flushed to
+    disk before the rename. With 'all', the directory is flushed after it.
+    """
+    dirname = os.path.dirname(os.path.abspath(path))
+    os.makedirs(dirname, exist_ok=True)
+    tmp = "{}.{}.tmp".format(path, os.getpid())
+    if isinstance(data, bytes):
+        data = [data]
+    with open(tmp, 'wb', buffering=WRITE_BUFSIZE) as wbl:
+        wbl.writelines(data)
+        metrics.count('files_written')
+        metrics.count('bytes_written', wbl.tell())
+        if fsync != 'none':
+            wbl.flush()
+            os.fsync(wbl.fileno())
+    os.replace(tmp, path)
+    if fsync == 'all':
+        fsync_dir(dirname)
+
+
+# -----------------------------------------------------------------------------
+def fsync_dir(dirname):
+    """
+    Flush the directory entries of *dirname* to disk
+    """
+    fd = os.open(dirname, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+# -----------------------------------------------------------------------------
+def build_staged(cfg, cfghash=None, fsync='none', **opts):
+    """
+    Build the index for *cfg* in a staging directory next to root and swap
+    it into place once every page has been written. The staging directory
+    starts as a hard linked copy of the current tree so the build stays
+    incremental; pages are replaced by rename, so the live tree is never
+    modified. If the build fails, the staging directory is removed and root
+    is left as it was. *opts* are passed on to build_index_htmls(), and
+    what it returns is returned.
+    """
+    import shutil
+    root = os.path.abspath(cfg['root'])
+    staging = os.path.join(os.path.dirname(root),
+                           ".{}.staging".format(os.path.basename(root)))
+    if os.path.lexists(staging):
+        shutil.rmtree(staging)
+    if os.path.isdir(root):
+        with metrics.span("link staging tree"):
+            shutil.copytree(os.path.realpath(root), staging, symlinks=True,
+                            copy_function=os.link)
+    try:
+        pkg_d = build_index_htmls(cfg, cfghash=cfghash, fsync=fsync,
+                                  into=staging, **opts)
+    except BaseException:
+        shutil.rmtree(staging, ignore_errors=True)
+        raise
+    with metrics.span("publish"):
+        publish(root, staging, fsync)
+    return pkg_d
+
+
+# -----------------------------------------------------------------------------
+def publish(root, staging, fsync='none'):
+    """
+    Put the tree in *staging* in place at *root* and remove the tree it
+    replaces.
+
+    If *root* is a symlink, *staging* is renamed to a new generation
+    directory and a new symlink to it is renamed over *root*. Otherwise the
+    two directories are exchanged with renameat2(RENAME_EXCHANGE), or, where
+    that is not supported, with two renames in quick succession.
+
+    The tree a symlink pointed at is only removed if it is a generation
+    directory made here before, .<root>.<n> beside *root*. Any other
+    target belongs to the user and is left in place.
+    """
+    import shutil
+    parent = os.path.dirname(root)
+    if os.path.islink(root):
+        base = os.path.basename(root)
+        stale = os.path.realpath(root)
+        made = re.match(r"\.{}\.\d+$".format(re.escape(base)),
+                        os.path.basename(stale))
+        if not made or os.path.dirname(stale) != os.path.realpath(parent):
+            stale = None
+        gen = os.path.join(parent, ".{}.{}".format(base,
+                                                   int(time.time() * 1e6)))
+        os.rename(staging, gen)
+        link = "{}.{}.tmp".format(root, os.getpid())
+        os.symlink(os.path.basename(gen), link)
+        os.replace(link, root)
+    elif os.path.isdir(root):
+        stale = staging
+        if not rename_exchange(staging, root):
+            stale = "{}.old".format(staging)
+            os.rename(root, stale)
+            os.rename(staging, root)
+    else:
+        stale = None
+        os.rename(staging, root)
+    if fsync == 'all':
+        fsync_dir(parent)
+    if stale:
+        shutil.rmtree(stale)
+
+
+# -----------------------------------------------------------------------------
+def rename_exchange(src, dst):
+    """
+    Atomically exchange the paths *src* and *dst* using renameat2(2). Return
+    False if the platform or filesystem does not support it.
+    """
+    import ctypes
+    try:
+        renameat2 = ctypes.CDLL(None, use_errno=True).renameat2
+    except (AttributeError, OSError):
+        return False
+    at_fdcwd = -100
+    rename_exchange = 2
+    rc = renameat2(at_fdcwd, os.fsencode(src), at_fdcwd, os.fsencode(dst),
+                   rename_exchange)
+    if rc != 0:
+        err = ctypes.get_errno()
+        if err in (errno.ENOSYS, errno.EINVAL):
+            return False
+        raise OSError(err, os.strerror(err), src)
+    return True
+
+
+# -----------------------------------------------------------------------------
+def remove_page(root, relpath, quiet=False):
+    """
+    Remove the page *relpath* under *root* along with its directory if that
+    leaves the directory empty
+    """
+    target = os.path.join(str(root), relpath)
+    if os.path.exists(target):
+        if not quiet:
+            print("removing file {}".format(target))
+        os.remove(target)
+        metrics.count('pages_removed')
+    try:
+        os.rmdir(os.path.dirname(target))
+    except OSError:
+        pass
+
+
+# -----------------------------------------------------------------------------
+def pool_map(func, items, jobs=1):
+    """
+    Generate func(item) for each of *items* in order, calling func on a pool
+    of *jobs* threads if *jobs* > 1. concurrent.futures, which brings in
+    logging, is only imported when a pool is wanted.
+    """
+    if jobs <= 1:
+        yield from map(func, items)
+        return
+    from concurrent import futures
+    with futures.ThreadPoolExecutor(max_workers=jobs) as pool:
+        yield from pool.map(func, items)
+
+
+# -----------------------------------------------------------------------------
+def jobs_option(value):
+    """
+    Validate the value of the --jobs option and return it as an int
+    """
+    try:
+        jobs = int(value)
+    except (TypeError, ValueError):
+        jobs = 0
+    if jobs < 1:
+        raise pyppi_error("--jobs must be a positive integer")
+    return jobs
+
+
+# -----------------------------------------------------------------------------
+def index_html_root(cfg):
+    """
+    Write the root package index.html
+    """
+    from py.path import local as pypath
+    root = pypath(cfg['root'])
+    target = root.join("index.html")
+    print("writing file {}".format(target.strpath))
+    write_atomic(target.strpath, encoded(root_chunks(cfg)))
+
+
+# -----------------------------------------------------------------------------
+def index_html_package(root, pkgname, pkg_l):
+    """
+    Write an index.html for each package in cfg
+    """
+    from py.path import local as pypath
+    target = pypath("{}/{}/index.html".format(root, pkgname))
+    print("writing file {}".format(target.strpath))
+    write_atomic(target.strpath, encoded(package_chunks(pkgname, pkg_l)))
+
+
+# -----------------------------------------------------------------------------
+def render_root(cfg):
+    """
+    Return the content of the root package index.html
+    """
+    return "".join(root_chunks(cfg))
+
+
+# -----------------------------------------------------------------------------
+def render_package(pkgname, pkg_l):
+    """
+    Return the content of the index.html for package *pkgname*
+    """
+    return "".join(package_chunks(pkgname, pkg_l))
+
+
+# -----------------------------------------------------------------------------
+def root_chunks(cfg):
+    """
+    Generate the root package index.html a line at a time
+    """
+    yield PAGE_HEAD
+    root = cfg['root']
+    for pkg in cfg['packages']:
+        yield "    <a href=\"/{}/{}/\">{}</a>\n".format(root, pkg, pkg)
+    yield PAGE_TAIL
+
+
+# -----------------------------------------------------------------------------
+def package_chunks(pkgname, pkg_l):
+    """
+    Generate the index.html for package *pkgname* a line at a time
+    """
+    yield PAGE_HEAD
+    for release in pkg_l:
+        attrs = ""
+        if 'minpy' in release:
+            attrs += " data-requires-python=\"&gt;={}\"".format(
+                release['minpy'])
+        if 'metadata' in release:
+            attrs += (" data-dist-info-metadata=\"sha256={0}\""
+                      " data-core-metadata=\"sha256={0}\"").format(
+                          release['metadata'])
+        yield "    <a href=\"{}\"{}>{}-{}</a>\n".format(
+            hashed_url(release), attrs, pkgname, release['version'])
+    yield PAGE_TAIL
+
+
+# -----------------------------------------------------------------------------
+def root_json_chunks(cfg):
+    """
+    Generate the PEP 691 JSON form of the root page a project at a time
+    """
+    import json
+    yield '{{"meta": {}, "projects": ['.format(json.dumps(JSON_META))
+    sep = ""
+    for pkg in cfg['packages']:
+        yield sep + json.dumps({'name': pkg})
+        sep = ", "
+    yield "]}\n"
+
+
+# -----------------------------------------------------------------------------
+def package_json_chunks(pkgname, pkg_l):
+    """
+    Generate the PEP 691 JSON form of the page for package *pkgname* a file
+    at a time
+    """
+    import json
+    yield '{{"meta": {}, "name": {}, "files": ['.format(
+        json.dumps(JSON_META), json.dumps(normalize(pkgname)))
+    sep = ""
+    for release in pkg_l:
+        entry = {'filename': dist_filename(release['url'], pkgname,
+                                           release['version']),
+                 'url': release['url'],
+                 'hashes': {}}
+        if 'sha256' in release:
+            entry['hashes']['sha256'] = release['sha256']
+        if 'metadata' in release:
+            entry['core-metadata'] = {'sha256': release['metadata']}
+            entry['dist-info-metadata'] = entry['core-metadata']
+        if 'minpy' in release:
+            entry['requires-python'] = ">={}".format(release['minpy'])
+        yield sep + json.dumps(entry)
+        sep = ", "
+    yield "]}\n"
+
+
+# -----------------------------------------------------------------------------
+def dist_filename(url, pkgname, version):
+    """
+    Return the name of the file release *url* names: the last part of its
+    path. A url with no file part, like a version control url
+    (git+https://...) or one ending in a slash, gets "*pkgname*-*version*".
+    """
+    from urllib import parse as urlparse
+    parts = urlparse.urlsplit(url)
+    name = urlparse.unquote(parts.path.rpartition("/")[2])
+    if not name or "+" in parts.scheme:
+        return "{}-{}".format(pkgname, version)
+    return name
+
+
+# -----------------------------------------------------------------------------
+def normalize(name):
+    """
+    Normalize project *name* as PEP 503 describes
+    """
+    return re.sub(r"[-_.]+", "-", name).lower()
+
+
+# -----------------------------------------------------------------------------
+def encoded(chunks):
+    """
+    Encode each of the str *chunks* for writing
+    """
+    for chunk in chunks:
+        yield chunk.encode()
+
+
+# -----------------------------------------------------------------------------
+def page_hash(payload):
+    """
+    Return the sha256 hex digest of page content *payload*, which may be a
+    str or an iterable of str chunks
+    """
+    if isinstance(payload, str):
+        payload = [payload]
+    import hashlib
+    digest = hashlib.sha256()
+    for chunk in payload:
+        digest.update(chunk.encode())
+    return digest.hexdigest()
+
+
+# -----------------------------------------------------------------------------
+def file_hash(filename):
+    """
+    Return the sha256 hex digest of the contents of *filename*
+    """
+    import hashlib
+    digest = hashlib.sha256()
+    with open(filename, 'rb') as rbl:
+        for chunk in iter(lambda: rbl.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+# -----------------------------------------------------------------------------
+def read_manifest(root):
+    """
+    Load the build manifest from *root*. A missing or unreadable manifest
+    yields an empty one so that the next build writes every page.
+    """
+    import json
+    path = os.path.join(str(root), MANIFEST)
+    try:
+        with open(path, 'r') as rbl:
+            rval = json.load(rbl)
+        if not isinstance(rval.get('pages'), dict):
+            raise ValueError(path)
+    except (OSError, ValueError):
+        rval = {'config': None, 'pages': {}}
+    return rval
+
+
+# -----------------------------------------------------------------------------
+def write_manifest(root, manifest, fsync='none'):
+    """
+    Write *manifest* into *root*
+    """
+    import json
+    path = os.path.join(str(root), MANIFEST)
+    data = json.dumps(manifest, indent=1, sort_keys=True) + "\n"
+    write_atomic(path, data.encode(), fsync)
+
+
+# -----------------------------------------------------------------------------
+def conditional_debug(debug_option):                         # pragma: no cover
+    """
+    Start the debugger if the debug option is True
+    """
+    if debug_option:
+        import pdb
+        pdb.set_trace()
+
+
+# -----------------------------------------------------------------------------
+def load_cfg(filename, cache=True, engine=None, expand=True, files=None):
+    """
+    Return the config data in *filename* and the sha256 of the file. With
+    *expand* False, roots are left as written (see read_cfg_file).
+
+    If *filename* has include lines, the fragments they name are loaded
+    too (see load_fragments) and merged in (see merged_cfg), and the hash
+    returned covers every file. If *files* is a list, the paths of
+    *filename* and every fragment read are added to it, which is how
+    --watch and serve know what to watch.
+
+    If *filename* is a store (see pyppi.store), its contents are read from
+    it and there is no cache.
+    """
+    path = os.path.abspath(str(filename))
+    if cfg_format(filename) == 'store':
+        from pyppi import store
+        rval = store.load(filename)
+        if files is not None:
+            files.append(path)
+        return rval
+    (cfg, digest) = load_cfg_file(filename, cache, engine, expand)
+    if 'include' not in cfg:
+        if files is not None:
+            files.append(path)
+        return (cfg, digest)
+    loaded = {path: (cfg, digest)}
+    includes = {}
+    level = [path]
+    while level:
+        wanted = []
+        for fpath in level:
+            includes[fpath] = included_files(fpath, loaded[fpath][0])
+            for (_, _, _, fragments) in includes[fpath]:
+                wanted.extend(_ for _ in fragments
+                              if _ not in loaded and _ not in wanted)
+        loaded.update(zip(wanted, load_fragments(wanted, cache, engine,
+                                                 expand)))
+        level = wanted
+    rval = merged_cfg(path, loaded, includes)
+    if files is not None:
+        files.extend(loaded)
+    return rval
+
+
+# -----------------------------------------------------------------------------
+def load_cfg_file(filename, cache=True, engine=None, expand=True):
+    """
+    Return the config data in the single file *filename*, with its include
+    lines unresolved, and the sha256 of the file.
+
+    The parsed data is kept in a cache file beside *filename*, keyed on the
+    path, size, mtime_ns, and sha256 of *filename*. If the path, size, and
+    mtime match, the cached data is used without reading *filename*. If only
+    the mtime differs, the file is hashed and the cache is still used when
+    the hash matches. A cache that is unreadable, corrupt, or from another
+    file is ignored and replaced. With *cache* False, *filename* is parsed
+    and the cache is neither read nor written. A config in the marshal
+    format loads as fast as its cache would, so it is never cached. The
+    cache holds expanded roots, so it is not used with *expand* False.
+    """
+    if not (cache and expand) or cfg_format(filename) == 'marshal':
+        return (read_cfg_file(filename, engine=engine, expand=expand),
+                file_hash(filename))
+
+    path = os.path.abspath(str(filename))
+    cpath = cfg_cache_path(path)
+    info = os.stat(path)
+    entry = read_cfg_cache(cpath)
+    if entry and entry['path'] == path and entry['size'] == info.st_size:
+        if entry['mtime_ns'] == info.st_mtime_ns:
+            return (unpacked_cfg(entry['cfg']), entry['sha256'])
+        digest = file_hash(path)
+        if entry['sha256'] == digest:
+            entry['mtime_ns'] = info.st_mtime_ns
+            write_cfg_cache(cpath, entry)
+            return (unpacked_cfg(entry['cfg']), digest)
+
+    digest = file_hash(path)
+    cfg = read_cfg_file(path, engine=engine)
+    write_cfg_cache(cpath, {'path': path,
+                            'size': info.st_size,
+                            'mtime_ns': info.st_mtime_ns,
+                            'sha256': digest,
+                            'cfg': packed_cfg(cfg)})
+    return (cfg, digest)
+
+
+# -----------------------------------------------------------------------------
+def included_files(filename, cfg):
+    """
+    Return the include lines of config file *filename*, whose own contents
+    are *cfg*, as (line number, pattern, position, paths) tuples, where
+    position is the number of packages listed before the line and paths
+    are the files the pattern names. A pattern is expanded like root, is
+    relative to the directory of *filename*, and may be a glob, whose
+    matches are taken in sorted order. A pattern with no wildcards must
+    name a file that exists.
+    """
+    import glob
+    import tbx
+    rval = []
+    dirname = os.path.dirname(filename)
+    for (lineno, pattern, position) in cfg.get('include', []):
+        fullpat = os.path.join(dirname, tbx.expand(pattern))
+        paths = sorted(os.path.abspath(_) for _ in glob.glob(fullpat)
+                       if os.path.isfile(_))
+        if not paths and not glob.has_magic(fullpat):
+            raise pyppi_error("{}:{}: no such file: {}"
+                              .format(filename, lineno, pattern))
+        rval.append((lineno, pattern, position, paths))
+    return rval
+
+
+# -----------------------------------------------------------------------------
+def load_fragments(paths, cache=True, engine=None, expand=True):
+    """
+    Return load_cfg_file(path) for each of *paths*. Each fragment has a
+    cache of its own, so only the fragments that changed are parsed. When
+    those add up to at least FRAGMENT_POOL_BYTES, they are parsed at the
+    same time by a pool of processes, one per CPU at most.
+    """
+    stale = []
+    if sum(os.path.getsize(_) for _ in paths) >= FRAGMENT_POOL_BYTES:
+        stale = [_ for _ in paths
+                 if not (cache and expand) or not cfg_cache_fresh(_)]
+    nbytes = sum(os.path.getsize(_) for _ in stale)
+    if len(stale) < 2 or nbytes < FRAGMENT_POOL_BYTES:
+        return [fragment_task((_, cache, engine, expand)) for _ in paths]
+
+    import multiprocessing
+    from concurrent import futures
+    method = "forkserver"
+    if method not in multiprocessing.get_all_start_methods():
+        method = "spawn"
+    opts = {'max_workers': min(len(stale), os.cpu_count() or 1)}
+    if sys.version_info >= (3, 7):
+        # python 3.6 has no mp_context and forks its workers
+        opts['mp_context'] = multiprocessing.get_context(method)
+    with metrics.span("parse fragments"):
+        with futures.ProcessPoolExecutor(**opts) as pool:
+            parsed = dict(zip(stale, pool.map(packed_fragment_task,
+                                              [(_, cache, engine, expand)
+                                               for _ in stale])))
+    return [(unpacked_cfg(parsed[_][0]), parsed[_][1]) if _ in parsed
+            else fragment_task((_, cache, engine, expand)) for _ in paths]
+
+
+# -----------------------------------------------------------------------------
+def fragment_task(args):
+    """
+    Load the config fragment in args (path, cache, engine, expand) as
+    load_cfg_file() does, naming the fragment in any error
+    """
+    (path, cache, engine, expand) = args
+    try:
+        return load_cfg_file(path, cache, engine, expand)
+    except pyppi_error as err:
+        raise pyppi_error("{}: {}".format(path, err))
+
+
+# -----------------------------------------------------------------------------
+def packed_fragment_task(args):
+    """
+    Run fragment_task(*args*) in a worker process and return the config in
+    the packed form, which crosses back to the parent cheaply
+    """
+    (cfg, digest) = fragment_task(args)
+    return (packed_cfg(cfg), digest)
+
+
+# -----------------------------------------------------------------------------
+def cfg_cache_fresh(filename):
+    """
+    Return True if the cache of config file *filename* matches its path,
+    size, and mtime, so load_cfg_file() will not need to parse it
+    """
+    path = os.path.abspath(filename)
+    entry = read_cfg_cache(cfg_cache_path(path))
+    if entry is None or entry['path'] != path:
+        return False
+    info = os.stat(path)
+    return (entry['size'], entry['mtime_ns']) == (info.st_size,
+                                                  info.st_mtime_ns)
+
+
+# -----------------------------------------------------------------------------
+def merged_cfg(top, loaded, includes):
+    """
+    Merge config file *top* with the fragments it includes and return the
+    config and a hash of every file's sha256. *loaded* maps each path to
+    its (cfg, sha256) and *includes* to its included_files(). Packages are
+    listed in the order the files would have them if each include line
+    were replaced by the fragments it names. A package or variant listed by
+    two files, a root set by two, or a fragment that includes itself is an
+    error that names the file and line of each.
+    """
+    rval = {'root': None, 'packages': {}}
+    merge_fragment(rval, top, loaded, includes, {}, [top])
+    if rval['root'] is not None:
+        rval['root'] = rval['root'][0]
+    return (rval, files_hash({_: loaded[_][1] for _ in loaded}))
+
+
+# -----------------------------------------------------------------------------
+def files_hash(digests):
+    """
+    Return the hash that stands for a config made of several files, where
+    *digests* maps the path of each to its sha256
+    """
+    return page_hash(["{} {}\n".format(digests[_], _)
+                      for _ in sorted(digests)])
+
+
+# -----------------------------------------------------------------------------
+def merge_fragment(rval, path, loaded, includes, origin, stack):
+    """
+    Add the root, variants, and packages of config file *path*, and then
+    those of the fragments it includes, to *rval* as merged_cfg()
+    describes. *origin* maps each package merged so far, and each variant
+    root as a 1-tuple, to the file that listed it, and *stack* is the chain
+    of files that included *path*. While merging, *rval*'s root is (root,
+    file) so the file can be named.
+    """
+    cfg = loaded[path][0]
+    if cfg['root'] is not None:
+        if rval['root'] is not None:
+            raise pyppi_error("{}: root was already set at {}".format(
+                cfg_key_where(path, 'root'),
+                cfg_key_where(rval['root'][1], 'root')))
+        rval['root'] = (cfg['root'], path)
+    for (vroot, variant) in cfg.get('variants', {}).items():
+        variants = rval.setdefault('variants', {})
+        if vroot in variants:
+            raise pyppi_error("{}: variant {} was already set at {}".format(
+                cfg_key_where(path, 'variant', vroot), vroot,
+                cfg_key_where(origin[(vroot,)], 'variant', vroot)))
+        origin[(vroot,)] = path
+        variants[vroot] = variant
+    names = list(cfg['packages'])
+    start = 0
+    for (lineno, pattern, position, fragments) in includes[path] + [
+            (None, None, len(names), [])]:
+        for pkg in names[start:position]:
+            if pkg in origin:
+                raise pyppi_error("{}: package {} was already listed at {}"
+                                  .format(cfg_key_where(path, 'package', pkg),
+                                          pkg,
+                                          cfg_key_where(origin[pkg], 'package',
+                                                        pkg)))
+            origin[pkg] = path
+            rval['packages'][pkg] = cfg['packages'][pkg]
+        start = position
+        for fragment in fragments:
+            if fragment in stack:
+                raise pyppi_error("{}:{}: {} includes itself"
+                                  .format(path, lineno, fragment))
+            merge_fragment(rval, fragment, loaded, includes, origin,
+                           stack + [fragment])
+
+
+# -----------------------------------------------------------------------------
+def cfg_key_where(filename, key, val=None):
+    """
+    Return "*filename*:<line>" for the first line of config file *filename*
+    that sets *key* (to *val*, if given), or just *filename* if none does.
+    This is only called to report errors, so the file is read again rather
+    than having the parsers keep every line number.
+    """
+    with open(filename, 'r') as rbl:
+        for (lineno, line) in enumerate(rbl, start=1):
+            fields = re.sub(r"\s*#\s.*$", "", line).split()
+            if fields[:1] == [key] and val in (None, fields[-1]):
+                return "{}:{}".format(filename, lineno)
+    return filename
+
+
+# -----------------------------------------------------------------------------
+def cfg_format(filename):
+    """
+    Return the format of config *filename*: 'store' or 'marshal' if it
+    starts with their magic bytes, then 'json', 'toml', or 'marshal' if its
+    extension is in CFG_EXTENSIONS, then 'json' if it starts with '{', and
+    otherwise 'text', the line format
+    """
+    head = cfg_head(filename, 64)
+    if head.startswith(STORE_MAGIC):
+        return 'store'
+    if head.startswith(CFG_MARSHAL_MAGIC):
+        return 'marshal'
+    ext = os.path.splitext(str(filename))[1].lower()
+    if ext in CFG_EXTENSIONS:
+        return CFG_EXTENSIONS[ext]
+    if head.lstrip().startswith(b"{"):
+        return 'json'
+    return 'text'
+
+
+# -----------------------------------------------------------------------------
+def cfg_head(filename, size):
+    """
+    Return the first *size* bytes of *filename*
+    """
+    with open(str(filename), 'rb') as rbl:
+        return rbl.read(size)
+
+
+# -----------------------------------------------------------------------------
+def packed_cfg(cfg):
+    """
+    Return *cfg* in the form kept in the config cache, with each release
+    as a tuple of its fields, which marshal can store
+    """
+    rval = {'root': cfg['root'],
+            'packages': {pkg: [release(**_).fields() for _ in pkg_l]
+                         for (pkg, pkg_l) in cfg['packages'].items()}}
+    for key in ('include', 'variants'):
+        if key in cfg:
+            rval[key] = cfg[key]
+    return rval
+
+
+# -----------------------------------------------------------------------------
+def unpacked_cfg(packed):
+    """
+    Return the config that packed_cfg() turned into *packed*
+    """
+    rval = {'root': packed['root'],
+            'packages': {pkg: [release(*_) for _ in pkg_l]
+                         for (pkg, pkg_l) in packed['packages'].items()}}
+    if 'include' in packed:
+        rval['include'] = [tuple(_) for _ in packed['include']]
+    if 'variants' in packed:
+        rval['variants'] = packed['variants']
+    return rval
+
+
+# -----------------------------------------------------------------------------
+def cfg_cache_path(filename):
+    """
+    Return the path of the cache file for config file *filename*
+    """
+    (dirname, basename) = os.path.split(filename)
+    return os.path.join(dirname, ".{}{}".format(basename, CFG_CACHE))
+
+
+# -----------------------------------------------------------------------------
+def read_cfg_cache(cpath):
+    """
+    Return the entry stored in cache file *cpath*, or None if it is missing
+    or damaged
+    """
+    try:
+        with open(cpath, 'rb') as rbl:
+            if rbl.read(len(CFG_CACHE_MAGIC)) != CFG_CACHE_MAGIC:
+                return None
+            entry = marshal.loads(rbl.read())
+        if set(entry) != {'path', 'size', 'mtime_ns', 'sha256', 'cfg'}:
+            return None
+    except (OSError, EOFError, ValueError, TypeError):
+        return None
+    return entry
+
+
+# -----------------------------------------------------------------------------
+def write_cfg_cache(cpath, entry):
+    """
+    Store *entry* in cache file *cpath*. The file is replaced by rename, so
+    a crash leaves the old cache or the new one. Failure to write the cache
+    is not an error.
+    """
+    try:
+        write_atomic(cpath, CFG_CACHE_MAGIC + marshal.dumps(entry))
+    except OSError:
+        pass
+
+
+# -----------------------------------------------------------------------------
+def cfg_lines(cfg):
+    """
+    Generate the lines of a config file that read_cfg_file() reads as *cfg*
+    """
+    yield "root            {}\n".format(cfg['root'])
+    for (vroot, variant) in cfg.get('variants', {}).items():
+        yield "\nvariant         {}\n".format(vroot)
+        if variant['maxpy']:
+            yield "    maxpy       {}\n".format(variant['maxpy'])
+        for key in ('allow', 'deny'):
+            for pkg in variant[key]:
+                yield "    {:12s}{}\n".format(key, pkg)
+    for (pkg, pkg_l) in cfg['packages'].items():
+        yield "\n"
+        yield from package_lines(pkg, pkg_l)
+
+
+# -----------------------------------------------------------------------------
+def package_lines(pkg, pkg_l):
+    """
+    Generate the config file lines for package *pkg* with releases *pkg_l*
+    """
+    yield "package         {}\n".format(pkg)
+    for release in pkg_l:
+        yield "    version     {}\n".format(release['version'])
+        if 'url' in release:
+            yield "    url         {}\n".format(release['url'])
+        if 'minpy' in release:
+            yield "    minpy       {}\n".format(release['minpy'])
+
+
+# -----------------------------------------------------------------------------
+def read_cfg_file(filename, engine=None, expand=True):
+    """
+    Load config data from *filename* using the parser named by *engine*
+    (default CFG_ENGINE, which can be set with $PYPPI_PARSER), or if the
+    file is in another format (see cfg_format), the reader for that format
+    in pyppi.formats. With *expand* False, root and the variant roots are
+    left as written rather than expanded (see cfg_path).
+    """
+    fmt = cfg_format(filename)
+    if fmt not in ('text', 'store'):
+        from pyppi import formats
+        return formats.read(filename, fmt, expand)
+    engine = engine or CFG_ENGINE
+    if engine not in cfg_engines:
+        raise pyppi_error("unknown config parser '{}'".format(engine))
+    if not expand:
+        return cfg_engines[engine](filename, expand=False)
+    return cfg_engines[engine](filename)
+
+
+# -----------------------------------------------------------------------------
+def cfg_path(val, expand=True):
+    """
+    Return *val*, the value of a root or variant line, with ~ and
+    environment variables expanded (see tbx.expand), or as it is if
+    *expand* is False
+    """
+    import tbx
+    return tbx.expand(val) if expand else val
+
+
+# -----------------------------------------------------------------------------
+def read_cfg_fast(filename, expand=True):
+    """
+    Load config data from *filename* by running CFG_LINE_RX over an mmap of
+    the whole file. Files containing anything the pattern does not handle
+    exactly like read_cfg_reference() (non-ASCII bytes, carriage returns,
+    lines that are not a single key/value pair) are handed to the reference
+    parser so the result and any error raised are always the same. Roots
+    are expanded unless *expand* is False.
+    """
+    rval = {'root': None,
+            'packages': {}}
+    with open(filename, 'rb') as rbl:
+        if os.fstat(rbl.fileno()).st_size == 0:
+            return rval
+        with mmap.mmap(rbl.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+            if CFG_ODD_RX.search(buf):
+                return read_cfg_reference(filename, expand)
+            (cpkg, cvariant) = (None, None)
+            (counted, lineno) = (0, 1)
+            for match in CFG_LINE_RX.finditer(buf):
+                (key, val, odd) = match.groups()
+                if key is None:
+                    if odd is None:
+                        continue
+                    return read_cfg_reference(filename, expand)
+                if b':' in key:
+                    msg = "Syntax error in config file: colons not allowed"
+                    raise pyppi_error(msg)
+                val = val.decode()
+                if key == b'version':
+                    cpkg.append(release(val))
+                elif key == b'url':
+                    cpkg[-1].url = val
+                elif key == b'minpy':
+                    cpkg[-1].minpy = sys.intern(val)
+                elif key == b'package':
+                    rval['packages'][val] = []
+                    cpkg = rval['packages'][val]
+                elif key == b'root':
+                    if rval['root'] is None:
+                        rval['root'] = cfg_path(val, expand)
+                    else:
+                        raise pyppi_error("root was already set")
+                elif key == b'include':
+                    lineno += buf[counted:match.start()].count(b"\n")
+                    counted = match.start()
+                    rval.setdefault('include', []).append(
+                        (lineno, val, len(rval['packages'])))
+                elif key == b'variant':
+                    cvariant = new_variant(rval, cfg_path(val, expand))
+                elif key in VARIANT_KEYS:
+                    set_variant(cvariant, key.decode(), val)
+    return rval
+
+
+# -----------------------------------------------------------------------------
+def read_cfg_reference(filename, expand=True):
+    """
+    Load config data from *filename* one line at a time. This is the original
+    parser, kept as the definition of the config syntax that
+    read_cfg_fast() must reproduce. Roots are expanded unless *expand* is
+    False.
+    """
+    rval = {'root': None,
+            'packages': {}}
+    with open(filename, 'r') as rbl:
+        (cpkg, cvariant) = (None, None)
+        for (lineno, line) in enumerate(rbl, start=1):
+            # throw away any comment at the end of the line
+            # the '#' must be followed by whitespace to be a valid comment
+            line = re.sub(r"\s*#\s.*$", "", line)
+            # ignore blank lines
+            if re.match(r"^\s*$", line):
+                continue
+            (key, val) = line.split()
+            if ':' in key:
+                msg = "Syntax error in config file: colons not allowed"
+                raise pyppi_error(msg)
+            key = key.strip()
+            val = val.strip()
+            if key == 'root':
+                if rval['root'] is None:
+                    rval['root'] = cfg_path(val, expand)
+                else:
+                    raise pyppi_error("root was already set")
+            elif key == 'package':
+                rval['packages'][val] = []
+                cpkg = rval['packages'][val]
+            elif key == 'version':
+                cpkg.append(release(val))
+            elif key == 'url':
+                cpkg[-1].url = val
+            elif key == 'minpy':
+                cpkg[-1].minpy = sys.intern(val)
+            elif key == 'include':
+                rval.setdefault('include', []).append(
+                    (lineno, val, len(rval['packages'])))
+            elif key == 'variant':
+                cvariant = new_variant(rval, cfg_path(val, expand))
+            elif key in ('maxpy', 'allow', 'deny'):
+                set_variant(cvariant, key, val)
+    return rval
+
+
+# -----------------------------------------------------------------------------
+def new_variant(cfg, root):
+    """
+    Add a variant tree at *root* to config *cfg* and return its filter
+    """
+    variants = cfg.setdefault('variants', {})
+    if root in variants:
+        raise pyppi_error("variant {} was already set".format(root))
+    variants[root] = {'maxpy': None, 'allow': [], 'deny': []}
+    return variants[root]
+
+
+# -----------------------------------------------------------------------------
+def set_variant(variant, key, val):
+    """
+    Apply a maxpy, allow, or deny line, *key* *val*, to the filter of the
+    *variant* it follows
+    """
+    if variant is None:
+        raise pyppi_error("{} must follow a variant line".format(key))
+    if key == 'maxpy':
+        variant['maxpy'] = val
+    else:
+        variant[key].append(val)
+
+
+# -----------------------------------------------------------------------------
+class release(object):
+    """
+    One release of a package, read from the config: a mapping holding
+    'version' and, when the config gives them, 'url' and 'minpy', that
+    behaves like the dict it replaces. Keeping the values in slots instead
+    of a dict makes a release about a third of the size, and the version
+    and minpy strings are interned so the few distinct values are shared,
+    which is what lets configs with millions of releases fit in memory.
+    """
+    __slots__ = RELEASE_KEYS
+
+    def __init__(self, version, url=None, minpy=None):
+        """
+        Hold *version* and optionally *url* and *minpy*
+        """
+        self.version = sys.intern(version)
+        self.url = url
+        self.minpy = None if minpy is None else sys.intern(minpy)
+
+    def __getitem__(self, key):
+        """
+        Return the value of *key*, raising KeyError if it is not set
+        """
+        value = getattr(self, key) if key in RELEASE_KEYS else None
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        """
+        Set *key*, which must be one of RELEASE_KEYS, to *value*
+        """
+        if key not in RELEASE_KEYS:
+            raise KeyError(key)
+        setattr(self, key, value)
+
+    def __delitem__(self, key):
+        """
+        Unset *key*
+        """
+        self[key]
+        setattr(self, key, None)
+
+    def __iter__(self):
+        """
+        Generate the keys that are set
+        """
+        return (_ for _ in RELEASE_KEYS if getattr(self, _) is not None)
+
+    def __len__(self):
+        """
+        Return the number of keys that are set
+        """
+        return sum(1 for _ in self)
+
+    def __contains__(self, key):
+        """
+        Return True if *key* is set
+        """
+        return key in RELEASE_KEYS and getattr(self, key) is not None
+
+    def get(self, key, default=None):
+        """
+        Return the value of *key*, or *default* if it is not set
+        """
+        value = getattr(self, key) if key in RELEASE_KEYS else None
+        return default if value is None else value
+
+    def keys(self):
+        """
+        Return a list of the keys that are set
+        """
+        return list(self)
+
+    def items(self):
+        """
+        Return a list of the (key, value) pairs that are set
+        """
+        return [(_, getattr(self, _)) for _ in self]
+
+    def values(self):
+        """
+        Return a list of the values that are set
+        """
+        return [getattr(self, _) for _ in self]
+
+    def __eq__(self, other):
+        """
+        Return True if *other*, a release or a dict, holds the same keys and
+        values
+        """
+        if isinstance(other, release):
+            return self.fields() == other.fields()
+        if isinstance(other, dict):
+            return dict(self.items()) == other
+        return NotImplemented
+
+    __hash__ = None
+
+    def __repr__(self):
+        """
+        Show the release as the dict it stands for
+        """
+        return repr(dict(self))
+
+    def fields(self):
+        """
+        Return (version, url, minpy), with None for those not set, which is
+        how releases are stored in the config cache
+        """
+        return (self.version, self.url, self.minpy)
+
+
+# -----------------------------------------------------------------------------
+class pyppi_error(Exception):
+    """
+    Error class for errors in this program
     """
     pass
 
+
+cfg_engines = {'fast': read_cfg_fast,
+               'reference': read_cfg_reference}
+
+# compressed sibling extension and the generator that produces it
+COMPRESSORS = {'.gz': gzip_chunks,
+               '.br': brotli_chunks}
+
+# page file name, root page generator, package page generator
+PAGE_FORMATS = {'html': ("index.html", root_chunks, package_chunks),
+                'json': ("index.json", root_json_chunks, package_json_chunks)}
+
 # ==TAGGABLE==
@@ -0,0 +1,251 @@
+"""
+Find one package's block in a config file without parsing the rest
+
+A block index lists the packages of a config in the line format, in
+config order, with the byte range of each one's block: from its package
+line up to the next package, root, include, or variant line. It is kept
+beside the config in .FILENAME.pyppi-blocks and used as long as the
+config's path, device, inode, size, and mtime are the ones it was made
+for. Otherwise it is made again by one pass of BLOCK_RX over the file,
+which only looks at those four kinds of line.
+
+With the index, reading a package means seeking to its block and parsing
+those lines alone, which is what 'pyppi show', 'pyppi build --only', and
+the package pages of 'pyppi serve' do. A config with include lines, or
+with bytes read_cfg_fast() leaves to the reference parser, is not indexed,
+and neither is a block with a line the fast parser does not handle. A
+config with variant lines is not used through its index either: a block
+ends at a variant line, but the parser would give any release lines
+after it to the package before. The callers then read the config whole,
+as before.
+
+This is free and unencumbered software released into the public domain.
+For more information, please visit <http://unlicense.org/>.
+"""
+import array
+import marshal
+import mmap
+import os
+import pyppi.__main__ as pmain
+import re
+import sys
+
+
+BLOCK_INDEX = ".pyppi-blocks"
+BLOCK_INDEX_MAGIC = b"pyppi-block-index 1\n"
+BLOCK_RX = re.compile(rb"^[ \t]*(package|root|include|variant)[ \t]+"
+                      rb"([!-~]*[!-\"$-~])[ \t]*"
+                      rb"(?:#(?:[ \t][^\n]*|(?=\n)))?$", re.M)
+COLON_KEY_RX = re.compile(rb"^[ \t]*[^\s#]*:", re.M)
+
+
+# -----------------------------------------------------------------------------
+def load(filename):
+    """
+    Return the block_index for config *filename*, making it if the one
+    stored beside the config is missing or out of date, or None if the
+    config cannot be indexed or has include or variant lines
+    """
+    path = os.path.abspath(str(filename))
+    if pmain.cfg_format(path) != 'text':
+        return None
+    stamp = file_stamp(path)
+    ipath = index_path(path)
+    entry = read_index(ipath)
+    if entry is None or (entry['path'], entry['stamp']) != (path, stamp):
+        entry = scan(path)
+        if entry is None:
+            return None
+        write_index(ipath, entry)
+    if entry['include'] or entry['variants']:
+        return None
+    return block_index(path, entry)
+
+
+# -----------------------------------------------------------------------------
+def scan(path):
+    """
+    Return the index entry for config file *path*, or None if it holds
+    bytes the fast parser does not handle, has a key with a colon in it,
+    or sets root twice, which are left for the parser to report
+    """
+    stamp = file_stamp(path)
+    (names, spans) = ([], array.array('q'))
+    (root, variants, include) = (None, False, False)
+    with open(path, 'rb') as rbl:
+        size = os.fstat(rbl.fileno()).st_size
+        if size:
+            with mmap.mmap(rbl.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+                if pmain.CFG_ODD_RX.search(buf) or COLON_KEY_RX.search(buf):
+                    return None
+                for match in BLOCK_RX.finditer(buf):
+                    (key, val) = match.groups()
+                    if names and len(spans) % 2:
+                        spans.append(match.start())
+                    if key == b'package':
+                        names.append(val)
+                        spans.append(match.start())
+                    elif key == b'root':
+                        if root is not None:
+                            return None
+                        root = val.decode()
+                    elif key == b'variant':
+                        variants = True
+                    else:
+                        include = True
+    if len(spans) % 2:
+        spans.append(size)
+    return {'path': path,
+            'stamp': stamp,
+            'root': root,
+            'variants': variants,
+            'include': include,
+            'names': b"\n" + b"".join(_ + b"\n" for _ in names),
+            'spans': spans.tobytes()}
+
+
+# -----------------------------------------------------------------------------
+def file_stamp(path):
+    """
+    Return the identity of file *path*: its device, inode, size, and mtime
+    """
+    info = os.stat(path)
+    return (info.st_dev, info.st_ino, info.st_size, info.st_mtime_ns)
+
+
+# -----------------------------------------------------------------------------
+def index_path(filename):
+    """
+    Return the path of the block index for config file *filename*
+    """
+    (dirname, basename) = os.path.split(filename)
+    return os.path.join(dirname, ".{}{}".format(basename, BLOCK_INDEX))
+
+
+# -----------------------------------------------------------------------------
+def read_index(ipath):
+    """
+    Return the entry stored in index file *ipath*, or None if it is missing
+    or damaged
+    """
+    try:
+        with open(ipath, 'rb') as rbl:
+            if rbl.read(len(BLOCK_INDEX_MAGIC)) != BLOCK_INDEX_MAGIC:
+                return None
+            entry = marshal.loads(rbl.read())
+        if set(entry) != {'path', 'stamp', 'root', 'variants', 'include',
+                          'names', 'spans'}:
+            return None
+    except (OSError, EOFError, ValueError, TypeError):
+        return None
+    return entry
+
+
+# -----------------------------------------------------------------------------
+def write_index(ipath, entry):
+    """
+    Store *entry* in index file *ipath*. Failure to write the index is not
+    an error.
+    """
+    try:
+        pmain.write_atomic(ipath, BLOCK_INDEX_MAGIC + marshal.dumps(entry))
+    except OSError:
+        pass
+
+
+# -----------------------------------------------------------------------------
+def parse_block(data):
+    """
+    Return the releases in *data*, the bytes of one package block, or None
+    if it has a line CFG_LINE_RX does not handle
+    """
+    pkg_l = []
+    for match in pmain.CFG_LINE_RX.finditer(data):
+        (key, val, odd) = match.groups()
+        if odd is not None:
+            return None
+        if key is None:
+            continue
+        if b':' in key:
+            msg = "Syntax error in config file: colons not allowed"
+            raise pmain.pyppi_error(msg)
+        if key == b'version':
+            pkg_l.append(pmain.release(val.decode()))
+        elif key == b'url':
+            pkg_l[-1].url = val.decode()
+        elif key == b'minpy':
+            pkg_l[-1].minpy = sys.intern(val.decode())
+    return pkg_l
+
+
+# -----------------------------------------------------------------------------
+class block_index(object):
+    """
+    The packages of a config file and where each one's block is
+    """
+    def __init__(self, path, entry):
+        """
+        Use index *entry* for config file *path*
+        """
+        import tbx
+        self.path = path
+        self.stamp = entry['stamp']
+        self.root = entry['root'] and tbx.expand(entry['root'])
+        self.blob = entry['names']
+        self.spans = array.array('q')
+        self.spans.frombytes(entry['spans'])
+
+    def names(self):
+        """
+        Return the package names in config order. A package listed twice
+        keeps its first place, as it does when the config is parsed.
+        """
+        return list(dict.fromkeys(self.blob[1:-1].decode().split("\n")
+                                  if len(self.blob) > 1 else []))
+
+    def span(self, pkg):
+        """
+        Return the byte range of the block of *pkg*, or None if the config
+        does not list it. A package listed twice has its last block, as it
+        does when the config is parsed.
+        """
+        where = self.blob.rfind(b"\n" + pkg.encode() + b"\n")
+        if where < 0 or "\n" in pkg:
+            return None
+        which = self.blob.count(b"\n", 0, where)
+        return (self.spans[2 * which], self.spans[2 * which + 1])
+
+    def releases(self, pkg):
+        """
+        Return the releases of *pkg*, or None if the config does not list
+        it. If the config has changed since the index was made, or the
+        block cannot be parsed on its own, the whole config is read.
+        """
+        span = self.span(pkg)
+        if span is None:
+            return None
+        with open(self.path, 'rb') as rbl:
+            info = os.fstat(rbl.fileno())
+            if (info.st_dev, info.st_ino, info.st_size,
+                    info.st_mtime_ns) == self.stamp:
+                rbl.seek(span[0])
+                pkg_l = parse_block(rbl.read(span[1] - span[0]))
+                if pkg_l is not None:
+                    return pkg_l
+        return pmain.read_cfg_file(self.path)['packages'].get(pkg)
+
+    def cfg(self, names):
+        """
+        Return the config with every package listed but only those in
+        *names* given their releases, which is enough to render the root
+        pages and the pages of *names* (see pyppi.store.read_cfg)
+        """
+        rval = {'root': self.root,
+                'packages': {_: [] for _ in self.names()}}
+        for pkg in names:
+            pkg_l = self.releases(pkg)
+            if pkg_l is not None:
+                rval['packages'][pkg] = pkg_l
+        return rval
+
+# ==TAGGABLE==
@@ -0,0 +1,281 @@
+"""
+Read and write configs in formats other than the line format
+
+The structured formats hold the same data read_cfg_file() returns for a
+config in the line format:
+
+    json      {"root": "pypi",
+               "variants": {"py36": {"maxpy": "3.6", "deny": ["old"]}},
+               "packages": {"foo": [{"version": "1.0", "url": "...",
+                                     "minpy": "3.6"}]}}
+
+    toml      root = "pypi"
+              [variants.py36]
+              maxpy = "3.6"
+              [packages]
+              foo = [
+                  {version = "1.0", url = "...", minpy = "3.6"},
+              ]
+
+    marshal   CFG_MARSHAL_MAGIC followed by the config as marshal data, in
+              the form the config cache keeps it (see packed_cfg)
+
+"variants" may be left out, as may "url" and "minpy" and each variant's
+"maxpy", "allow", and "deny". The format of a file is recognized by
+pyppi.__main__.cfg_format(); reading TOML needs python 3.11 (tomllib) or
+the tomli module. Include lines exist only in the line format.
+
+This is free and unencumbered software released into the public domain.
+For more information, please visit <http://unlicense.org/>.
+"""
+import json
+import marshal
+import pyppi.__main__ as pmain
+import re
+import sys
+
+
+FORMATS = ['text', 'json', 'toml', 'marshal']
+RELEASE_FIELDS = {'version', 'url', 'minpy'}
+VARIANT_FIELDS = {'maxpy', 'allow', 'deny'}
+TOML_BARE_KEY = re.compile(r"^[A-Za-z0-9_-]+$")
+
+
+# -----------------------------------------------------------------------------
+def read(filename, fmt, expand=True):
+    """
+    Return the config in *filename*, which is in format *fmt* (one of
+    FORMATS other than 'text'), with root and the variant roots expanded
+    unless *expand* is False (see pmain.cfg_path)
+    """
+    if fmt == 'marshal':
+        with open(filename, 'rb') as rbl:
+            rbl.read(len(pmain.CFG_MARSHAL_MAGIC))
+            try:
+                packed = marshal.loads(rbl.read())
+                cfg = pmain.unpacked_cfg(packed)
+            except (EOFError, ValueError, TypeError, KeyError) as err:
+                raise pmain.pyppi_error("{}: damaged marshal config ({})"
+                                        .format(filename, err))
+        if expand:
+            expand_roots(cfg)
+        return cfg
+    if fmt == 'json':
+        try:
+            with open(filename, 'rb') as rbl:
+                data = json.load(rbl)
+        except ValueError as err:
+            raise pmain.pyppi_error("{}: {}".format(filename, err))
+    elif fmt == 'toml':
+        data = read_toml(filename)
+    else:
+        raise pmain.pyppi_error("unknown config format '{}'".format(fmt))
+    return from_data(data, filename, expand)
+
+
+# -----------------------------------------------------------------------------
+def expand_roots(cfg):
+    """
+    Expand root and the variant roots of *cfg* in place
+    """
+    if cfg['root'] is not None:
+        cfg['root'] = pmain.cfg_path(cfg['root'])
+    if cfg.get('variants'):
+        cfg['variants'] = {pmain.cfg_path(vroot): variant for (vroot, variant)
+                           in cfg['variants'].items()}
+
+
+# -----------------------------------------------------------------------------
+def read_toml(filename):
+    """
+    Return the data in TOML file *filename*
+    """
+    try:
+        import tomllib
+    except ImportError:
+        try:
+            import tomli as tomllib
+        except ImportError:
+            raise pmain.pyppi_error("reading TOML needs python 3.11 or the"
+                                    " tomli module")
+    try:
+        with open(filename, 'rb') as rbl:
+            return tomllib.load(rbl)
+    except tomllib.TOMLDecodeError as err:
+        raise pmain.pyppi_error("{}: {}".format(filename, err))
+
+
+# -----------------------------------------------------------------------------
+def from_data(data, source, expand=True):
+    """
+    Return the config held in *data*, a dict read from the JSON or TOML
+    file *source*, checking its shape as it goes. Roots are expanded
+    unless *expand* is False.
+    """
+    if not isinstance(data, dict):
+        bad_shape(source, "the config", "a table")
+    unknown = set(data) - {'root', 'variants', 'packages'}
+    if unknown:
+        bad_shape(source, "the config", "only root, variants, and packages",
+                  sorted(unknown))
+    root = data.get('root')
+    if root is not None:
+        root = pmain.cfg_path(checked_str(source, "root", root), expand)
+    rval = {'root': root, 'packages': {}}
+
+    variants = data.get('variants', {})
+    if not isinstance(variants, dict):
+        bad_shape(source, "variants", "a table")
+    for (vroot, variant) in variants.items():
+        where = "variant {}".format(vroot)
+        if not isinstance(variant, dict) or set(variant) - VARIANT_FIELDS:
+            bad_shape(source, where, "a table of maxpy, allow, and deny")
+        filt = pmain.new_variant(rval, pmain.cfg_path(vroot, expand))
+        if variant.get('maxpy') is not None:
+            filt['maxpy'] = checked_str(source, where, variant['maxpy'])
+        for key in ('allow', 'deny'):
+            names = variant.get(key, [])
+            if not isinstance(names, list):
+                bad_shape(source, where, "{} as a list".format(key))
+            filt[key] = [checked_str(source, where, _) for _ in names]
+
+    packages = data.get('packages', {})
+    if not isinstance(packages, dict):
+        bad_shape(source, "packages", "a table")
+    for (pkg, pkg_l) in packages.items():
+        if not isinstance(pkg_l, list):
+            bad_shape(source, pkg, "a list of releases")
+        rval['packages'][pkg] = [checked_release(source, pkg, _)
+                                 for _ in pkg_l]
+    return rval
+
+
+# -----------------------------------------------------------------------------
+def checked_release(source, pkg, item):
+    """
+    Return release *item* of package *pkg* in *source* as a release
+    """
+    if not isinstance(item, dict) or 'version' not in item or (
+            set(item) - RELEASE_FIELDS):
+        bad_shape(source, pkg, "releases with a version and optionally a url"
+                  " and minpy")
+    (url, minpy) = (item.get('url'), item.get('minpy'))
+    if url is not None:
+        url = checked_str(source, pkg, url)
+    if minpy is not None:
+        minpy = sys.intern(checked_str(source, pkg, minpy))
+    return pmain.release(checked_str(source, pkg, item['version']), url,
+                         minpy)
+
+
+# -----------------------------------------------------------------------------
+def checked_str(source, where, value):
+    """
+    Return *value*, which should be a string, from *where* in *source*
+    """
+    if not isinstance(value, str):
+        bad_shape(source, where, "strings", value)
+    return value
+
+
+# -----------------------------------------------------------------------------
+def bad_shape(source, where, wanted, found=None):
+    """
+    Raise the error for *where* in *source* not being *wanted*
+    """
+    msg = "{}: {} should hold {}".format(source, where, wanted)
+    if found is not None:
+        msg += ", not {!r}".format(found)
+    raise pmain.pyppi_error(msg)
+
+
+# -----------------------------------------------------------------------------
+def to_data(cfg):
+    """
+    Return *cfg* as plain dicts and lists, as from_data() reads it
+    """
+    rval = {'root': cfg['root']}
+    if cfg.get('variants'):
+        rval['variants'] = {vroot: variant_data(variant) for (vroot, variant)
+                            in cfg['variants'].items()}
+    rval['packages'] = {pkg: [dict(_) for _ in pkg_l]
+                        for (pkg, pkg_l) in cfg['packages'].items()}
+    return rval
+
+
+# -----------------------------------------------------------------------------
+def variant_data(variant):
+    """
+    Return the parts of *variant* that are set
+    """
+    return {key: val for (key, val) in variant.items() if val}
+
+
+# -----------------------------------------------------------------------------
+def write(cfg, fmt):
+    """
+    Return config *cfg* as the bytes of a file in format *fmt*
+    """
+    if fmt == 'text':
+        return "".join(pmain.cfg_lines(cfg)).encode()
+    if fmt == 'marshal':
+        return pmain.CFG_MARSHAL_MAGIC + marshal.dumps(pmain.packed_cfg(cfg))
+    if fmt == 'json':
+        return (json.dumps(to_data(cfg), indent=1) + "\n").encode()
+    if fmt == 'toml':
+        return "".join(toml_lines(to_data(cfg))).encode()
+    raise pmain.pyppi_error("unknown config format '{}'".format(fmt))
+
+
+# -----------------------------------------------------------------------------
+def toml_lines(data):
+    """
+    Generate the lines of the TOML form of config *data* (see to_data)
+    """
+    if data['root'] is not None:
+        yield "root = {}\n".format(toml_str(data['root']))
+    for (vroot, variant) in data.get('variants', {}).items():
+        yield "\n[variants.{}]\n".format(toml_key(vroot))
+        for (key, val) in variant.items():
+            yield "{} = {}\n".format(key, toml_value(val))
+    yield "\n[packages]\n"
+    for (pkg, pkg_l) in data['packages'].items():
+        if not pkg_l:
+            yield "{} = []\n".format(toml_key(pkg))
+            continue
+        yield "{} = [\n".format(toml_key(pkg))
+        for item in pkg_l:
+            yield "    {{{}}},\n".format(", ".join(
+                "{} = {}".format(key, toml_str(val))
+                for (key, val) in item.items()))
+        yield "]\n"
+
+
+# -----------------------------------------------------------------------------
+def toml_key(key):
+    """
+    Return *key* as a TOML key, quoted unless it is a bare key
+    """
+    return key if TOML_BARE_KEY.match(key) else toml_str(key)
+
+
+# -----------------------------------------------------------------------------
+def toml_value(value):
+    """
+    Return string or list of strings *value* as a TOML value
+    """
+    if isinstance(value, list):
+        return "[{}]".format(", ".join(toml_str(_) for _ in value))
+    return toml_str(value)
+
+
+# -----------------------------------------------------------------------------
+def toml_str(value):
+    """
+    Return *value* as a TOML basic string. JSON's string escapes are valid
+    TOML as long as non-ASCII text is left as it is, but DEL, which JSON
+    leaves alone, must be escaped.
+    """
+    return json.dumps(value, ensure_ascii=False).replace("\x7f", "\\u007f")
+
+# ==TAGGABLE==
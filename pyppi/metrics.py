@@ -0,0 +1,221 @@
+"""
+Phase timing, counters, and profiling for pyppi commands
+
+A command decorated with instrumented() runs as usual unless --metrics or
+--profile was given. Then a recorder collects the time spent in each phase
+(each 'with span(name)' block the command passes through, nested as they
+ran) and counters bumped along the way (pages and bytes written, stat
+calls, subprocess time, ...). With --metrics -, a summary goes to stderr;
+with --metrics FILE, the same data is written to FILE as JSON. With
+--profile FILE, the command runs under cProfile and the stats are dumped
+to FILE for pstats.
+
+When no recorder is active, span() hands back a shared do-nothing context
+manager and count() returns at once, so the instrumentation costs a
+function call per use.
+
+This is free and unencumbered software released into the public domain.
+For more information, please visit <http://unlicense.org/>.
+"""
+import functools
+import os
+import sys
+import time
+
+
+_active = None
+
+
+# -----------------------------------------------------------------------------
+class recorder(object):
+    """
+    The spans and counters collected while one command runs
+    """
+    def __init__(self, command):
+        """
+        Start recording for *command*
+        """
+        import threading
+        self.command = command
+        self.origin = time.perf_counter()
+        self.elapsed = None
+        self.depth = 0
+        self.spans = []
+        self.counters = {}
+        self.lock = threading.Lock()
+
+    def report(self):
+        """
+        Return what was recorded as a dict that json can write
+        """
+        return {'command': self.command,
+                'elapsed': self.elapsed,
+                'spans': [dict(_) for _ in self.spans],
+                'counters': dict(sorted(self.counters.items()))}
+
+    def summary(self):
+        """
+        Return what was recorded as text for people
+        """
+        lines = ["pyppi {}: {:.3f}s".format(self.command, self.elapsed)]
+        for item in self.spans:
+            lines.append("  {:9.3f}s  {}{}".format(item['elapsed'],
+                                                   "  " * item['depth'],
+                                                   item['name']))
+        for (name, value) in sorted(self.counters.items()):
+            if isinstance(value, float):
+                value = "{:.3f}".format(value)
+            lines.append("  {:>10}  {}".format(value, name))
+        return "\n".join(lines) + "\n"
+
+
+# -----------------------------------------------------------------------------
+class timed_span(object):
+    """
+    Context manager that records one span in the active recorder
+    """
+    __slots__ = ('rec', 'item', 'subprocess')
+
+    def __init__(self, rec, name, subprocess=False):
+        """
+        Prepare to time *name* for recorder *rec*
+        """
+        self.rec = rec
+        self.item = {'name': name, 'depth': rec.depth}
+        self.subprocess = subprocess
+
+    def __enter__(self):
+        """
+        Note the start of the span
+        """
+        self.rec.spans.append(self.item)
+        self.rec.depth += 1
+        self.item['start'] = time.perf_counter() - self.rec.origin
+        return self
+
+    def __exit__(self, *exc):
+        """
+        Note the end of the span
+        """
+        elapsed = time.perf_counter() - self.rec.origin - self.item['start']
+        self.item['elapsed'] = elapsed
+        self.rec.depth -= 1
+        if self.subprocess:
+            count('subprocesses')
+            count('subprocess_seconds', elapsed)
+        return False
+
+
+# -----------------------------------------------------------------------------
+class null_span(object):
+    """
+    Context manager that does nothing, used when nothing is being recorded
+    """
+    __slots__ = ()
+
+    def __enter__(self):
+        """
+        Do nothing
+        """
+        return self
+
+    def __exit__(self, *exc):
+        """
+        Do nothing
+        """
+        return False
+
+
+NULL_SPAN = null_span()
+
+
+# -----------------------------------------------------------------------------
+def span(name, subprocess=False):
+    """
+    Return a context manager that times the phase *name*. With *subprocess*
+    True, the time is also added to the subprocess counters.
+    """
+    if _active is None:
+        return NULL_SPAN
+    return timed_span(_active, name, subprocess)
+
+
+# -----------------------------------------------------------------------------
+def count(name, amount=1):
+    """
+    Add *amount* to counter *name*. Safe to call from worker threads.
+    """
+    rec = _active
+    if rec is None:
+        return
+    with rec.lock:
+        rec.counters[name] = rec.counters.get(name, 0) + amount
+
+
+# -----------------------------------------------------------------------------
+def instrumented(func):
+    """
+    Decorate command function *func* so that kw['metrics'] and
+    kw['profile'], when set, turn on recording and profiling around it
+    """
+    @functools.wraps(func)
+    def wrapper(**kw):
+        """
+        Run the command, instrumented if it was asked for
+        """
+        if not kw.get('metrics') and not kw.get('profile'):
+            return func(**kw)
+        return run_instrumented(func, kw)
+    return wrapper
+
+
+# -----------------------------------------------------------------------------
+def run_instrumented(func, kw):
+    """
+    Run command function *func* with *kw* while recording metrics and, if
+    asked, profiling it. The results are written even if the command fails.
+    """
+    global _active
+    command = func.__name__.replace("pyppi_", "")
+    _active = rec = recorder(command)
+    (stat, lstat) = (os.stat, os.lstat)
+    os.stat = counted(stat, 'stat_calls')
+    os.lstat = counted(lstat, 'stat_calls')
+    profiler = None
+    if kw.get('profile'):
+        import cProfile
+        profiler = cProfile.Profile()
+    try:
+        if profiler:
+            return profiler.runcall(func, **kw)
+        return func(**kw)
+    finally:
+        (os.stat, os.lstat) = (stat, lstat)
+        _active = None
+        rec.elapsed = time.perf_counter() - rec.origin
+        if profiler:
+            profiler.dump_stats(kw['profile'])
+        if kw.get('metrics') == "-":
+            sys.stderr.write(rec.summary())
+        elif kw.get('metrics'):
+            import json
+            with open(kw['metrics'], 'w') as wbl:
+                json.dump(rec.report(), wbl, indent=1)
+                wbl.write("\n")
+
+
+# -----------------------------------------------------------------------------
+def counted(func, name):
+    """
+    Return a wrapper for *func* that bumps counter *name* on each call
+    """
+    @functools.wraps(func)
+    def wrapper(*args, **kw):
+        """
+        Count the call, then make it
+        """
+        count(name)
+        return func(*args, **kw)
+    return wrapper
+
+# ==TAGGABLE==
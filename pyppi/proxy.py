@@ -0,0 +1,256 @@
+"""
+Fetch and cache pages from an upstream simple index for 'pyppi serve'
+
+With 'pyppi serve --upstream URL', a package the config does not list is
+looked up at URL/<pkg>/ instead of being a 404. Packages in the config
+always win: their upstream pages are never fetched, so a local package
+cannot be shadowed by an upstream one of the same name.
+
+Upstream requests go through a small pool of keep-alive connections and
+ask for gzip. Responses are cached, on disk with --cache-dir or else in
+memory, and kept under --cache-size MB by evicting the least recently used
+first. A cached page younger than --ttl seconds is served as is; an older
+one is revalidated with If-None-Match/If-Modified-Since, and served stale
+if the upstream cannot be reached. Concurrent requests for a page that is
+not cached share one upstream request.
+
+Upstream pages are passed through unchanged, so their file links must be
+absolute urls, as PyPI's are.
+
+This is free and unencumbered software released into the public domain.
+For more information, please visit <http://unlicense.org/>.
+"""
+import asyncio
+import collections
+import gzip
+import hashlib
+import http.client
+import json
+import os
+import pyppi.__main__ as pmain
+import threading
+import time
+from urllib import parse as urlparse
+
+
+ACCEPT = {'html': "application/vnd.pypi.simple.v1+html;q=0.2, text/html;q=0.1",
+          'json': "application/vnd.pypi.simple.v1+json, text/html;q=0.1"}
+USER_AGENT = "pyppi-proxy"
+
+
+# -----------------------------------------------------------------------------
+class upstream(object):
+    """
+    The upstream simple index, with its connection pool and page cache
+    """
+    def __init__(self, url, cache_dir=None, max_bytes=1 << 30, ttl=600.0,
+                 timeout=10.0):
+        """
+        Fetch pages from the simple index at *url*, caching up to
+        *max_bytes* of them in *cache_dir* (or in memory if that is None),
+        and revalidating pages older than *ttl* seconds
+        """
+        self.url = url.rstrip("/") + "/"
+        self.pool = connection_pool(self.url, timeout=timeout)
+        self.cache = page_cache(cache_dir, max_bytes)
+        self.ttl = ttl
+        self.pending = {}
+
+    async def page(self, name, fmt):
+        """
+        Return (status, content type, body) for the *fmt* ('html' or 'json')
+        form of package *name*'s upstream page. Concurrent calls for the
+        same page share one fetch.
+        """
+        key = (name, fmt)
+        if key not in self.pending:
+            loop = asyncio.get_event_loop()
+            self.pending[key] = loop.run_in_executor(None, self.fetch, name,
+                                                     fmt)
+            self.pending[key].add_done_callback(
+                lambda _: self.pending.pop(key, None))
+        return await asyncio.shield(self.pending[key])
+
+    def fetch(self, name, fmt):
+        """
+        Return (status, content type, body) for a page as page() does,
+        from the cache when it is fresh and from the upstream otherwise
+        """
+        key = "{}:{}".format(fmt, name)
+        (meta, body) = self.cache.get(key)
+        if meta and time.time() - meta['fetched'] < self.ttl:
+            return (200, meta['ctype'], body)
+
+        headers = {'Accept': ACCEPT[fmt]}
+        if meta and meta.get('etag'):
+            headers['If-None-Match'] = meta['etag']
+        if meta and meta.get('last_modified'):
+            headers['If-Modified-Since'] = meta['last_modified']
+        try:
+            (status, rhdrs, rbody) = self.pool.get(
+                "{}{}/".format(self.path(), urlparse.quote(name)), headers)
+        except (OSError, http.client.HTTPException):
+            if meta:
+                return (200, meta['ctype'], body)
+            return (502, None, b"upstream unavailable\n")
+        if status == 304 and meta:
+            meta['fetched'] = time.time()
+            self.cache.put(key, meta, body)
+            return (200, meta['ctype'], body)
+        if status != 200:
+            return (404 if status == 404 else 502, None, b"")
+        meta = {'ctype': rhdrs.get('content-type', "text/html"),
+                'etag': rhdrs.get('etag'),
+                'last_modified': rhdrs.get('last-modified'),
+                'fetched': time.time()}
+        self.cache.put(key, meta, rbody)
+        return (200, meta['ctype'], rbody)
+
+    def path(self):
+        """
+        Return the path part of the upstream url
+        """
+        return urlparse.urlsplit(self.url).path
+
+
+# -----------------------------------------------------------------------------
+class connection_pool(object):
+    """
+    Keep-alive HTTP(S) connections to one host, shared by threads
+    """
+    def __init__(self, url, size=8, timeout=10.0):
+        """
+        Connect to the host of *url*, keeping up to *size* idle connections
+        """
+        parts = urlparse.urlsplit(url)
+        self.https = parts.scheme == "https"
+        self.host = parts.hostname
+        self.port = parts.port
+        self.size = size
+        self.timeout = timeout
+        self.idle = []
+        self.lock = threading.Lock()
+
+    def connect(self):
+        """
+        Return a new connection to the host
+        """
+        cls = http.client.HTTPSConnection if self.https else (
+            http.client.HTTPConnection)
+        return cls(self.host, self.port, timeout=self.timeout)
+
+    def get(self, path, headers):
+        """
+        GET *path* with *headers* and return (status, headers, body), with
+        the header names in lower case and the body ungzipped. An idle
+        connection the server has closed is replaced and the request tried
+        once more.
+        """
+        headers = dict(headers, **{'Accept-Encoding': "gzip",
+                                   'User-Agent': USER_AGENT})
+        with self.lock:
+            conn = self.idle.pop() if self.idle else None
+        for reused in ([True] if conn else []) + [False]:
+            conn = conn or self.connect()
+            try:
+                conn.request("GET", path, headers=headers)
+                rsp = conn.getresponse()
+                body = rsp.read()
+                break
+            except (OSError, http.client.HTTPException):
+                conn.close()
+                conn = None
+                if not reused:
+                    raise
+        rhdrs = {k.lower(): v for (k, v) in rsp.getheaders()}
+        if rhdrs.get('content-encoding') == "gzip":
+            body = gzip.decompress(body)
+        with self.lock:
+            if rsp.will_close or len(self.idle) >= self.size:
+                conn.close()
+            else:
+                self.idle.append(conn)
+        return (rsp.status, rhdrs, body)
+
+
+# -----------------------------------------------------------------------------
+class page_cache(object):
+    """
+    Cached upstream pages, evicted least recently used first once they take
+    more than a set number of bytes. On disk, each page is one file holding
+    a line of JSON metadata followed by the body, and the file times keep
+    the order of use across restarts.
+    """
+    def __init__(self, directory=None, max_bytes=1 << 30):
+        """
+        Keep pages in *directory*, or in memory if that is None, up to
+        *max_bytes* in all
+        """
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.sizes = collections.OrderedDict()
+        self.memory = {}
+        self.total = 0
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+            with os.scandir(directory) as entries:
+                found = [(_.stat().st_mtime, _.name, _.stat().st_size)
+                         for _ in entries if not _.name.startswith(".")]
+            for (_, fname, size) in sorted(found):
+                self.sizes[fname] = size
+                self.total += size
+
+    def get(self, key):
+        """
+        Return (metadata, body) for *key*, or (None, None) if it is not
+        cached, and mark it as just used
+        """
+        fname = self.fname(key)
+        with self.lock:
+            if fname not in self.sizes:
+                return (None, None)
+            self.sizes.move_to_end(fname)
+            if not self.directory:
+                return self.memory[fname]
+        path = os.path.join(self.directory, fname)
+        try:
+            with open(path, 'rb') as rbl:
+                meta = json.loads(rbl.readline().decode())
+                body = rbl.read()
+            os.utime(path)
+        except (OSError, ValueError):
+            return (None, None)
+        return (meta, body)
+
+    def put(self, key, meta, body):
+        """
+        Cache *body* with *meta* as *key*, then evict pages until the total
+        size is under the limit
+        """
+        fname = self.fname(key)
+        data = json.dumps(meta).encode() + b"\n" + body
+        if self.directory:
+            pmain.write_atomic(os.path.join(self.directory, fname), data)
+        with self.lock:
+            self.total += len(data) - self.sizes.pop(fname, 0)
+            self.sizes[fname] = len(data)
+            if not self.directory:
+                self.memory[fname] = (dict(meta), body)
+            while self.total > self.max_bytes and len(self.sizes) > 1:
+                (old, size) = self.sizes.popitem(last=False)
+                self.total -= size
+                self.memory.pop(old, None)
+                if self.directory:
+                    try:
+                        os.remove(os.path.join(self.directory, old))
+                    except OSError:
+                        pass
+
+    def fname(self, key):
+        """
+        Return the file name for *key*
+        """
+        return hashlib.sha256(key.encode()).hexdigest()[:32]
+
+# ==TAGGABLE==
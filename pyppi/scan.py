@@ -0,0 +1,177 @@
+"""
+Generate config entries by scanning a directory of distribution files
+
+Wheels (.whl) and sdists (.tar.gz, .zip) are found with os.scandir. The
+Name, Version, and Requires-Python of each are read from the METADATA (or
+PKG-INFO) member of the archive without unpacking anything else; for a
+wheel that is one member read through the zip central directory. What is
+learned about each file is kept in the dist cache beside root, next to
+the sha256 digests the build records there, so a file is only opened again
+when its size, mtime, or inode changes.
+
+This is free and unencumbered software released into the public domain.
+For more information, please visit <http://unlicense.org/>.
+"""
+import email.parser
+import os
+from pyppi import metrics
+import pyppi.__main__ as pmain
+import re
+import sys
+import tarfile
+from urllib import parse as urlparse
+import zipfile
+
+
+DIST_SUFFIXES = ('.whl', '.tar.gz', '.zip')
+WHEEL_METADATA_RX = re.compile(r"^[^/]+\.dist-info/METADATA$")
+SDIST_METADATA_RX = re.compile(r"^[^/]+/PKG-INFO$")
+MINPY_RX = re.compile(r"^\s*>=\s*([0-9][0-9.]*)\s*$")
+
+
+# -----------------------------------------------------------------------------
+def scan_cfg(directory, root, url=None, jobs=1):
+    """
+    Scan *directory* and return a config for *root* listing every
+    distribution found, as read_cfg_file would return it. Release urls are
+    *url* followed by the path of the file under *directory*, or without
+    *url*, root-relative urls that dist_path() maps back to the file.
+    """
+    cache = pmain.read_dist_cache(root)
+    (found, cache) = scan_tree(directory, cache, jobs)
+    pmain.write_dist_cache(root, cache)
+
+    packages = {}
+    for path in sorted(found):
+        facts = found[path]
+        release = pmain.release(facts['version'],
+                                dist_url(path, directory, root, url),
+                                facts.get('minpy'))
+        pkg = pmain.normalize(facts['name'])
+        packages.setdefault(pkg, []).append(release)
+    return {'root': root,
+            'packages': {_: packages[_] for _ in sorted(packages)}}
+
+
+# -----------------------------------------------------------------------------
+def scan_tree(directory, cache, jobs=1):
+    """
+    Find the distributions under *directory* and return a dict mapping the
+    path of each to its facts ('name', 'version', and maybe 'minpy'), along
+    with *cache* updated to hold them. Files whose entries in *cache* are
+    current are not opened; the rest are read by *jobs* threads. Files that
+    cannot be read are reported on stderr and left out. Entries for files
+    under *directory* that are gone are dropped from the cache.
+    """
+    directory = os.path.abspath(directory)
+    found = {}
+    stale = []
+    for (path, info) in walk(directory):
+        stamp = (info.st_size, info.st_mtime_ns, info.st_ino)
+        facts = pmain.cached_facts(cache, path, stamp)
+        if 'name' in facts:
+            found[path] = facts
+        else:
+            stale.append((path, stamp, facts))
+
+    def scan_task(item):
+        """
+        Read the metadata of one file, returning its facts or the exception
+        """
+        (path, stamp, facts) = item
+        metrics.count('files_scanned')
+        try:
+            return dict(facts, **dist_facts(path))
+        except Exception as err:
+            return err
+
+    prefix = os.path.join(directory, "")
+    cache = {path: entry for (path, entry) in cache.items()
+             if path in found or not path.startswith(prefix)}
+    results = pmain.pool_map(scan_task, stale, jobs)
+    for ((path, stamp, _), facts) in zip(stale, results):
+        if isinstance(facts, Exception):
+            print("skipping {}: {}".format(path, facts), file=sys.stderr)
+            continue
+        found[path] = facts
+        cache[path] = stamp + (facts,)
+    return (found, cache)
+
+
+# -----------------------------------------------------------------------------
+def walk(directory):
+    """
+    Generate (path, stat result) for each distribution file under
+    *directory*. Names starting with '.' are skipped and symlinked
+    directories are not followed.
+    """
+    pending = [directory]
+    while pending:
+        with os.scandir(pending.pop()) as entries:
+            for entry in entries:
+                if entry.name.startswith("."):
+                    continue
+                if entry.is_dir(follow_symlinks=False):
+                    pending.append(entry.path)
+                elif entry.name.endswith(DIST_SUFFIXES) and entry.is_file():
+                    yield (entry.path, entry.stat())
+
+
+# -----------------------------------------------------------------------------
+def dist_facts(path):
+    """
+    Return the name, version, and (when Requires-Python is a plain lower
+    bound, the only form the config can express) minpy of distribution
+    *path*
+    """
+    text = dist_metadata(path).decode('utf-8', 'replace')
+    headers = email.parser.HeaderParser().parsestr(text)
+    if not headers['Name'] or not headers['Version']:
+        raise pmain.pyppi_error("no Name or Version in metadata")
+    rval = {'name': headers['Name'].strip(),
+            'version': headers['Version'].strip()}
+    match = MINPY_RX.match(headers['Requires-Python'] or "")
+    if match:
+        rval['minpy'] = match.group(1)
+    return rval
+
+
+# -----------------------------------------------------------------------------
+def dist_metadata(path):
+    """
+    Return the core metadata (METADATA or PKG-INFO) of distribution *path*
+    as bytes
+    """
+    if path.endswith('.tar.gz'):
+        with tarfile.open(path, 'r:gz') as tarball:
+            for member in tarball:
+                if member.isfile() and SDIST_METADATA_RX.match(member.name):
+                    return tarball.extractfile(member).read()
+    else:
+        rx = WHEEL_METADATA_RX if path.endswith('.whl') else SDIST_METADATA_RX
+        with zipfile.ZipFile(path) as archive:
+            for name in archive.namelist():
+                if rx.match(name):
+                    return archive.read(name)
+    raise pmain.pyppi_error("no metadata found")
+
+
+# -----------------------------------------------------------------------------
+def dist_url(path, directory, root, url=None):
+    """
+    Return the url for distribution *path* found under *directory*: *url*
+    followed by its path under *directory*, or failing that, the
+    root-relative url that dist_path() maps to *path* for *root*, or a
+    file:// url if *path* is outside the tree the root-relative urls cover
+    """
+    if url:
+        rel = os.path.relpath(path, os.path.abspath(directory))
+        return "{}/{}".format(url.rstrip("/"),
+                              urlparse.quote(rel.replace(os.sep, "/")))
+    docroot = os.sep if os.path.isabs(root) else os.getcwd()
+    rel = os.path.relpath(path, docroot)
+    if rel.split(os.sep)[0] == os.pardir:
+        return "file://" + urlparse.quote(path)
+    return "/" + urlparse.quote(rel.replace(os.sep, "/"))
+
+# ==TAGGABLE==
@@ -0,0 +1,464 @@
+"""
+Serve the package index straight from the parsed config
+
+The pages are rendered once and kept in memory as bytes, in both the PEP
+503 HTML and PEP 691 JSON forms: all of them when the config is loaded, or
+for a config with a block index (see pyppi.blocks), the root pages then
+and each package's pages the first time they are asked for, in a worker
+thread so other connections are not held up. The form is chosen from the
+Accept header. Each response carries an ETag so clients can revalidate
+with If-None-Match, and is gzipped when the client accepts it.
+The config file, and every fragment it includes, is checked for changes
+every few seconds and the config reloaded when one of them changes. With
+an upstream (see pyppi.proxy), packages the config does not list are
+fetched from it.
+
+This is free and unencumbered software released into the public domain.
+For more information, please visit <http://unlicense.org/>.
+"""
+import asyncio
+import gzip
+import hashlib
+import io
+import os
+import pyppi.__main__ as pmain
+import sys
+import threading
+
+
+HTML = "text/html; charset=utf-8"
+MEDIA_TYPES = {"application/vnd.pypi.simple.v1+json": 'json',
+               "application/vnd.pypi.simple.latest+json": 'json',
+               "application/vnd.pypi.simple.v1+html": 'html',
+               "application/vnd.pypi.simple.latest+html": 'html',
+               "text/html": 'html',
+               "*/*": 'html'}
+REASONS = {200: "OK", 301: "Moved Permanently", 304: "Not Modified",
+           404: "Not Found", 405: "Method Not Allowed", 502: "Bad Gateway"}
+
+
+# -----------------------------------------------------------------------------
+def run(filename, host, port, interval=2.0, cache=True, upstream=None):
+    """
+    Serve the index described by *filename* on *host*:*port* until
+    interrupted, falling back to *upstream* (a pyppi.proxy.upstream) for
+    packages it does not list
+    """
+    srv = index_server(filename, interval=interval, cache=cache,
+                       upstream=upstream)
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    server = loop.run_until_complete(srv.start(host, port))
+    port = server.sockets[0].getsockname()[1]
+    print("serving {} on http://{}:{}/".format(filename, host, port))
+    try:
+        loop.run_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        loop.run_until_complete(srv.stop())
+        loop.close()
+
+
+# -----------------------------------------------------------------------------
+def file_stamp(filename):
+    """
+    Return something that changes when *filename* is modified, or None if
+    it does not exist
+    """
+    try:
+        info = os.stat(str(filename))
+    except FileNotFoundError:
+        return None
+    return (info.st_size, info.st_mtime_ns, info.st_ino)
+
+
+# -----------------------------------------------------------------------------
+class page(object):
+    """
+    One rendered page with its ETag and, once asked for, its gzipped form
+    """
+    __slots__ = ('body', 'etag', 'ctype', '_gzbody')
+
+    def __init__(self, body, ctype=HTML):
+        """
+        Hold *body* (bytes) of content type *ctype*
+        """
+        self.body = body
+        self.etag = '"{}"'.format(hashlib.sha256(body).hexdigest()[:32])
+        self.ctype = ctype
+        self._gzbody = None
+
+    def gzbody(self):
+        """
+        Return the gzipped body, compressing it on first use
+        """
+        if self._gzbody is None:
+            buf = io.BytesIO()
+            with gzip.GzipFile(fileobj=buf, mode='wb', mtime=0) as gzf:
+                gzf.write(self.body)
+            self._gzbody = buf.getvalue()
+        return self._gzbody
+
+
+# -----------------------------------------------------------------------------
+class index_server(object):
+    """
+    An asyncio HTTP server for the index described by a config file
+    """
+    def __init__(self, filename, interval=2.0, cache=True, upstream=None):
+        """
+        Load *filename* and render its pages. The file is checked for
+        changes every *interval* seconds once the server is started.
+        Packages it does not list are looked up in *upstream*, a
+        pyppi.proxy.upstream, if that is set.
+        """
+        self.filename = filename
+        self.interval = interval
+        self.cache = cache
+        self.upstream = upstream
+        self.server = None
+        self.watcher = None
+        self.dists = None
+        self.lock = threading.Lock()
+        self.load()
+
+    def load(self):
+        """
+        Read the config and replace the page table with its pages. Local
+        release files are hashed as they are for a build, starting from the
+        dist cache beside root; the cache is kept in memory, not written, and
+        only metadata files a build has already written are announced. A
+        config with a block index is not read whole: its package pages are
+        left to package_pages to render when they are asked for. With
+        self.cache False, the config is always read whole.
+
+        Since a reload runs in a worker thread while package pages may be
+        rendering in others, the dist cache is only touched while holding
+        self.lock.
+        """
+        from pyppi import blocks
+        stamp = file_stamp(self.filename)
+        index = blocks.load(self.filename) if self.cache else None
+        files = [os.path.abspath(str(self.filename))]
+        if index is not None:
+            if self.dists is None:
+                self.dists = pmain.read_dist_cache(index.root)
+            names = index.names()
+            cfg = {'root': index.root, 'packages': names}
+            self.root = index.root.strip("/")
+            self.pages = package_pages(index, names, render_pages(
+                pmain.PAGE_FORMATS, 1, (cfg,)), self.dists, self.lock)
+            self.stamps = {files[0]: stamp}
+            return
+        files = []
+        (cfg, _) = pmain.load_cfg(self.filename, cache=self.cache,
+                                  files=files)
+        if self.dists is None:
+            self.dists = pmain.read_dist_cache(cfg['root'])
+        with self.lock:
+            dists = dict(self.dists)
+        (pkg_d, dists) = pmain.hash_releases(cfg, dists, metadata=False)
+        with self.lock:
+            self.dists = dists
+        pages = {'': render_pages(pmain.PAGE_FORMATS, 1, (cfg,))}
+        for pkg in pkg_d:
+            pages[pmain.normalize(pkg)] = render_pages(pmain.PAGE_FORMATS, 2,
+                                                       (pkg, pkg_d[pkg]))
+        self.root = cfg['root'].strip("/")
+        self.pages = pages
+        self.stamps = {_: file_stamp(_) for _ in files}
+        self.stamps[os.path.abspath(str(self.filename))] = stamp
+
+    def changed(self):
+        """
+        Return True if the config or a fragment it includes has changed
+        since it was loaded
+        """
+        return any(file_stamp(path) != stamp
+                   for (path, stamp) in self.stamps.items())
+
+    def reload(self):
+        """
+        Load the config again if it has changed. If it cannot be loaded,
+        report why and keep serving the pages we have.
+        """
+        try:
+            if self.changed():
+                self.load()
+                print("reloaded {}".format(self.filename))
+        except Exception as err:
+            print("reload of {} failed: {}".format(self.filename, err),
+                  file=sys.stderr)
+
+    def page_key(self, path):
+        """
+        Return the key of the page for URL *path* in the page table. The
+        root page is at '/' and at '/<root>/' under ''; a package page is
+        at '/<pkg>/' or '/<root>/<pkg>/' under the normalized name.
+        """
+        path = path.strip("/")
+        if path in ("", self.root):
+            return ''
+        return pmain.normalize(path.rpartition("/")[2])
+
+    def lookup(self, path):
+        """
+        Return the forms of the page for URL *path*, or None
+        """
+        return self.pages.get(self.page_key(path))
+
+    async def render(self, target):
+        """
+        Have the page for request *target* rendered, off the event loop,
+        if the page table renders its pages when they are first asked for
+        """
+        pages = self.pages
+        if isinstance(pages, package_pages):
+            await pages.ready(self.page_key(target.partition("?")[0]))
+
+    def respond(self, method, target, headers, fetched=None):
+        """
+        Return (status, headers, body) for a request. *fetched* is the
+        upstream page to send if the config has none for the target.
+        """
+        path = target.partition("?")[0]
+        if method not in ("GET", "HEAD"):
+            return (405, [("Allow", "GET, HEAD")], b"")
+        found = self.lookup(path) or fetched
+        if isinstance(found, tuple):
+            return (found[0], [("Content-Type", "text/plain")], found[1])
+        if found is None:
+            return (404, [("Content-Type", "text/plain")], b"not found\n")
+        if not path.endswith("/"):
+            return (301, [("Location", path + "/")], b"")
+
+        (fmt, ctype) = negotiate(headers.get("accept", ""))
+        found = found[fmt]
+        body = found.body
+        etag = found.etag
+        rhdrs = [("Content-Type", ctype or found.ctype),
+                 ("Vary", "Accept, Accept-Encoding")]
+        if accepts_gzip(headers.get("accept-encoding", "")):
+            body = found.gzbody()
+            etag = etag[:-1] + '-gz"'
+            rhdrs.append(("Content-Encoding", "gzip"))
+        rhdrs.append(("ETag", etag))
+
+        inm = [_.strip() for _ in headers.get("if-none-match", "").split(",")]
+        if etag in inm or "*" in inm:
+            return (304, rhdrs, b"")
+        return (200, rhdrs, body)
+
+    async def handle(self, reader, writer):
+        """
+        Answer the requests arriving on one connection
+        """
+        try:
+            while True:
+                line = await reader.readline()
+                if not line.strip():
+                    break
+                (method, target, proto) = line.decode('latin-1').split()
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if not line.strip():
+                        break
+                    (name, _, value) = line.decode('latin-1').partition(":")
+                    headers[name.strip().lower()] = value.strip()
+
+                await self.render(target)
+                fetched = await self.fetch(method, target, headers)
+                (status, rhdrs, body) = self.respond(method, target, headers,
+                                                     fetched)
+                keep = all([proto == "HTTP/1.1",
+                            headers.get("connection", "").lower() != "close"])
+                head = ["HTTP/1.1 {} {}".format(status, REASONS[status])]
+                head.extend("{}: {}".format(*_) for _ in rhdrs)
+                head.append("Content-Length: {}".format(len(body)))
+                if not keep:
+                    head.append("Connection: close")
+                writer.write(("\r\n".join(head) + "\r\n\r\n").encode())
+                if method != "HEAD":
+                    writer.write(body)
+                await writer.drain()
+                if not keep:
+                    break
+        except (ConnectionError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def fetch(self, method, target, headers):
+        """
+        Return the upstream page for a request the config has no page for,
+        in the form lookup() returns, or (status, body) if the upstream
+        does not have it either. Return None when there is no upstream to
+        ask or nothing to ask it for.
+        """
+        path = target.partition("?")[0].strip("/")
+        name = path.rpartition("/")[2]
+        if not self.upstream or method not in ("GET", "HEAD"):
+            return None
+        if not name or path not in (name, "{}/{}".format(self.root, name)):
+            return None
+        if self.lookup(path) is not None:
+            return None
+        (fmt, _) = negotiate(headers.get("accept", ""))
+        (status, ctype, body) = await self.upstream.page(
+            pmain.normalize(name), fmt)
+        if status != 200:
+            return (status, body or b"not found\n")
+        return {fmt: page(body, ctype)}
+
+    async def watch(self):
+        """
+        Check the config for changes every self.interval seconds
+        """
+        loop = asyncio.get_event_loop()
+        while True:
+            await asyncio.sleep(self.interval)
+            await loop.run_in_executor(None, self.reload)
+
+    async def start(self, host, port):
+        """
+        Start listening on *host*:*port* and watching the config
+        """
+        self.server = await asyncio.start_server(self.handle, host, port)
+        self.watcher = asyncio.ensure_future(self.watch())
+        return self.server
+
+    async def stop(self):
+        """
+        Stop watching the config and close the listening socket
+        """
+        if self.watcher:
+            self.watcher.cancel()
+        if self.server:
+            self.server.close()
+            await self.server.wait_closed()
+
+
+# -----------------------------------------------------------------------------
+class package_pages(object):
+    """
+    The page table of a config read through its block index, which holds
+    the root pages (under '') from the start and renders the pages of a
+    package from its block the first time they are looked up
+    """
+    def __init__(self, index, names, root_pages, dists, lock=None):
+        """
+        Look packages *names* up in block_index *index*, hashing their
+        local release files with dist cache *dists*, which is guarded by
+        *lock*. *root_pages* are the rendered root pages.
+        """
+        self.index = index
+        self.dists = dists
+        self.lock = lock
+        self.names = {pmain.normalize(_): _ for _ in names}
+        self.rendered = {'': root_pages}
+        self.pending = {}
+
+    def __getitem__(self, key):
+        """
+        Return the pages for normalized name *key*, raising KeyError if the
+        config has none
+        """
+        rval = self.get(key)
+        if rval is None:
+            raise KeyError(key)
+        return rval
+
+    def get(self, key):
+        """
+        Return the pages for normalized name *key*, or None if the config
+        has none, rendering them if this is the first time. Reading the
+        block and hashing the release files may take a while, so the
+        server calls ready() first to do that in a worker thread.
+        """
+        if key not in self.rendered:
+            name = self.names.get(key)
+            if name is None:
+                return None
+            pkg_l = self.index.releases(name)
+            if pkg_l is None:
+                return None
+            pkg_l = pmain.hashed_block(self.index.root, name, pkg_l,
+                                       self.dists, metadata=False,
+                                       lock=self.lock)
+            self.rendered[key] = render_pages(pmain.PAGE_FORMATS, 2,
+                                              (name, pkg_l))
+        return self.rendered[key]
+
+    async def ready(self, key):
+        """
+        Render the pages for normalized name *key* in a worker thread if
+        they have not been yet. Concurrent calls for the same pages share
+        one rendering.
+        """
+        if key in self.rendered or key not in self.names:
+            return
+        if key not in self.pending:
+            loop = asyncio.get_event_loop()
+            self.pending[key] = loop.run_in_executor(None, self.get, key)
+            self.pending[key].add_done_callback(
+                lambda _: self.pending.pop(key, None))
+        await asyncio.shield(self.pending[key])
+
+
+# -----------------------------------------------------------------------------
+def render_pages(formats, which, args):
+    """
+    Render the page generator at index *which* of each entry in *formats*
+    (see pmain.PAGE_FORMATS) with *args*, returning a page per format
+    """
+    rval = {}
+    for (fmt, entry) in formats.items():
+        body = "".join(entry[which](*args)).encode()
+        rval[fmt] = page(body, pmain.JSON_TYPE if fmt == 'json' else HTML)
+    return rval
+
+
+# -----------------------------------------------------------------------------
+def negotiate(accept):
+    """
+    Pick the page format for Accept header value *accept*. Return the format
+    and the content type to send, or None to send the format's own.
+    """
+    best = ('html', None, 0.0)
+    for item in accept.split(","):
+        (mtype, _, params) = item.partition(";")
+        mtype = mtype.strip().lower()
+        if mtype not in MEDIA_TYPES:
+            continue
+        qual = 1.0
+        for param in params.split(";"):
+            (name, _, value) = param.partition("=")
+            if name.strip() == "q":
+                try:
+                    qual = float(value)
+                except ValueError:
+                    qual = 0.0
+        if qual > best[2]:
+            fmt = MEDIA_TYPES[mtype]
+            ctype = None
+            if fmt == 'html' and "vnd.pypi" in mtype:
+                ctype = "application/vnd.pypi.simple.v1+html"
+            best = (fmt, ctype, qual)
+    return best[:2]
+
+
+# -----------------------------------------------------------------------------
+def accepts_gzip(accept_encoding):
+    """
+    Return True if the Accept-Encoding value *accept_encoding* allows gzip
+    """
+    for item in accept_encoding.split(","):
+        (coding, _, params) = item.partition(";")
+        if coding.strip().lower() in ("gzip", "*"):
+            return params.replace(" ", "") not in ("q=0", "q=0.0", "q=0.00",
+                                                   "q=0.000")
+    return False
+
+# ==TAGGABLE==
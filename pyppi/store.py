@@ -0,0 +1,226 @@
+"""
+Keep the index in an SQLite database instead of a config file
+
+A store holds the root and every package and release of a config in three
+tables: meta (root, a random id, and a generation number bumped by every
+change), packages, and releases, indexed on package and version. Packages
+and releases keep the order they were added in, which is the order the
+pages list them in, as with a config file.
+
+'pyppi add' and 'pyppi remove' change one package's rows in a single
+transaction. With --build, only that package's pages and the root pages are
+rendered, provided the index was last built from the store as it was just
+before the change; otherwise the whole index is built. 'pyppi build' and
+'pyppi cpush' take a store wherever they take a config file (see
+pyppi.__main__.load_cfg), and 'pyppi import' and 'pyppi export' convert
+between the two.
+
+This is free and unencumbered software released into the public domain.
+For more information, please visit <http://unlicense.org/>.
+"""
+import os
+import pyppi.__main__ as pmain
+import sqlite3
+
+
+SCHEMA = """
+    CREATE TABLE IF NOT EXISTS meta (
+        key TEXT PRIMARY KEY,
+        value TEXT NOT NULL);
+    CREATE TABLE IF NOT EXISTS packages (
+        id INTEGER PRIMARY KEY,
+        name TEXT NOT NULL UNIQUE);
+    CREATE TABLE IF NOT EXISTS releases (
+        id INTEGER PRIMARY KEY,
+        package INTEGER NOT NULL REFERENCES packages (id) ON DELETE CASCADE,
+        version TEXT NOT NULL,
+        url TEXT,
+        minpy TEXT);
+    CREATE INDEX IF NOT EXISTS releases_package
+        ON releases (package, version);
+"""
+
+
+# -----------------------------------------------------------------------------
+def is_store(filename):
+    """
+    Return True if *filename* is an SQLite database
+    """
+    try:
+        with open(str(filename), 'rb') as rbl:
+            return rbl.read(len(pmain.STORE_MAGIC)) == pmain.STORE_MAGIC
+    except OSError:
+        return False
+
+
+# -----------------------------------------------------------------------------
+def connect(filename, create=False):
+    """
+    Open the store in *filename* and return the connection. With *create*,
+    a missing store is created empty; otherwise it is an error. A file that
+    is not a store is always an error.
+    """
+    exists = os.path.exists(str(filename))
+    if not is_store(filename) and (exists or not create):
+        raise pmain.pyppi_error("{} is not a pyppi store".format(filename))
+    db = sqlite3.connect(str(filename))
+    db.execute("PRAGMA foreign_keys = ON")
+    with db:
+        db.executescript(SCHEMA)
+        db.execute("INSERT OR IGNORE INTO meta VALUES ('id', ?)",
+                   (os.urandom(16).hex(),))
+        db.execute("INSERT OR IGNORE INTO meta VALUES ('generation', '0')")
+        db.execute("INSERT OR IGNORE INTO meta VALUES ('root', 'pypi')")
+    return db
+
+
+# -----------------------------------------------------------------------------
+def load(filename):
+    """
+    Return the config held in the store in *filename* and its store_hash()
+    """
+    db = connect(filename)
+    try:
+        return (read_cfg(db), store_hash(db))
+    finally:
+        db.close()
+
+
+# -----------------------------------------------------------------------------
+def store_hash(db):
+    """
+    Return a string that identifies the contents of store *db*, which
+    stands in for the sha256 of a config file in the build manifest
+    """
+    meta = dict(db.execute("SELECT key, value FROM meta"))
+    return pmain.page_hash("{}:{}".format(meta['id'], meta['generation']))
+
+
+# -----------------------------------------------------------------------------
+def changed(db):
+    """
+    Record that the contents of store *db* have changed. Call it inside the
+    transaction that makes the change.
+    """
+    db.execute("UPDATE meta SET value = CAST(value AS INTEGER) + 1"
+               " WHERE key = 'generation'")
+
+
+# -----------------------------------------------------------------------------
+def read_cfg(db, names=None):
+    """
+    Return the config held in store *db*, as read_cfg_file() would return
+    it. With *names*, only the packages named have their releases read; the
+    others are listed with none, which is enough to render the root pages.
+    """
+    cfg = {'root': read_root(db), 'packages': {}}
+    packages = cfg['packages']
+    for (name,) in db.execute("SELECT name FROM packages ORDER BY id"):
+        packages[name] = []
+    if names is None:
+        rows = db.execute("SELECT p.name, r.version, r.url, r.minpy"
+                          " FROM releases r JOIN packages p"
+                          " ON r.package = p.id ORDER BY r.id")
+    else:
+        rows = []
+        for name in names:
+            rows.extend(db.execute("SELECT p.name, r.version, r.url,"
+                                   " r.minpy FROM releases r JOIN packages p"
+                                   " ON r.package = p.id WHERE p.name = ?"
+                                   " ORDER BY r.id", (name,)))
+    for (name, version, url, minpy) in rows:
+        packages[name].append(pmain.release(version, url, minpy))
+    return cfg
+
+
+# -----------------------------------------------------------------------------
+def read_root(db):
+    """
+    Return the root recorded in store *db*
+    """
+    row = db.execute("SELECT value FROM meta WHERE key = 'root'").fetchone()
+    return row[0]
+
+
+# -----------------------------------------------------------------------------
+def import_cfg(db, cfg):
+    """
+    Replace the contents of store *db* with config *cfg*. A store has no
+    variants, so a config with any is refused rather than imported without
+    them.
+    """
+    if cfg.get('variants'):
+        raise pmain.pyppi_error("a store cannot hold variants ({})".format(
+            ", ".join(cfg['variants'])))
+    with db:
+        db.execute("DELETE FROM releases")
+        db.execute("DELETE FROM packages")
+        db.execute("UPDATE meta SET value = ? WHERE key = 'root'",
+                   (cfg['root'],))
+        for (pkg, pkg_l) in cfg['packages'].items():
+            pkgid = db.execute("INSERT INTO packages (name) VALUES (?)",
+                               (pkg,)).lastrowid
+            rows = [(pkgid, _['version'], _.get('url'), _.get('minpy'))
+                    for _ in pkg_l]
+            db.executemany("INSERT INTO releases"
+                           " (package, version, url, minpy)"
+                           " VALUES (?, ?, ?, ?)", rows)
+        changed(db)
+
+
+# -----------------------------------------------------------------------------
+def add_release(db, pkg, version, url=None, minpy=None):
+    """
+    Add *version* of *pkg*, with *url* and *minpy* if given, to store *db*.
+    The package is added if it is new. A version already there is an error.
+    """
+    with db:
+        db.execute("INSERT OR IGNORE INTO packages (name) VALUES (?)", (pkg,))
+        (pkgid,) = db.execute("SELECT id FROM packages WHERE name = ?",
+                              (pkg,)).fetchone()
+        if db.execute("SELECT 1 FROM releases WHERE package = ? AND"
+                      " version = ?", (pkgid, version)).fetchone():
+            raise pmain.pyppi_error("{} {} is already in the store"
+                                    .format(pkg, version))
+        db.execute("INSERT INTO releases (package, version, url, minpy)"
+                   " VALUES (?, ?, ?, ?)", (pkgid, version, url, minpy))
+        changed(db)
+
+
+# -----------------------------------------------------------------------------
+def remove_release(db, pkg, version=None):
+    """
+    Remove *version* of *pkg* from store *db*, or without *version*, the
+    package and all its releases. Removing what is not there is an error.
+    """
+    with db:
+        if version is None:
+            cursor = db.execute("DELETE FROM packages WHERE name = ?", (pkg,))
+        else:
+            cursor = db.execute("DELETE FROM releases WHERE version = ? AND"
+                                " package = (SELECT id FROM packages"
+                                " WHERE name = ?)", (version, pkg))
+        if cursor.rowcount == 0:
+            raise pmain.pyppi_error("{} is not in the store".format(
+                " ".join(_ for _ in (pkg, version) if _)))
+        changed(db)
+
+
+# -----------------------------------------------------------------------------
+def rebuild(filename, db, before, names, kw):
+    """
+    Build the index for store *db* in *filename* after packages *names*
+    changed, as directed by the command line options in *kw*. If the
+    manifest shows the index was built from the store as it was before
+    the change, when its store_hash() was *before*, only the pages of
+    *names* and the root pages are rendered; otherwise everything is.
+    """
+    manifest = pmain.read_manifest(read_root(db))
+    same = pmain.same_options(manifest, **pmain.page_options(kw))
+    if same and manifest['config'] == before:
+        pmain.run_build(filename, read_cfg(db, names), kw, store_hash(db),
+                        changed=set(names))
+    else:
+        pmain.run_build(filename, read_cfg(db), kw, store_hash(db))
+
+# ==TAGGABLE==
@@ -0,0 +1,428 @@
+"""
+Build the index without holding the config in memory: build --stream
+
+The config is read a chunk at a time and each package's pages are rendered
+and written as soon as its block ends, so memory holds one package's
+releases rather than the whole index. Include lines are followed in place.
+What has to outlive a block goes to temporary files instead: the package
+names, in config order, from which the root pages are rendered at the end,
+and the manifest entries, which are sorted on disk (sorted_lines) to write
+the manifest and to find the pages of packages that have left the config
+by merging them against the old manifest, itself read a line at a time.
+
+Only the dist cache, which holds the local release files, stays in memory.
+A page is left alone when the file already there has the same content,
+which takes the place of the old manifest's hashes. The tree and manifest
+are the ones build writes without --stream.
+
+A config in another format, one with variant lines, or one that lists a
+package twice, cannot be streamed.
+
+This is free and unencumbered software released into the public domain.
+For more information, please visit <http://unlicense.org/>.
+"""
+import json
+import os
+from pyppi import metrics
+import pyppi.__main__ as pmain
+import re
+import sys
+
+
+READ_CHUNK = 1 << 20
+LINE_KEYS = {b'root', b'include', b'variant', b'maxpy', b'allow',
+             b'deny'}
+SORT_RUN = 1 << 16
+MANIFEST_PAGE_RX = re.compile(r'^  ("(?:[^"\\]|\\.)*"): "([0-9a-f]*)",?$')
+
+
+# -----------------------------------------------------------------------------
+def run_build(filename, kw):
+    """
+    Build the index for config *filename* as directed by the command line
+    options in *kw*, streaming it as the module docstring describes, and
+    return its root
+    """
+    import tempfile
+    for option in ('staged', 'watch', 'only'):
+        if kw[option]:
+            raise pmain.pyppi_error("--stream and --{} cannot be used"
+                                    " together".format(option))
+    if pmain.cfg_format(filename) != 'text':
+        raise pmain.pyppi_error("--stream reads only configs in the line"
+                                " format")
+    if kw['fsync'] not in pmain.FSYNC_POLICIES:
+        raise pmain.pyppi_error("--fsync must be one of {}"
+                                .format(", ".join(pmain.FSYNC_POLICIES)))
+    options = pmain.page_options(kw)
+    opts = {'quiet': kw['quiet'],
+            'fsync': kw['fsync'],
+            'compress': options['compress']}
+    formats = options['formats']
+    with tempfile.TemporaryDirectory(prefix="pyppi-stream-") as tmpd:
+        with metrics.span("build"):
+            return build(filename, tmpd, formats, opts)
+
+
+# -----------------------------------------------------------------------------
+def build(filename, tmpd, formats, opts):
+    """
+    Write the pages for config *filename* in *formats* (see PAGE_FORMATS),
+    with *opts* for build_page(), keeping what outlives a block in
+    directory *tmpd*. Return the root.
+    """
+    kinds = [pmain.PAGE_FORMATS[_] for _ in formats]
+    digests = {}
+    (top, where, root, dists, old) = (None, None, None, None, None)
+    (included, failed) = (False, {})
+    names = open(os.path.join(tmpd, "names"), 'w')
+    entries = open(os.path.join(tmpd, "entries"), 'w')
+    with names, entries:
+        for (kind, name, value) in cfg_blocks(filename, digests):
+            if kind == 'include':
+                included = True
+                continue
+            if kind == 'root':
+                if top is not None:
+                    raise pmain.pyppi_error("{}: root was already set at {}"
+                                            .format(value, where))
+                (top, where, root) = (name, value, os.path.abspath(name))
+                dists = pmain.read_dist_cache(root)
+                old = disk_digests(root)
+                continue
+            if top is None:
+                raise pmain.pyppi_error("{}: with --stream, root must be set"
+                                        " before the first package"
+                                        .format(filename))
+            names.write(name + "\n")
+            pkg_l = pmain.hashed_block(top, name, value, dists)
+            for (page, _, render) in kinds:
+                relpath = "{}/{}".format(name, page)
+                try:
+                    pages = pmain.build_page(root, relpath, render,
+                                             (name, pkg_l), old, **opts)
+                except Exception as err:
+                    failed[relpath] = err
+                    continue
+                for (entry, digest) in pages.items():
+                    entries.write("{}\t{}\n".format(entry, digest))
+
+        if top is None:
+            raise pmain.pyppi_error("{}: no root is set".format(filename))
+        names.close()
+        check_unique(names.name, tmpd)
+        cfg = {'root': top, 'packages': spilled(names.name)}
+        for (page, render, _) in kinds:
+            pages = pmain.build_page(root, page, render, (cfg,), old, **opts)
+            for (entry, digest) in pages.items():
+                entries.write("{}\t{}\n".format(entry, digest))
+
+    done = os.path.join(tmpd, "manifest")
+    with open(entries.name) as rbl, open(done, 'w') as wbl:
+        wbl.writelines(sorted_lines(rbl, tmpd))
+    with metrics.span("remove pages"):
+        old_pages = (_[0] + "\n" for _ in manifest_pages(root))
+        for relpath in stale_pages(sorted_lines(old_pages, tmpd),
+                                   spilled(done, field=0)):
+            if pmain.page_of(relpath) not in failed:
+                pmain.remove_page(root, relpath, opts['quiet'])
+
+    cfghash = digests[os.path.abspath(filename)]
+    if included:
+        cfghash = pmain.files_hash(digests)
+    with metrics.span("write manifest"):
+        pmain.write_dist_cache(root, dists, opts['fsync'])
+        path = os.path.join(root, pmain.MANIFEST)
+        head = {'config': None if failed else cfghash,
+                'formats': sorted(formats),
+                'compress': sorted(opts['compress'])}
+        pmain.write_atomic(path, manifest_chunks(head, spilled(done)),
+                           opts['fsync'])
+    if failed:
+        msg = "{} page(s) failed:".format(len(failed))
+        for (relpath, err) in failed.items():
+            msg += "\n    {}: {}".format(relpath, err)
+        raise pmain.pyppi_error(msg)
+    return root
+
+
+# -----------------------------------------------------------------------------
+def cfg_blocks(filename, digests, stack=()):
+    """
+    Generate the parts of config *filename* as they are read, following
+    include lines where they stand: ('root', root, "file:line") for a root
+    line, ('include', pattern, "file:line") for an include line, and
+    ('package', name, releases) for each package block as it ends. The
+    sha256 of each file read is stored in *digests* by path. Files already
+    being read (*stack*) may not be included again.
+    """
+    import hashlib
+    import tbx
+    path = os.path.abspath(filename)
+    digest = hashlib.sha256()
+    (pkg, pkg_l) = (None, None)
+    with open(path, 'rb') as rbl:
+        for (lineno, key, val) in cfg_pairs(rbl, digest):
+            if key == b'version':
+                pkg_l.append(pmain.release(val))
+            elif key == b'url':
+                pkg_l[-1].url = val
+            elif key == b'minpy':
+                pkg_l[-1].minpy = sys.intern(val)
+            elif key == b'package':
+                if pkg is not None:
+                    yield ('package', pkg, pkg_l)
+                (pkg, pkg_l) = (val, [])
+            elif key == b'root':
+                yield ('root', tbx.expand(val), "{}:{}".format(path, lineno))
+            elif key == b'include':
+                if pkg is not None:
+                    yield ('package', pkg, pkg_l)
+                (pkg, pkg_l) = (None, None)
+                yield ('include', val, "{}:{}".format(path, lineno))
+                cfg = {'include': [(lineno, val, 0)]}
+                for fragment in pmain.included_files(path, cfg)[0][3]:
+                    if fragment in stack + (path,):
+                        raise pmain.pyppi_error("{}:{}: {} includes itself"
+                                                .format(path, lineno,
+                                                        fragment))
+                    yield from cfg_blocks(fragment, digests, stack + (path,))
+            elif key == b'variant' or key in pmain.VARIANT_KEYS:
+                raise pmain.pyppi_error("{}:{}: variants cannot be built"
+                                        " with --stream".format(path, lineno))
+    if pkg is not None:
+        yield ('package', pkg, pkg_l)
+    digests[path] = digest.hexdigest()
+
+
+# -----------------------------------------------------------------------------
+def cfg_pairs(rbl, digest):
+    """
+    Generate (line number, key as bytes, value) for each key/value line of
+    the config open in binary file *rbl*, reading it a chunk at a time and
+    adding each chunk to hashlib object *digest*. Lines are tokenized by
+    CFG_LINE_RX as read_cfg_fast() does, and any it cannot handle the way
+    read_cfg_reference() does. Line numbers are only counted for the keys
+    in LINE_KEYS, which are the ones errors name; the rest get None.
+    """
+    (rest, lineno) = (b"", 1)
+    while True:
+        chunk = rbl.read(READ_CHUNK)
+        digest.update(chunk)
+        if chunk:
+            buf = rest + chunk
+            cut = buf.rfind(b"\n") + 1
+            (buf, rest) = (buf[:cut], buf[cut:])
+        else:
+            (buf, rest) = (rest, b"")
+        counted = 0
+        for match in pmain.CFG_LINE_RX.finditer(buf):
+            (key, val, odd) = match.groups()
+            if key is None and odd is None:
+                continue
+            if key is None:
+                for (key, val) in reference_pairs(odd):
+                    yield (None, key, val)
+                continue
+            if b':' in key:
+                msg = "Syntax error in config file: colons not allowed"
+                raise pmain.pyppi_error(msg)
+            where = None
+            if key in LINE_KEYS:
+                lineno += buf.count(b"\n", counted, match.start())
+                (counted, where) = (match.start(), lineno)
+            yield (where, key, val.decode())
+        lineno += buf.count(b"\n", counted)
+        if not chunk:
+            return
+
+
+# -----------------------------------------------------------------------------
+def reference_pairs(raw):
+    """
+    Generate the (key, value) pairs read_cfg_reference() finds in *raw*,
+    the bytes of a line CFG_LINE_RX does not handle. A carriage return ends
+    a line there, as it does in text mode.
+    """
+    for line in raw.decode().split("\r"):
+        line = re.sub(r"\s*#\s.*$", "", line)
+        if re.match(r"^\s*$", line):
+            continue
+        (key, val) = line.split()
+        if ':' in key:
+            msg = "Syntax error in config file: colons not allowed"
+            raise pmain.pyppi_error(msg)
+        yield (key.strip().encode(), val.strip())
+
+
+# -----------------------------------------------------------------------------
+def check_unique(filename, tmpd):
+    """
+    Raise pyppi_error if the file of package names *filename* lists one
+    twice
+    """
+    last = None
+    with open(filename) as rbl:
+        for name in sorted_lines(rbl, tmpd):
+            if name == last:
+                raise pmain.pyppi_error("package {} is listed twice, which"
+                                        " --stream cannot build"
+                                        .format(name.strip()))
+            last = name
+
+
+# -----------------------------------------------------------------------------
+def sorted_lines(lines, tmpd, run_size=None):
+    """
+    Generate the str *lines*, each ending in a newline, in sorted order,
+    holding no more than *run_size* (default SORT_RUN) of them in memory.
+    Each run of that many is sorted and written to a file in *tmpd*, and
+    the files are merged.
+    """
+    import heapq
+    import tempfile
+    run_size = run_size or SORT_RUN
+    (runs, batch) = ([], [])
+    try:
+        for line in lines:
+            batch.append(line)
+            if len(batch) >= run_size:
+                batch.sort()
+                runs.append(tempfile.TemporaryFile('w+', dir=tmpd))
+                runs[-1].writelines(batch)
+                batch = []
+        batch.sort()
+        if not runs:
+            yield from batch
+            return
+        runs.append(tempfile.TemporaryFile('w+', dir=tmpd))
+        runs[-1].writelines(batch)
+        batch = []
+        for run in runs:
+            run.seek(0)
+        yield from heapq.merge(*runs)
+    finally:
+        for run in runs:
+            run.close()
+
+
+# -----------------------------------------------------------------------------
+def stale_pages(old, new):
+    """
+    Generate the pages of sorted lines *old* that sorted lines *new* do
+    not have, without the newlines
+    """
+    new = iter(new)
+    current = next(new, None)
+    for line in old:
+        while current is not None and current < line:
+            current = next(new, None)
+        if current != line:
+            yield line.rstrip("\n")
+
+
+# -----------------------------------------------------------------------------
+def manifest_pages(root):
+    """
+    Generate (page, hash) for each page in the manifest under *root*,
+    reading it a line at a time. write_manifest() and manifest_chunks()
+    both put each page on a line of its own; a manifest laid out any other
+    way is read whole.
+    """
+    path = os.path.join(root, pmain.MANIFEST)
+    try:
+        rbl = open(path)
+    except OSError:
+        return
+    with rbl:
+        if rbl.readline() != "{\n":
+            yield from pmain.read_manifest(root)['pages'].items()
+            return
+        for line in rbl:
+            match = MANIFEST_PAGE_RX.match(line)
+            if match:
+                yield (json.loads(match.group(1)), match.group(2))
+
+
+# -----------------------------------------------------------------------------
+def manifest_chunks(head, entries):
+    """
+    Generate the manifest with the keys of *head*, which all sort before
+    "pages", and the (page, hash) pairs *entries*, sorted, exactly as
+    write_manifest() lays it out
+    """
+    text = json.dumps(head, indent=1, sort_keys=True)
+    yield (text[:-2] + ',\n "pages": {').encode()
+    sep = "\n"
+    for (page, digest) in entries:
+        yield '{}  {}: {}'.format(sep, json.dumps(page),
+                                  json.dumps(digest)).encode()
+        sep = ",\n"
+    yield ("}" if sep == "\n" else "\n }").encode()
+    yield b"\n}\n"
+
+
+# -----------------------------------------------------------------------------
+class spilled(object):
+    """
+    The lines of a file, read again each time they are iterated over:
+    stripped of their newlines, as whole lines, or split on tabs
+    """
+    def __init__(self, filename, field=None):
+        """
+        Iterate over the lines of *filename*, each split on tabs into a
+        tuple, or with *field* 0, as whole lines up to the first tab
+        """
+        self.filename = filename
+        self.field = field
+
+    def __iter__(self):
+        """
+        Generate the lines of the file
+        """
+        with open(self.filename) as rbl:
+            for line in rbl:
+                line = line.rstrip("\n")
+                if "\t" not in line:
+                    yield line
+                elif self.field is None:
+                    yield tuple(line.split("\t"))
+                else:
+                    yield line.split("\t")[self.field] + "\n"
+
+
+# -----------------------------------------------------------------------------
+class disk_digests(object):
+    """
+    The hashes of the pages already under a root, read from the files
+    themselves, standing in for the old manifest's pages in build_page()
+    """
+    def __init__(self, root):
+        """
+        Look for pages under *root*
+        """
+        self.root = root
+        self.last = (None, None)
+
+    def get(self, relpath):
+        """
+        Return the sha256 of the page *relpath*, or None if there is none.
+        A compressed sibling that exists is taken to hold the page it is
+        next to as it was before build_page() asked for that page's hash,
+        which it always does first.
+        """
+        (base, ext) = os.path.splitext(relpath)
+        if ext in pmain.COMPRESSORS:
+            if base != self.last[0]:
+                return None
+            if not os.path.exists(os.path.join(self.root, relpath)):
+                return None
+            return self.last[1]
+        try:
+            digest = pmain.file_hash(os.path.join(self.root, relpath))
+        except OSError:
+            digest = None
+        self.last = (relpath, digest)
+        return digest
+
+# ==TAGGABLE==
@@ -0,0 +1,281 @@
+"""
+Keep the index up to date with its config: build --watch and cpush --watch
+
+The config is parsed once and kept in memory. Changes to it, or to any
+fragment it includes, are noticed through inotify on their directories
+(editors often save by writing a new file and renaming it over the old
+one) or, where inotify is not available, by checking their size, mtime,
+and inode every few seconds. The files watched are the ones the last
+parse read. A burst of changes is waited out before anything is done.
+Then the config is parsed again,
+compared with the one in memory package by package, and only the pages of
+the packages whose blocks changed are rendered. With cpush --watch, the
+pages built are committed and pushed at most once per push interval.
+
+This is free and unencumbered software released into the public domain.
+For more information, please visit <http://unlicense.org/>.
+"""
+import os
+from pyppi import metrics
+import pyppi.__main__ as pmain
+import select
+import struct
+import sys
+import time
+
+
+IN_MODIFY = 0x002
+IN_ATTRIB = 0x004
+IN_CLOSE_WRITE = 0x008
+IN_MOVED_FROM = 0x040
+IN_MOVED_TO = 0x080
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_EVENTS = sum([IN_MODIFY, IN_ATTRIB, IN_CLOSE_WRITE, IN_MOVED_FROM,
+                 IN_MOVED_TO, IN_CREATE, IN_DELETE])
+IN_EVENT = struct.Struct("iIII")
+PUSH_RETRY = 30.0
+
+
+# -----------------------------------------------------------------------------
+def run(filename, cfg, kw, push=False, stop=None, files=None):
+    """
+    Rebuild the index whenever *filename*, whose parsed contents are *cfg*,
+    or one of the *files* that were read to get them (see pmain.load_cfg)
+    changes, as directed by the command line options in *kw*, until
+    interrupted or until threading.Event *stop* is set. With *push*, commit
+    and push the pages built every kw['push_interval'] seconds. A commit or
+    push that fails is reported and tried again after PUSH_RETRY seconds,
+    or the push interval if that is longer.
+    """
+    debounce = float(kw['debounce'])
+    push_interval = float(kw['push_interval'] or 0)
+    watcher = file_watcher(files or [filename], float(kw['interval']))
+    (pending, unpushed) = (False, False)
+    next_push = time.monotonic() + push_interval
+    ok = True
+    if not kw['quiet']:
+        print("watching {}".format(filename))
+    try:
+        while stop is None or not stop.is_set():
+            timeout = 0.5 if stop else None
+            if pending:
+                due = max(0, next_push - time.monotonic())
+                timeout = due if timeout is None else min(timeout, due)
+            if watcher.wait(timeout):
+                while watcher.wait(debounce):
+                    pass
+                try:
+                    files = []
+                    cfg = rebuild(filename, cfg, kw, full=not ok,
+                                  files=files)
+                    watcher.watch(files)
+                    ok = True
+                except (pmain.pyppi_error, OSError, ValueError) as err:
+                    print("pyppi: {}".format(err), file=sys.stderr)
+                    ok = False
+                pending = push
+            if pending and time.monotonic() >= next_push:
+                try:
+                    if not pmain.commit_pages(pmain.cfg_roots(cfg), kw['m']):
+                        if unpushed:
+                            pmain.git_push()
+                    (pending, unpushed) = (False, False)
+                    next_push = time.monotonic() + push_interval
+                except (pmain.pyppi_error, OSError) as err:
+                    print("pyppi: {}; trying again".format(err),
+                          file=sys.stderr)
+                    unpushed = True
+                    next_push = time.monotonic() + max(push_interval,
+                                                       PUSH_RETRY)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        watcher.close()
+
+
+# -----------------------------------------------------------------------------
+def rebuild(filename, cfg, kw, full=False, files=None):
+    """
+    Parse *filename* again and build the pages of the packages that differ
+    from *cfg*, or, with *full*, a new root, or new variants, every page.
+    Return the new config, and add the files read to list *files*.
+    """
+    with metrics.span("load config"):
+        (new, cfghash) = pmain.load_cfg(filename, cache=not kw['no_cache'],
+                                        files=files)
+    changed = None
+    trees = (new['root'], new.get('variants'))
+    if not full and trees == (cfg['root'], cfg.get('variants')):
+        changed = changed_packages(cfg, new)
+    if not kw['quiet']:
+        print("{} changed: rebuilding {}".format(
+            filename, "all" if changed is None else
+            "{} package(s)".format(len(changed))))
+    pmain.run_build(filename, new, kw, cfghash, changed=changed)
+    return new
+
+
+# -----------------------------------------------------------------------------
+def changed_packages(old, new):
+    """
+    Return the set of package names whose releases differ between configs
+    *old* and *new*, including those only one of them has
+    """
+    (opkgs, npkgs) = (old['packages'], new['packages'])
+    rval = {_ for _ in npkgs if opkgs.get(_) != npkgs[_]}
+    return rval.union(set(opkgs) - set(npkgs))
+
+
+# -----------------------------------------------------------------------------
+def file_watcher(filenames, interval=2.0):
+    """
+    Return an inotify_watcher for *filenames* if inotify can be used here,
+    or else a poll_watcher that checks them every *interval* seconds
+    """
+    try:
+        return inotify_watcher(filenames)
+    except (OSError, AttributeError):
+        return poll_watcher(filenames, interval)
+
+
+# -----------------------------------------------------------------------------
+def file_stamp(filename):
+    """
+    Return something that changes when *filename* is modified, or None if
+    it does not exist
+    """
+    try:
+        info = os.stat(filename)
+    except FileNotFoundError:
+        return None
+    return (info.st_size, info.st_mtime_ns, info.st_ino)
+
+
+# -----------------------------------------------------------------------------
+class poll_watcher(object):
+    """
+    Notice changes to files by checking their stamps at intervals
+    """
+    def __init__(self, filenames, interval=2.0):
+        """
+        Watch *filenames*, checking them every *interval* seconds
+        """
+        self.interval = interval
+        self.stamps = {}
+        self.watch(filenames)
+
+    def watch(self, filenames):
+        """
+        Watch *filenames* in place of the files watched so far
+        """
+        self.stamps = {_: self.stamps[_] if _ in self.stamps
+                       else file_stamp(_) for _ in filenames}
+
+    def wait(self, timeout=None):
+        """
+        Return True as soon as a file has changed, or False if none has
+        changed within *timeout* seconds (None to wait indefinitely)
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            stamps = {_: file_stamp(_) for _ in self.stamps}
+            if stamps != self.stamps:
+                self.stamps = stamps
+                return True
+            remaining = self.interval
+            if deadline is not None:
+                remaining = min(remaining, deadline - time.monotonic())
+                if remaining <= 0:
+                    return False
+            time.sleep(remaining)
+
+    def close(self):
+        """
+        Nothing to release
+        """
+
+
+# -----------------------------------------------------------------------------
+class inotify_watcher(object):
+    """
+    Notice changes to files through inotify events on their directories
+    """
+    def __init__(self, filenames):
+        """
+        Watch *filenames*. Raise OSError (or AttributeError, if libc has no
+        inotify) when inotify cannot be used.
+        """
+        import ctypes
+        self.libc = ctypes.CDLL(None, use_errno=True)
+        self.fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.dirs = {}
+        self.wanted = set()
+        try:
+            self.watch(filenames)
+        except OSError:
+            os.close(self.fd)
+            raise
+
+    def watch(self, filenames):
+        """
+        Watch *filenames* in place of the files watched so far. A directory
+        stays watched once it has been, and events for files no longer
+        wanted are ignored.
+        """
+        import ctypes
+        wanted = set()
+        for filename in filenames:
+            (dirname, name) = os.path.split(os.path.abspath(filename))
+            if dirname not in self.dirs:
+                wdesc = self.libc.inotify_add_watch(
+                    self.fd, os.fsencode(dirname), IN_EVENTS)
+                if wdesc < 0:
+                    raise OSError(ctypes.get_errno(),
+                                  "inotify_add_watch failed", dirname)
+                self.dirs[dirname] = wdesc
+            wanted.add((self.dirs[dirname], os.fsencode(name)))
+        self.wanted = wanted
+
+    def wait(self, timeout=None):
+        """
+        Return True as soon as a file has changed, or False if none has
+        changed within *timeout* seconds (None to wait indefinitely)
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            remaining = None
+            if deadline is not None:
+                remaining = max(0, deadline - time.monotonic())
+            if not select.select([self.fd], [], [], remaining)[0]:
+                return False
+            if self.wanted & self.names():
+                return True
+
+    def names(self):
+        """
+        Read the pending events and return the (watch descriptor, name)
+        pairs they are about
+        """
+        rval = set()
+        while True:
+            try:
+                data = os.read(self.fd, 1 << 16)
+            except BlockingIOError:
+                return rval
+            offset = 0
+            while offset < len(data):
+                (wdesc, _, _, length) = IN_EVENT.unpack_from(data, offset)
+                offset += IN_EVENT.size
+                rval.add((wdesc, data[offset:offset + length].rstrip(b"\0")))
+                offset += length
+
+    def close(self):
+        """
+        Stop watching
+        """
+        os.close(self.fd)
+
+# ==TAGGABLE==
@@ -2,17 +2,45 @@
 This is free and unencumbered software released into the public domain.
 For more information, please visit <http://unlicense.org/>.
 """
+import asyncio
+import docopt
 import glob
+import gzip
+import hashlib
+import http.client
+import http.server
 from importlib import import_module
 import inspect
+import io
+import json
+import os
 from py.path import local as pypath
+import pstats
+from pyppi import blocks
+from pyppi import metrics
+from pyppi import proxy
+from pyppi import scan
+from pyppi import serve
+from pyppi import stream
 from pyppi import version
+from pyppi import watch
 from pyppi.__main__ import pyppi_error
 import pyppi.__main__ as pmain
 import pytest
 import re
+import subprocess
 import sys
+import tarfile
 import tbx
+import threading
+import time
+import tracemalloc
+import zipfile
+
+
+# Ceiling on the time to import pyppi.__main__ (from source, if there is no
+# byte code), generous enough for a slow machine
+IMPORT_BUDGET_US = 100000
 
 
 # -----------------------------------------------------------------------------
@@ -34,7 +62,9 @@ def test_function_doc():
     """
     pytest.dbgfunc()
 
-    importables = ['pyppi.__main__']
+    importables = ['pyppi.__main__', 'pyppi.blocks', 'pyppi.formats',
+                   'pyppi.metrics', 'pyppi.proxy', 'pyppi.scan', 'pyppi.serve',
+                   'pyppi.store', 'pyppi.stream', 'pyppi.watch']
     importables.extend([tbx.basename(_).replace('.py', '')
                         for _ in glob.glob('tests/*.py')])
 
@@ -147,6 +177,393 @@ def test_read_cfg_extra_root(tmpdir, fx_extra_root):
     assert "root was already set" in str(err.value)
 
 
+# -----------------------------------------------------------------------------
+@pytest.mark.parametrize("fixture, exc, msg", [
+    ("fx_colons", pyppi_error, "colons not allowed"),
+    ("fx_extra_root", pyppi_error, "root was already set"),
+    ("fx_oddities", None, None),
+])
+def test_read_cfg_engines(tmpdir, request, fixture, exc, msg):
+    """
+    The fast parser must return the same struct, or raise the same error, as
+    the reference parser
+    """
+    pytest.dbgfunc()
+    request.getfixturevalue(fixture)
+    cfgfile = tmpdir.join("test.cfg")
+    if exc:
+        for engine in ['fast', 'reference']:
+            with pytest.raises(exc) as err:
+                pmain.read_cfg_file(cfgfile, engine=engine)           # payload
+            assert msg in str(err.value)
+    else:
+        fast = pmain.read_cfg_file(cfgfile, engine='fast')            # payload
+        ref = pmain.read_cfg_file(cfgfile, engine='reference')
+        assert fast == ref
+        assert fast['packages']['foo'] == [{'version': "1.0",
+                                            'url': "http://x/foo#egg=foo"},
+                                           {'version': "1.1",
+                                            'url': "http://x/foo-1.1",
+                                            'minpy': "3.6"}]
+
+
+# -----------------------------------------------------------------------------
+def test_read_cfg_fallback(tmpdir, fx_cfgfile):
+    """
+    Lines the fast parser cannot tokenize send the file to the reference
+    parser, which raises its usual error
+    """
+    pytest.dbgfunc()
+    cfgfile = fx_cfgfile['tstcfg']
+    cfgfile.write("package  foo  bar\n", mode='a')
+    for engine in ['fast', 'reference']:
+        with pytest.raises(ValueError):
+            pmain.read_cfg_file(cfgfile, engine=engine)               # payload
+    with pytest.raises(pyppi_error) as err:
+        pmain.read_cfg_file(cfgfile, engine='nosuch')                 # payload
+    assert "unknown config parser 'nosuch'" in str(err.value)
+
+
+# -----------------------------------------------------------------------------
+def test_release():
+    """
+    A release reads, compares, and converts like the dict it stands for
+    """
+    pytest.dbgfunc()
+    rel = pmain.release("1.0", url="http://x/a")                      # payload
+    assert rel == {'version': "1.0", 'url': "http://x/a"}
+    assert {'version': "1.0", 'url': "http://x/a"} == rel
+    assert rel != pmain.release("1.0")
+    assert dict(rel) == {'version': "1.0", 'url': "http://x/a"}
+    assert 'minpy' not in rel and 'url' in rel and 'sha256' not in rel
+    assert rel.get('minpy', "none") == "none"
+    with pytest.raises(KeyError):
+        rel['minpy']
+    rel['minpy'] = "3.6"
+    assert len(rel) == 3 and rel.items()[2] == ('minpy', "3.6")
+    del rel['url']
+    assert list(rel) == ['version', 'minpy']
+    with pytest.raises(KeyError):
+        rel['sha256'] = "0" * 64
+    assert rel.fields() == ("1.0", None, "3.6")
+
+
+# -----------------------------------------------------------------------------
+@pytest.mark.parametrize("engine", ['fast', 'reference'])
+def test_release_memory(tmpdir, engine):
+    """
+    A parsed config takes well under what the same data took with each
+    release held in a dict
+    """
+    pytest.dbgfunc()
+    cfgfile = tmpdir.join("big.cfg")
+    lines = ["root  pypi", ""]
+    for pdx in range(50):
+        lines.append("package  pkg{}".format(pdx))
+        for vdx in range(40):
+            url = "https://x/pkg{}-1.{}.tar.gz".format(pdx, vdx)
+            lines.extend(["    version  1.{}".format(vdx),
+                          "    url  {}".format(url),
+                          "    minpy  3.{}".format(vdx % 4 + 6)])
+        lines.append("")
+    cfgfile.write("\n".join(lines))
+    pmain.read_cfg_file(cfgfile.strpath, engine=engine)
+    tracemalloc.start()
+    cfg = pmain.read_cfg_file(cfgfile.strpath, engine=engine)        # payload
+    (compact, _) = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    # the dicts get strings of their own, as the parsers used to make them
+    tracemalloc.start()
+    dicts = {pkg: [{'version': "".join(_['version']),
+                    'url': "".join(_['url']),
+                    'minpy': "".join(_['minpy'])} for _ in pkg_l]
+             for (pkg, pkg_l) in cfg['packages'].items()}
+    (loose, _) = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    assert dicts == cfg['packages']
+    assert compact < 0.75 * loose
+
+
+# -----------------------------------------------------------------------------
+def test_load_cfg_cache(tmpdir, fx_cfgfile, monkeypatch):
+    """
+    load_cfg() parses the config once and then serves it from the cache
+    until the file content changes
+    """
+    pytest.dbgfunc()
+    exp = fx_cfgfile
+    cfgfile = exp.pop('tstcfg')
+    cache = tmpdir.join(".test.cfg.pyppi-cache")
+    parsed = []
+
+    def counting_parser(filename):
+        """
+        Count the calls that get past the cache
+        """
+        parsed.append(filename)
+        return pmain.read_cfg_fast(filename)
+
+    monkeypatch.setattr(pmain, 'cfg_engines', {'fast': counting_parser})
+
+    (cfg, digest) = pmain.load_cfg(cfgfile)                           # payload
+    assert (cfg, digest) == (exp, pmain.file_hash(cfgfile))
+    assert cache.isfile()
+    assert pmain.load_cfg(cfgfile) == (exp, digest)                   # payload
+    cfgfile.setmtime(cfgfile.mtime() + 10)
+    assert pmain.load_cfg(cfgfile) == (exp, digest)                   # payload
+    assert len(parsed) == 1
+
+    cfgfile.write("package   more\n", mode='a')
+    (cfg, digest) = pmain.load_cfg(cfgfile)                           # payload
+    assert cfg['packages']['more'] == []
+    assert len(parsed) == 2
+
+    cache.write_binary(cache.read_binary()[:40])
+    assert pmain.load_cfg(cfgfile) == (cfg, digest)                   # payload
+    assert len(parsed) == 3
+    assert pmain.load_cfg(cfgfile, cache=False) == (cfg, digest)      # payload
+    assert len(parsed) == 4
+
+
+# -----------------------------------------------------------------------------
+@pytest.mark.parametrize("engine", ['fast', 'reference'])
+def test_include(tmpdir, fx_fragments, monkeypatch, engine):
+    """
+    include lines merge fragments in where they stand, and a change to one
+    fragment only costs parsing that fragment
+    """
+    pytest.dbgfunc()
+    parsed = []
+
+    def counting_parser(filename):
+        """
+        Count the files that get past their caches
+        """
+        parsed.append(os.path.basename(filename))
+        return pmain.cfg_engines[engine](filename)
+
+    monkeypatch.setattr(pmain, 'CFG_ENGINE', 'counting')
+    monkeypatch.setitem(pmain.cfg_engines, 'counting', counting_parser)
+    top = fx_fragments.join("index.cfg")
+    (cfg, digest) = pmain.load_cfg(top.strpath)                       # payload
+    assert cfg['root'] == "pypi"
+    assert list(cfg['packages']) == ["first", "alpha", "beta", "gamma",
+                                     "last", "single"]
+    assert cfg['packages']['alpha'] == [{'version': "1.0",
+                                         'url': "http://x/alpha-1.0"}]
+    assert 'include' not in cfg
+    assert sorted(parsed) == ["a.cfg", "b.cfg", "index.cfg", "single.cfg"]
+
+    del parsed[:]
+    assert pmain.load_cfg(top.strpath) == (cfg, digest)               # payload
+    assert parsed == []
+
+    fx_fragments.join("team", "b.cfg").write("package  beta\n"
+                                             "    version  2.0\n",
+                                             mode='a')
+    (cfg2, digest2) = pmain.load_cfg(top.strpath)                     # payload
+    assert parsed == ["b.cfg"]
+    assert digest2 != digest
+    assert cfg2['packages']['beta'] == [{'version': "2.0"}]
+
+
+# -----------------------------------------------------------------------------
+def test_include_pool(tmpdir, fx_fragments, monkeypatch):
+    """
+    Fragments parsed by the process pool come out as they do in process
+    """
+    pytest.dbgfunc()
+    top = fx_fragments.join("index.cfg").strpath
+    exp = pmain.load_cfg(top, cache=False)
+    monkeypatch.setattr(pmain, 'FRAGMENT_POOL_BYTES', 0)
+    assert pmain.load_cfg(top, cache=False) == exp                    # payload
+    assert pmain.load_cfg(top) == exp                                 # payload
+    assert pmain.cfg_cache_fresh(fx_fragments.join("team", "a.cfg").strpath)
+
+
+# -----------------------------------------------------------------------------
+@pytest.mark.parametrize("fname, text, msg", [
+    ("team/single.cfg", "package  alpha\n",
+     "{d}/team/single.cfg:2: package alpha was already listed at"
+     " {d}/team/a.cfg:1"),
+    ("team/single.cfg", "root  other\n",
+     "{d}/team/single.cfg:2: root was already set at {d}/index.cfg:1"),
+    ("team/single.cfg", "include  ../index.cfg\n",
+     "{d}/team/single.cfg:2: {d}/index.cfg includes itself"),
+    ("index.cfg", "include  nosuch.cfg\n",
+     "{d}/index.cfg:8: no such file: nosuch.cfg"),
+])
+def test_include_errors(tmpdir, fx_fragments, fname, text, msg):
+    """
+    Duplicate packages, a second root, include loops and missing files are
+    errors that give the file and line
+    """
+    pytest.dbgfunc()
+    fx_fragments.join(fname).write(text, mode='a')
+    with pytest.raises(pyppi_error) as err:
+        pmain.load_cfg(fx_fragments.join("index.cfg").strpath)        # payload
+    assert str(err.value) == msg.format(d=fx_fragments.strpath)
+
+
+# -----------------------------------------------------------------------------
+@pytest.mark.parametrize("engine", ['fast', 'reference'])
+def test_read_cfg_variants(tmpdir, fx_variants, engine):
+    """
+    variant blocks give each extra tree its root and filter
+    """
+    pytest.dbgfunc()
+    cfg = pmain.read_cfg_file(fx_variants.strpath, engine=engine)     # payload
+    assert cfg['variants'] == {
+        "py36": {'maxpy': "3.6", 'allow': [], 'deny': ["Old_Pkg"]},
+        "only": {'maxpy': None, 'allow': ["new", "pinned"], 'deny': []}}
+    assert pmain.cfg_roots(cfg) == ["pypi", "py36", "only"]
+    fx_variants.write("".join(pmain.cfg_lines(cfg)))
+    assert pmain.read_cfg_file(fx_variants.strpath) == cfg
+
+    fx_variants.write("root  pypi\nmaxpy  3.6\n")
+    with pytest.raises(pyppi_error) as err:
+        pmain.read_cfg_file(fx_variants.strpath, engine=engine)       # payload
+    assert "maxpy must follow a variant line" in str(err.value)
+
+
+# -----------------------------------------------------------------------------
+@pytest.mark.parametrize("staged", [False, True])
+def test_build_variants(tmpdir, fx_variants, monkeypatch, staged):
+    """
+    One build writes root and every variant, each filtered, sharing the
+    pages they have in common as hard links
+    """
+    pytest.dbgfunc()
+    argv = ["build", fx_variants.strpath, "-q"] + (["--staged"] * staged)
+    kw = command_kw(argv)
+    (cfg, _) = pmain.load_cfg(fx_variants.strpath)
+    rec = metrics.recorder("build")
+    monkeypatch.setattr(metrics, "_active", rec)
+    with tmpdir.as_cwd():
+        pmain.run_build(fx_variants.strpath, cfg, kw)                 # payload
+        full = tmpdir.join("pypi")
+        py36 = tmpdir.join("py36")
+        only = tmpdir.join("only")
+        assert sorted(_.basename for _ in full.listdir()
+                      if _.isdir()) == ["new", "old_pkg", "pinned"]
+        assert sorted(_.basename for _ in py36.listdir()
+                      if _.isdir()) == ["pinned"]
+        assert sorted(_.basename for _ in only.listdir()
+                      if _.isdir()) == ["new", "pinned"]
+        new = [_.join("new", "index.html") for _ in (full, only)]
+        assert "new-2.0" in new[0].read()
+        assert new[0].stat().ino == new[1].stat().ino
+        assert "/py36/pinned/" in py36.join("index.html").read()
+        pinned = [_.join("pinned", "index.html") for _ in (full, py36, only)]
+        assert len({_.stat().ino for _ in pinned}) == 1
+        assert rec.counters['pages_linked'] == 3
+        assert not pmain.index_out_of_date(fx_variants.strpath, cfg)
+
+        fx_variants.write(fx_variants.read().replace("1.0", "1.1"))
+        (cfg, _) = pmain.load_cfg(fx_variants.strpath)
+        pmain.run_build(fx_variants.strpath, cfg, kw)                 # payload
+        assert len({_.stat().ino for _ in pinned}) == 1
+        assert "pinned-1.1" in pinned[1].read()
+
+
+# -----------------------------------------------------------------------------
+@pytest.mark.parametrize("minpy, maxpy, kept", [
+    ("3.8.0", "3.8", True),
+    ("3.8", "3.8.0", True),
+    ("3.8.1", "3.8", False),
+    ("3.10", "3.8", False),
+    ("3.8", "3.10", True),
+    ("3", "3.0.0", True),
+])
+def test_variant_maxpy(minpy, maxpy, kept):
+    """
+    A variant's maxpy keeps the releases whose minpy is not above it, with
+    versions that differ only by trailing zeros equal
+    """
+    pytest.dbgfunc()
+    variant = {'maxpy': maxpy, 'allow': [], 'deny': []}
+    packages = {'p': [pmain.release("1", "u", minpy)]}
+    cfg = pmain.variant_cfg("v", variant, packages)                   # payload
+    assert ('p' in cfg['packages']) == kept
+
+
+# -----------------------------------------------------------------------------
+@pytest.mark.parametrize("fmt, fname", [
+    ("json", "out.json"),
+    ("toml", "out.toml"),
+    ("marshal", "out.marshal"),
+    ("json", "json-noext"),
+    ("marshal", "marshal-noext"),
+])
+def test_convert(tmpdir, fx_variants, fmt, fname):
+    """
+    convert writes each format so that it reads back, recognized by
+    extension or content, as the same config, and converts back to the
+    same text, with roots as they were written
+    """
+    pytest.dbgfunc()
+    fx_variants.write(fx_variants.read()
+                      .replace("root  pypi", "root  ~/pypi")
+                      .replace("variant  py36", "variant  $HOME/py36"))
+    fx_variants.write("package  z.odd_Name\n"
+                      "package  caf\u00e9\n"
+                      "    version  1\n"
+                      "    url  http://x/\"q\"\n", mode='a')
+    (exp, _) = pmain.load_cfg(fx_variants.strpath, cache=False)
+    (raw, _) = pmain.load_cfg(fx_variants.strpath, cache=False, expand=False)
+    assert exp['root'] == os.path.expanduser("~/pypi")
+    assert (raw['root'], list(raw['variants'])) == ("~/pypi",
+                                                    ["$HOME/py36", "only"])
+    output = tmpdir.join(fname)
+    argv = ["convert", fx_variants.strpath, "-o", output.strpath]
+    if "noext" in fname:
+        argv.extend(["--to", fmt])
+    pmain.pyppi_convert(**command_kw(argv))                          # payload
+    assert pmain.cfg_format(output.strpath) == fmt
+    assert b"~/pypi" in output.read_binary()
+    (cfg, _) = pmain.load_cfg(output.strpath)
+    assert cfg == exp
+    assert list(cfg['packages']) == list(exp['packages'])
+    assert pmain.load_cfg(output.strpath) == (cfg, _)
+
+    back = tmpdir.join("back.cfg")
+    pmain.pyppi_convert(**command_kw(["convert", output.strpath,     # payload
+                                      "-o", back.strpath]))
+    assert back.read() == "".join(pmain.cfg_lines(raw))
+
+
+# -----------------------------------------------------------------------------
+@pytest.mark.parametrize("fname, text, msg", [
+    ("bad.json", '{"root": "pypi", "packages": {"a": [{"url": "u"}]}}',
+     "a should hold releases with a version"),
+    ("bad.json", '{"root": "pypi", "packages": {"a": [{"version": 1}]}}',
+     "a should hold strings, not 1"),
+    ("bad.json", '{"root": "pypi", "extra": 1}',
+     "should hold only root, variants, and packages, not ['extra']"),
+    ("bad.json", '{"root": "pypi",', "Expecting property name"),
+    ("bad.toml", 'root = "pypi"\n[packages]\na = "1.0"\n',
+     "a should hold a list of releases"),
+    ("bad.toml", 'root = pypi\n', "Invalid value"),
+    ("bad.marshal", "pyppi-cfg-marshal 1\n", "damaged marshal config"),
+])
+def test_convert_errors(tmpdir, fname, text, msg):
+    """
+    A structured config of the wrong shape is reported as a pyppi_error
+    naming the file
+    """
+    pytest.dbgfunc()
+    cfgfile = tmpdir.join(fname)
+    cfgfile.write(text)
+    with pytest.raises(pyppi_error) as err:
+        pmain.load_cfg(cfgfile.strpath)                               # payload
+    assert str(err.value).startswith(cfgfile.strpath)
+    assert msg in str(err.value)
+    with pytest.raises(pyppi_error) as err:
+        pmain.pyppi_convert(**command_kw(["convert", cfgfile.strpath,
+                                          "--to", "yaml"]))           # payload
+    assert "--to must be one of text, json, toml, marshal" in str(err.value)
+
+
 # -----------------------------------------------------------------------------
 def test_build_dirs_noroot(tmpdir, fx_cfgfile):
     """
@@ -209,158 +626,1985 @@ def test_build_index_htmls(tmpdir, fx_cfgfile):
 
 
 # -----------------------------------------------------------------------------
-def test_debuggable():
+def test_build_incremental(tmpdir, fx_cfgfile):
     """
-    Verify that all functions have a __doc__
+    A second build only rewrites the pages whose content changed and removes
+    the pages of packages that left the config
     """
     pytest.dbgfunc()
-    rval = ""
-    func_d = dict(inspect.getmembers(sys.modules['test_pyppi'],
-                                     inspect.isfunction))
-    for func in func_d:
-        if func.startswith('test_'):
-            mem_d = dict(inspect.getmembers(func_d[func]))
-            cobj = mem_d['__code__']
-            if 'dbgfunc' not in cobj.co_names:
-                rval += "    {}\n".format(func)
-    assert rval == ""
+    cfg = fx_cfgfile
+    root = pypath(cfg['root'])
+    pmain.build_index_htmls(cfg)
+    root.join("foobar", "index.html").write("untouched")
+    root.join("tbx", "index.html").write("stale")
+
+    cfg['packages']['tbx'][0]['version'] = "0.1.1"
+    del cfg['packages']['dtm']
+    pmain.build_index_htmls(cfg)                                      # payload
+
+    assert root.join("foobar", "index.html").read() == "untouched"
+    assert "tbx-0.1.1" in root.join("tbx", "index.html").read()
+    assert not root.join("dtm").exists()
+    assert "/dtm/" not in root.join("index.html").read()
+    manifest = pmain.read_manifest(root)
+    assert sorted(manifest['pages']) == ["foobar/index.html",
+                                         "index.html",
+                                         "tbx/index.html"]
 
 
 # -----------------------------------------------------------------------------
-def test_version(capsys):
+def test_build_missing_page(tmpdir, fx_cfgfile):
     """
-    Check what the pyppi_version() function returns
+    A page the manifest records but that has gone from disk is written
+    again by the next build, as are its siblings. index_out_of_date only
+    compares the manifest, so it does not stat every page.
     """
     pytest.dbgfunc()
-    kw = {'build': False, 'd': False, 'FILENAME': None, 'version': True}
-    pmain.pyppi_version(**kw)                                         # payload
-    (result, err) = capsys.readouterr()
-    assert "pyppi version" in result
-    assert version._v in result
+    cfg = fx_cfgfile
+    cfgfile = cfg['tstcfg'].strpath
+    root = pypath(cfg['root'])
+    cfghash = pmain.file_hash(cfgfile)
+    options = {'formats': ['html', 'json'], 'compress': ['.gz']}
+    pmain.build_index_htmls(cfg, cfghash=cfghash, **options)
+    assert not pmain.index_out_of_date(cfgfile, cfg, **options)
+    gone = [root.join("tbx", _) for _ in ("index.html", "index.html.gz",
+                                          "index.json")]
+    exp = [_.read_binary() for _ in gone]
+    for page in gone:
+        page.remove()
+    assert not pmain.index_out_of_date(cfgfile, cfg, **options)
+    pmain.build_index_htmls(cfg, cfghash=cfghash, **options)          # payload
+    assert [_.read_binary() for _ in gone] == exp
+    assert not pmain.index_out_of_date(cfgfile, cfg, **options)
+    with pytest.raises(pmain.pyppi_error) as err:
+        pmain.build_index_htmls(cfg, cfghash=cfghash, changed={'tbx'})
+    assert "other --json or --precompress" in str(err.value)
 
 
 # -----------------------------------------------------------------------------
-def test_deployable():
+def test_build_jobs(tmpdir, fx_cfgfile, capsys):
     """
-    Check that 1) no untracked files are hanging out, 2) no staged but
-    uncommitted updates are outstanding, 3) no unstaged, uncommitted changes
-    are outstanding, 4) the most recent git tag matches HEAD, and 5) the most
-    recent git tag matches the current version.
+    A build with a thread pool produces the same tree and manifest as a
+    serial build, and -q keeps it from reporting each file
     """
     pytest.dbgfunc()
-    staged, changed, untracked = tbx.git_status()
-    assert untracked == [], "You have untracked files"
-    assert changed == [], "You have unstaged updates"
-    assert staged == [], "You have updates staged but not committed"
+    cfg = fx_cfgfile
+    pmain.build_index_htmls(cfg, cfghash="x")
+    serial = pypath(cfg['root'])
+    cfg['root'] = tmpdir.join("pool").strpath
+    capsys.readouterr()
+    pmain.build_index_htmls(cfg, cfghash="x", jobs=4, quiet=True)   # payload
+    (out, err) = capsys.readouterr()
+    assert out == ""
+    pool = pypath(cfg['root'])
+    for relpath in ["index.html"] + ["{}/index.html".format(_)
+                                     for _ in cfg['packages']]:
+        sdata = serial.join(relpath).read().replace(serial.strpath, "")
+        pdata = pool.join(relpath).read().replace(pool.strpath, "")
+        assert sdata == pdata
+    manifest = pmain.read_manifest(pool)
+    assert list(manifest['pages']) == list(pmain.read_manifest(serial)
+                                           ['pages'])
+    assert manifest['config'] == "x"
 
-    if tbx.git_current_branch() != 'master':
-        return True
 
-    last_tag = tbx.git_last_tag()
-    msg = "Version ({}) does not match tag ({})".format(version._v,
-                                                        last_tag)
-    assert version._v == last_tag, msg
-    assert tbx.git_hash() == tbx.git_hash(last_tag), "Tag != HEAD"
+# -----------------------------------------------------------------------------
+def test_build_errors(tmpdir, fx_cfgfile):
+    """
+    Pages that cannot be written are reported together after the rest of
+    the pages are written
+    """
+    pytest.dbgfunc()
+    cfg = fx_cfgfile
+    root = pypath(cfg['root'])
+    root.ensure("tbx", "index.html", dir=True)
+    root.ensure("dtm", "index.html", dir=True)
+    with pytest.raises(pyppi_error) as err:
+        pmain.build_index_htmls(cfg, cfghash="x", jobs=2)             # payload
+    assert "2 page(s) failed" in str(err.value)
+    assert "tbx/index.html" in str(err.value)
+    assert "dtm/index.html" in str(err.value)
+    assert root.join("foobar", "index.html").isfile()
+    manifest = pmain.read_manifest(root)
+    assert manifest['config'] is None
+    assert sorted(manifest['pages']) == ["foobar/index.html", "index.html"]
+    with pytest.raises(pyppi_error) as err:
+        pmain.jobs_option("0")                                        # payload
+    assert "--jobs must be a positive integer" in str(err.value)
 
 
 # -----------------------------------------------------------------------------
-@pytest.fixture
-def fx_extra_root(tmpdir):
+def test_page_content(tmpdir, fx_cfgfile):
     """
-    Set up a config file with an extra root line to trigger the exception
+    The streamed pages are byte for byte what the index has always contained
     """
-    lines = ["root            foobar",
-             "",
-             "package         whatever",
-             "    version     0.0.0",
-             "    url         git+https://someplace.com/foobar/foobar/",
-             "",
-             "root            throwthatexception",
-             "",
-             ]
-    tstcfg = tmpdir.join("test.cfg")
-    tstcfg.write("\n".join(lines) + "\n")
+    pytest.dbgfunc()
+    cfg = fx_cfgfile
+    root = pypath(cfg['root'])
+    pmain.build_index_htmls(cfg, quiet=True)                          # payload
+    head = "<!DOCTYPE html>\n<html>\n  <body>\n"
+    tail = "  </body>\n</html>\n"
+    url = "git+https://github.com/tbarron/tbx#egg=tbx-0.1.0"
+    assert root.join("tbx", "index.html").read_binary() == (
+        head + "    <a href=\"{}\" data-requires-python=\"&gt;=3.8.0\">"
+        "tbx-0.1.0</a>\n".format(url) + tail).encode()
+    url = "git+https://github.com/tbarron/dtm#egg=dtm-2.0.0"
+    assert root.join("dtm", "index.html").read_binary() == (
+        head + "    <a href=\"{}\">dtm-2.0.0</a>\n".format(url) + tail
+    ).encode()
+    assert root.join("index.html").read_binary() == (
+        head + "".join("    <a href=\"/{0}/{1}/\">{1}</a>\n".format(root, _)
+                       for _ in ["foobar", "tbx", "dtm"]) + tail).encode()
 
 
 # -----------------------------------------------------------------------------
-def make_test_cfg(tmpdir, colons=False):
+def test_build_json(tmpdir, fx_cfgfile):
     """
-    Set up a config file we can test read_cfg_file on
+    With the json format, each directory gets a PEP 691 index.json that
+    agrees with its index.html, naming each file after its url
     """
-    urlpfx = "git+https://github.com/tbarron"
-    data = {'root': "{}/pypi".format(tmpdir.strpath),
-            'tstcfg': tmpdir.join("test.cfg"),
-            'packages':
-            {'foobar': [{'version': "0.0.0",
-                         'url': "{}/foobar#egg=foobar-0.0.0".format(urlpfx)},
-                        {'version': "0.0.1",
-                         'url': "{}/foobar#egg=foobar-0.0.1".format(urlpfx)},
-                        ],
-             'tbx': [{'version': "0.1.0",
-                      'url': "{}/tbx#egg=tbx-0.1.0".format(urlpfx),
-                      'minpy': "3.8.0"},
-                     ],
-             'dtm': [{'version': "2.0.0",
-                      'url': "{}/dtm#egg=dtm-2.0.0".format(urlpfx)},
-                     ]}
-            }
-    colchr = ":" if colons else ""
-    cfgs = "root{}       {}\n\n".format(colchr, data['root'])
-    pkg_l = data['packages']
-    for pkg in pkg_l:
-        cfgs += "package{}       {}\n".format(colchr, pkg)
-        for rel in pkg_l[pkg]:
-            cfgs += "    version{}   {}\n".format(colchr, rel['version'])
-            cfgs += "    url{}       {}\n".format(colchr, rel['url'])
-            if 'minpy' in rel:
-                cfgs += "    minpy{}     {}\n".format(colchr, rel['minpy'])
-        cfgs += "\n"
+    pytest.dbgfunc()
+    cfg = fx_cfgfile
+    cfg['packages']['Foo_Bar'] = cfg['packages'].pop('foobar')
+    cfg['packages']['dist'] = [
+        {'version': "1.0", 'url': "https://x/d/dist-1.0.tar.gz#md5=0"},
+        {'version': "1.1", 'url': "https://x/d/dist%2B1.1-py3-none-any.whl"},
+        {'version': "1.2", 'url': "https://x/d/"}]
+    root = pypath(cfg['root'])
+    pmain.build_index_htmls(cfg, quiet=True,                          # payload
+                            formats=['html', 'json'])
+    meta = {'api-version': "1.0"}
+    data = json.loads(root.join("index.json").read())
+    assert data == {'meta': meta,
+                    'projects': [{'name': _} for _ in cfg['packages']]}
+    data = json.loads(root.join("tbx", "index.json").read())
+    url = "git+https://github.com/tbarron/tbx#egg=tbx-0.1.0"
+    assert data == {'meta': meta, 'name': "tbx",
+                    'files': [{'filename': "tbx-0.1.0", 'url': url,
+                               'hashes': {}, 'requires-python': ">=3.8.0"}]}
+    data = json.loads(root.join("Foo_Bar", "index.json").read())
+    assert data['name'] == "foo-bar"
+    assert [_['filename'] for _ in data['files']] == ["Foo_Bar-0.0.0",
+                                                      "Foo_Bar-0.0.1"]
+    assert "requires-python" not in data['files'][0]
+    data = json.loads(root.join("dist", "index.json").read())
+    assert [_['filename'] for _ in data['files']] == [
+        "dist-1.0.tar.gz", "dist+1.1-py3-none-any.whl", "dist-1.2"]
+    assert "Foo_Bar/index.json" in pmain.read_manifest(root)['pages']
 
-    data['tstcfg'].write(cfgs)
-    return data
+    pmain.build_index_htmls(cfg, quiet=True)                          # payload
+    assert not root.join("Foo_Bar", "index.json").exists()
+    assert root.join("Foo_Bar", "index.html").exists()
 
 
 # -----------------------------------------------------------------------------
-@pytest.fixture
-def fx_cfgfile(tmpdir):
+def test_build_precompress(tmpdir, fx_cfgfile, capsys):
     """
-    Set up a config file we can test read_cfg_file on
+    With compress, each page gets a gzipped sibling that is rewritten only
+    when the page changes and removed when compress is dropped
     """
-    return make_test_cfg(tmpdir, colons=False)
+    pytest.dbgfunc()
+    cfg = fx_cfgfile
+    root = pypath(cfg['root'])
+    pmain.build_index_htmls(cfg, compress=['.gz'])                    # payload
+    for page in root.visit("index.html"):
+        gzpage = page.dirpath(page.basename + ".gz")
+        assert gzip.decompress(gzpage.read_binary()) == page.read_binary()
+    assert "tbx/index.html.gz" in pmain.read_manifest(root)['pages']
+    assert pmain.index_file(root.strpath, root.join("index.html.gz").strpath)
+
+    cfg['packages']['tbx'][0]['version'] = "0.1.1"
+    capsys.readouterr()
+    pmain.build_index_htmls(cfg, compress=['.gz'])                    # payload
+    written = sorted(_.split(root.strpath)[1]
+                     for _ in capsys.readouterr().out.splitlines())
+    assert written == ["/tbx/index.html", "/tbx/index.html.gz"]
+
+    pmain.build_index_htmls(cfg, quiet=True)                          # payload
+    assert not list(root.visit("*.gz"))
+    assert root.join("tbx", "index.html").exists()
 
 
 # -----------------------------------------------------------------------------
-@pytest.fixture
-def fx_colons(tmpdir):
+@pytest.mark.parametrize("value, exp", [
+    (None, []),
+    ("gz", ['.gz']),
+    (" gz ,", ['.gz']),
+    ("zip", "--precompress codecs are br, gz"),
+])
+def test_codecs_option(value, exp):
     """
-    Set up a config file we can test read_cfg_file on with colons
+    The --precompress value is turned into sibling extensions or rejected
     """
-    return make_test_cfg(tmpdir, colons=True)
+    pytest.dbgfunc()
+    if isinstance(exp, list):
+        assert pmain.codecs_option(value) == exp                      # payload
+    else:
+        with pytest.raises(pmain.pyppi_error) as err:
+            pmain.codecs_option(value)                                # payload
+        assert exp in str(err.value)
 
 
 # -----------------------------------------------------------------------------
-def lglob(*args, dupl_allowed=False):
+def test_build_precompress_br(tmpdir, fx_cfgfile):
     """
-    glob a list of paths and return the results in a single list
+    The br codec writes brotli siblings when the brotli module is present
     """
-    rval = []
-    [rval.extend(y) for y in [glob.glob(x) for x in args]]
-    if not dupl_allowed:
-        rval = list(set(rval))
-    return rval
+    pytest.dbgfunc()
+    brotli = pytest.importorskip("brotli")
+    root = pypath(fx_cfgfile['root'])
+    pmain.build_index_htmls(fx_cfgfile, quiet=True,                   # payload
+                            compress=pmain.codecs_option("gz,br"))
+    page = root.join("tbx", "index.html")
+    brpage = root.join("tbx", "index.html.br")
+    assert brotli.decompress(brpage.read_binary()) == page.read_binary()
 
 
 # -----------------------------------------------------------------------------
-def doc_missing(obj):
+def test_build_hashes(tmpdir, fx_cfgfile, monkeypatch):
     """
-    Check *obj* for a non-empty __doc__ element
+    Releases whose urls name local files get #sha256= fragments, and files
+    are hashed again only when they change. The digests are cached beside
+    root, not in the published tree, and only once there are local files.
     """
-    if any([not hasattr(obj, '__doc__'),
-            obj.__doc__ is None,
-            obj.__doc__.strip() == ""]):
-        return True
-    else:
-        return False
+    pytest.dbgfunc()
+    cfg = fx_cfgfile
+    root = pypath(cfg['root'])
+    cache = pypath(pmain.dist_cache_path(root.strpath))
+    pmain.build_index_htmls(cfg, quiet=True)
+    assert not cache.exists()
+    wheels = tmpdir.ensure_dir("wheels")
+    for name in ["a.whl", "b.whl", "c.whl"]:
+        wheels.join(name).write_binary(name.encode() * 1000)
+    digest = {_.basename: pmain.file_hash(_.strpath) for _ in wheels.listdir()}
+    cfg['packages']['dists'] = [
+        {'version': "1", 'url': "file://" + wheels.join("a.whl").strpath},
+        {'version': "2", 'url': wheels.join("b.whl").strpath + "#egg=d-2"},
+        {'version': "3", 'url': "../../wheels/c.whl"},
+        {'version': "4", 'url': "../../wheels/missing.whl"},
+    ]
+    hashed = []
+
+    def counting_hash(path):
+        hashed.append(os.path.basename(path))
+        return digest[os.path.basename(path)]
+
+    monkeypatch.setattr(pmain, "file_hash", counting_hash)
+    pmain.build_index_htmls(cfg, quiet=True, jobs=2,                  # payload
+                            formats=['html', 'json'])
+    assert sorted(hashed) == ["a.whl", "b.whl", "c.whl"]
+    page = root.join("dists", "index.html").read()
+    assert "a.whl#sha256={}\"".format(digest['a.whl']) in page
+    assert "#egg=d-2&sha256={}\"".format(digest['b.whl']) in page
+    assert "c.whl#sha256={}\"".format(digest['c.whl']) in page
+    assert "\"../../wheels/missing.whl\"" in page
+    files = json.loads(root.join("dists", "index.json").read())['files']
+    assert files[0]['hashes'] == {'sha256': digest['a.whl']}
+    assert files[0]['url'] == cfg['packages']['dists'][0]['url']
+    assert files[3]['hashes'] == {}
 
+    hashed.clear()
+    wheels.join("c.whl").write_binary(b"changed")
+    digest['c.whl'] = "c" * 64
+    pmain.build_index_htmls(cfg, quiet=True)                          # payload
+    assert hashed == ["c.whl"]
+    page = root.join("dists", "index.html").read()
+    assert "c.whl#sha256={}".format("c" * 64) in page
+    assert cache.dirname == root.dirname
+    assert cache.basename == ".{}.pyppi-dists".format(root.basename)
+    assert cache.exists()
+    assert [_ for _ in root.visit() if "pyppi-dists" in _.basename] == []
+
+
+# -----------------------------------------------------------------------------
+@pytest.mark.parametrize("url, root, exp", [
+    ("file:///srv/w/a.whl", "pypi", "/srv/w/a.whl"),
+    ("file://elsewhere/srv/w/a.whl", "pypi", None),
+    ("https://example.com/a.whl", "pypi", None),
+    ("git+https://github.com/tbarron/tbx#egg=tbx", "pypi", None),
+    ("/srv/w/a%20b.whl#egg=a", "/srv/pypi", "/srv/w/a b.whl"),
+    ("/w/a.whl", "pypi", "{cwd}/w/a.whl"),
+    ("../w/a.whl", "/srv/pypi", "/srv/pypi/w/a.whl"),
+])
+def test_dist_path(url, root, exp):
+    """
+    Release urls are mapped to local files the way the index links are
+    """
+    pytest.dbgfunc()
+    if exp:
+        exp = exp.format(cwd=os.getcwd())
+    assert pmain.dist_path(url, root, "pkg") == exp                   # payload
+
+
+# -----------------------------------------------------------------------------
+def test_scan_cfg(tmpdir, fx_wheelhouse, capsys):
+    """
+    scan turns the metadata of the wheels and sdists under a directory into
+    a config that read_cfg_file reads back the same
+    """
+    pytest.dbgfunc()
+    wheels = fx_wheelhouse
+    root = tmpdir.join("pypi").strpath
+    cfg = scan.scan_cfg(wheels.strpath, root)                         # payload
+    err = capsys.readouterr().err
+    assert "skipping {}".format(wheels.join("junk.whl")) in err
+    assert list(cfg['packages']) == ["bar", "foo-bar"]
+    assert cfg['packages']['foo-bar'] == [
+        {'version': "1.0", 'minpy': "3.7",
+         'url': wheels.join("Foo_Bar-1.0-py3-none-any.whl").strpath},
+        {'version': "0.9", 'url': wheels.join("foo-bar-0.9.tar.gz").strpath},
+    ]
+    assert cfg['packages']['bar'] == [
+        {'version': "2.0", 'url': wheels.join("sub", "bar-2.0.zip").strpath},
+    ]
+    cfgfile = tmpdir.join("scanned.cfg")
+    cfgfile.write("".join(pmain.cfg_lines(cfg)))
+    assert pmain.read_cfg_file(cfgfile.strpath) == cfg
+
+    cfg = scan.scan_cfg(wheels.strpath, root,                         # payload
+                        url="https://example.com/w/")
+    assert cfg['packages']['bar'][0]['url'] == ("https://example.com/w/"
+                                                "sub/bar-2.0.zip")
+
+
+# -----------------------------------------------------------------------------
+def test_scan_cache(tmpdir, fx_wheelhouse, monkeypatch):
+    """
+    scan only opens files that are new or changed since the last scan, and
+    a build from the scanned config keeps what the scan learned
+    """
+    pytest.dbgfunc()
+    wheels = fx_wheelhouse
+    wheels.join("junk.whl").remove()
+    root = tmpdir.join("pypi").strpath
+    opened = []
+    dist_facts = scan.dist_facts
+
+    def counting_facts(path):
+        opened.append(os.path.basename(path))
+        return dist_facts(path)
+
+    monkeypatch.setattr(scan, "dist_facts", counting_facts)
+    cfg = scan.scan_cfg(wheels.strpath, root, jobs=2)                 # payload
+    assert len(opened) == 3
+    pmain.build_index_htmls(cfg, quiet=True)
+    digest = pmain.file_hash(wheels.join("foo-bar-0.9.tar.gz").strpath)
+    page = tmpdir.join("pypi", "foo-bar", "index.html").read()
+    assert "foo-bar-0.9.tar.gz#sha256={}".format(digest) in page
+
+    opened.clear()
+    make_dist(wheels.join("sub", "bar-2.0.zip"), "bar", "2.1")
+    wheels.join("foo-bar-0.9.tar.gz").remove()
+    again = scan.scan_cfg(wheels.strpath, root)                       # payload
+    assert opened == ["bar-2.0.zip"]
+    assert again['packages']['bar'][0]['version'] == "2.1"
+    assert len(again['packages']['foo-bar']) == 1
+    cache = pmain.read_dist_cache(root)
+    assert wheels.join("foo-bar-0.9.tar.gz").strpath not in cache
+    assert "sha256" in cache[wheels.join("Foo_Bar-1.0-py3-none-any.whl")
+                             .strpath][3]
+
+
+# -----------------------------------------------------------------------------
+def test_build_metadata(tmpdir, fx_cfgfile, fx_wheelhouse, monkeypatch):
+    """
+    Local wheels get a PEP 658 .metadata file beside them, announced in the
+    anchor and the JSON, and written again only when needed
+    """
+    pytest.dbgfunc()
+    cfg = fx_cfgfile
+    root = pypath(cfg['root'])
+    wheel = fx_wheelhouse.join("Foo_Bar-1.0-py3-none-any.whl")
+    sdist = fx_wheelhouse.join("foo-bar-0.9.tar.gz")
+    junk = fx_wheelhouse.join("junk.whl")
+    cfg['packages']['foo-bar'] = [{'version': "1.0", 'url': wheel.strpath},
+                                  {'version': "0.9", 'url': sdist.strpath},
+                                  {'version': "0.0", 'url': junk.strpath}]
+    written = []
+    core_metadata = pmain.core_metadata
+
+    def counting_metadata(path):
+        written.append(os.path.basename(path))
+        return core_metadata(path)
+
+    monkeypatch.setattr(pmain, "core_metadata", counting_metadata)
+    pmain.build_index_htmls(cfg, quiet=True,                          # payload
+                            formats=['html', 'json'])
+    assert sorted(written) == ["Foo_Bar-1.0-py3-none-any.whl", "junk.whl"]
+    meta = wheel.dirpath(wheel.basename + ".metadata").read_binary()
+    assert meta.startswith(b"Metadata-Version: 2.1\nName: Foo_Bar\n")
+    digest = hashlib.sha256(meta).hexdigest()
+    page = root.join("foo-bar", "index.html").read()
+    assert ("any.whl#sha256={0}\" data-dist-info-metadata=\"sha256={1}\""
+            " data-core-metadata=\"sha256={1}\">".format(
+                pmain.file_hash(wheel.strpath), digest)) in page
+    assert page.count("metadata=") == 2
+    assert not sdist.dirpath(sdist.basename + ".metadata").exists()
+    files = json.loads(root.join("foo-bar", "index.json").read())['files']
+    assert files[0]['core-metadata'] == {'sha256': digest}
+    assert files[0]['dist-info-metadata'] == {'sha256': digest}
+    assert "core-metadata" not in files[1]
+
+    written.clear()
+    pmain.build_index_htmls(cfg, quiet=True)                          # payload
+    assert written == []
+    sidecar = fx_wheelhouse.join(wheel.basename + ".metadata")
+    sidecar.remove()
+    pmain.build_index_htmls(cfg, quiet=True)                          # payload
+    assert written == [wheel.basename]
+    assert sidecar.read_binary() == meta
+
+
+# -----------------------------------------------------------------------------
+def test_page_memory(tmpdir):
+    """
+    Writing a page holds no more than a small part of it in memory at once
+    """
+    pytest.dbgfunc()
+    pkg_l = [{'version': "1.{}".format(_),
+              'url': "https://files.example.com/big-1.{0}.tar.gz"
+                     "#egg=big-1.{0}".format(_),
+              'minpy': "3.6"}
+             for _ in range(20000)]
+    root = tmpdir.join("pypi")
+    tracemalloc.start()
+    pmain.build_page(root, "big/index.html", pmain.package_chunks,
+                     ("big", pkg_l), None, quiet=True)                # payload
+    (_, peak) = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    size = root.join("big", "index.html").size()
+    assert size > 2000000
+    assert peak < size / 10
+
+
+# -----------------------------------------------------------------------------
+def test_build_stream(tmpdir, fx_fragments, monkeypatch):
+    """
+    build --stream writes the tree and manifest a build without it would,
+    leaves pages alone when they have not changed, and removes the pages of
+    packages that have left the config
+    """
+    pytest.dbgfunc()
+    top = fx_fragments.join("index.cfg")
+    team_b = fx_fragments.join("team", "b.cfg")
+    for cfgfile in (top, team_b):
+        cfgfile.write(re.sub(r"(version  (\S+)\n)",
+                             r"\1    url  http://x/\2\n", cfgfile.read()))
+    dist = fx_fragments.join("local-1.0.tar.gz")
+    dist.write("local release")
+    top.write("package  local\n"
+              "    version  1.0\n"
+              "    url  file://{}\n".format(dist.strpath), mode='a')
+    kw = command_kw(["build", top.strpath, "-q", "--json",
+                     "--precompress", "gz", "--stream"])
+    pypi = fx_fragments.join("pypi")
+    with fx_fragments.as_cwd():
+        (cfg, cfghash) = pmain.load_cfg(top.strpath)
+        pmain.run_build(top.strpath, cfg, kw, cfghash)
+        exp = tree_content(pypi)
+        assert hashlib.sha256(b"local release").hexdigest() in (
+            pypi.join("local", "index.html").read())
+        pypi.remove()
+        assert stream.run_build(top.strpath, kw) == pypi.strpath  # payload
+        assert tree_content(pypi) == exp
+
+        rec = metrics.recorder("build")
+        monkeypatch.setattr(metrics, "_active", rec)
+        stream.run_build(top.strpath, kw)                             # payload
+        assert rec.counters.get('pages_written', 0) == 0
+
+        top.write(top.read().replace("package  last\n", ""))
+        team_b.write("    version  3.1\n    url  http://x/3.1\n", mode='a')
+        stream.run_build(top.strpath, kw)                             # payload
+        assert not pypi.join("last").exists()
+        assert "gamma-3.1" in pypi.join("gamma", "index.html").read()
+        exp = (tree_content(pypi), pmain.read_dist_cache(pypi.strpath))
+        (cfg, cfghash) = pmain.load_cfg(top.strpath)
+        assert not pmain.index_out_of_date(top.strpath, cfg, cfghash,
+                                           **pmain.page_options(kw))
+        pypi.remove()
+        pmain.run_build(top.strpath, cfg, kw, cfghash)
+        assert (tree_content(pypi),
+                pmain.read_dist_cache(pypi.strpath)) == exp
+
+
+# -----------------------------------------------------------------------------
+@pytest.mark.parametrize("args, text, msg", [
+    (["--staged"], "", "--stream and --staged cannot be used together"),
+    (["--watch"], "", "--stream and --watch cannot be used together"),
+    ([], "package  first\n", "package first is listed twice"),
+    ([], "variant  py36\n", "index.cfg:8: variants cannot be built"),
+    ([], "root  other\n", "index.cfg:8: root was already set at"),
+])
+def test_build_stream_errors(tmpdir, fx_fragments, args, text, msg):
+    """
+    What --stream cannot build is reported before or while it builds
+    """
+    pytest.dbgfunc()
+    top = fx_fragments.join("index.cfg")
+    top.write(text, mode='a')
+    kw = command_kw(["build", top.strpath, "-q", "--stream"] + args)
+    with fx_fragments.as_cwd():
+        with pytest.raises(pyppi_error) as err:
+            stream.run_build(top.strpath, kw)                         # payload
+    assert msg in str(err.value)
+
+
+# -----------------------------------------------------------------------------
+def test_stream_memory(tmpdir):
+    """
+    Streaming a config of a million packages takes a small, fixed amount
+    of memory, where parsing it whole takes hundreds of megabytes. Pages
+    are not written here (test_page_memory covers what one page takes),
+    but each gets a manifest entry with a full digest, so the entries are
+    spilled, sorted, and merged against an old manifest whose pages are
+    all stale, as in a real build. The build runs in a process of its own
+    so its peak RSS is its own.
+    """
+    pytest.dbgfunc()
+    cfgfile = tmpdir.join("million.cfg")
+    with open(cfgfile.strpath, 'w') as wbl:
+        wbl.write("root  pypi\n")
+        wbl.writelines("package  pkg{0}\n    version  1.{0}\n".format(_)
+                       for _ in range(1000000))
+    manifest = tmpdir.ensure_dir("pypi").join(pmain.MANIFEST)
+    head = {'compress': [], 'config': "x", 'formats': ["html"]}
+    gone = (("gone{:06d}/index.html".format(_), "f" * 64)
+            for _ in range(200000))
+    manifest.write_binary(b"".join(stream.manifest_chunks(head, gone)))
+    code = ("import resource, sys, tempfile\n"
+            "import pyppi.__main__ as pmain\n"
+            "from pyppi import stream\n"
+            "(pages, removed) = ([], [])\n"
+            "def build_page(root, relpath, *args, **kw):\n"
+            "    pages.append(1)\n"
+            "    return {relpath: '0' * 64}\n"
+            "pmain.build_page = build_page\n"
+            "pmain.remove_page = lambda *args: removed.append(1)\n"
+            "before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss\n"
+            "with tempfile.TemporaryDirectory() as tmpd:\n"
+            "    stream.build(sys.argv[1], tmpd, ['html'],\n"
+            "                 {'quiet': True, 'fsync': 'none',\n"
+            "                  'compress': ()})\n"
+            "after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss\n"
+            "print(len(pages), len(removed), after - before)\n")
+    with tmpdir.as_cwd():
+        result = subprocess.run([sys.executable, "-c", code,
+                                 cfgfile.strpath], check=True,
+                                stdout=subprocess.PIPE,
+                                universal_newlines=True)          # payload
+    (pages, removed, growth_kb) = [int(_) for _ in result.stdout.split()]
+    assert pages == 1000001
+    assert removed == 200000
+    assert growth_kb < 32 * 1024
+    with open(manifest.strpath) as rbl:
+        entries = [_ for _ in rbl if _.endswith('"{}",\n'.format("0" * 64))]
+    assert len(entries) == 1000000
+    assert entries[0] == '  "index.html": "{}",\n'.format("0" * 64)
+
+
+# -----------------------------------------------------------------------------
+def test_block_index(tmpdir, fx_cfgfile, monkeypatch):
+    """
+    The block index finds each package's releases as the parser does, is
+    kept beside the config, and is made again when the config changes
+    """
+    pytest.dbgfunc()
+    cfgfile = fx_cfgfile['tstcfg']
+    index = blocks.load(cfgfile)                                      # payload
+    assert index.names() == ["foobar", "tbx", "dtm"]
+    assert index.root == fx_cfgfile['root']
+    for (pkg, pkg_l) in fx_cfgfile['packages'].items():
+        assert index.releases(pkg) == pkg_l                           # payload
+    assert index.releases("nosuch") is None
+    assert tmpdir.join(".test.cfg.pyppi-blocks").isfile()
+
+    def no_scan(path):
+        """
+        Fail if the config is scanned again
+        """
+        pytest.fail("the stored index should have been used")
+
+    with monkeypatch.context() as mpc:
+        mpc.setattr(blocks, 'scan', no_scan)
+        assert blocks.load(cfgfile).names() == index.names()          # payload
+
+    cfgfile.write("package  tbx\n"
+                  "    version  0.2.0   # listed again\n", mode='a')
+    index = blocks.load(cfgfile)                                      # payload
+    assert index.names() == ["foobar", "tbx", "dtm"]
+    assert index.releases("tbx") == [{'version': "0.2.0"}]
+    assert index.cfg(["tbx"]) == {'root': fx_cfgfile['root'],
+                                  'packages': {'foobar': [],
+                                               'tbx': [{'version': "0.2.0"}],
+                                               'dtm': []}}
+
+    cfgfile.write("include  other.cfg\n", mode='a')
+    assert blocks.load(cfgfile) is None                               # payload
+
+
+# -----------------------------------------------------------------------------
+@pytest.mark.parametrize("text", ["", "    version  0.0.2 extra\n"])
+def test_show(tmpdir, fx_cfgfile, capsys, text):
+    """
+    'pyppi show' writes a package's block as config lines, reading the
+    whole config when the block cannot be parsed alone
+    """
+    pytest.dbgfunc()
+    cfgfile = fx_cfgfile['tstcfg']
+    cfgfile.write(cfgfile.read().replace("package       tbx\n",
+                                         text + "package       tbx\n"))
+    argv = ["show", cfgfile.strpath, "tbx"]
+    pmain.pyppi_show(**command_kw(argv))                              # payload
+    (out, _) = capsys.readouterr()
+    assert out == "".join(pmain.package_lines(
+        "tbx", fx_cfgfile['packages']['tbx']))
+    argv = ["show", cfgfile.strpath, "foobar"]
+    if text:
+        with pytest.raises(ValueError):
+            pmain.pyppi_show(**command_kw(argv))                      # payload
+    with pytest.raises(pyppi_error) as err:
+        pmain.pyppi_show(**command_kw(["show", cfgfile.strpath,
+                                       "nosuch"]))                    # payload
+    assert str(err.value) == "nosuch is not in {}".format(cfgfile.strpath)
+
+
+# -----------------------------------------------------------------------------
+def test_show_variant(tmpdir, capsys):
+    """
+    A config with variant lines is read whole by show and serve, so a
+    release line after a variant line goes to the package the parser gives
+    it to, not to nothing
+    """
+    pytest.dbgfunc()
+    cfgfile = tmpdir.join("variant.cfg")
+    cfgfile.write("root  {}\n"
+                  "package  a\n"
+                  "    version  1\n"
+                  "    url  http://x/a-1\n"
+                  "package  b\n"
+                  "variant  v\n"
+                  "    version  2\n"
+                  "    url  http://x/b-2\n".format(tmpdir.join("pypi")))
+    exp = pmain.read_cfg_file(cfgfile.strpath)['packages']['b']
+    assert exp == [{'version': "2", 'url': "http://x/b-2"}]
+    assert blocks.load(cfgfile) is None                               # payload
+    pmain.pyppi_show(**command_kw(["show", cfgfile.strpath, "b"]))    # payload
+    (out, _) = capsys.readouterr()
+    assert out == "".join(pmain.package_lines("b", exp))
+    srv = serve.index_server(cfgfile.strpath)
+    for (srv, conn) in running(srv):
+        (status, _, body) = http_get(conn, "/b/")                     # payload
+        assert (status, b"b-2" in body) == (200, True)
+
+
+# -----------------------------------------------------------------------------
+def test_build_only(tmpdir, fx_cfgfile, monkeypatch):
+    """
+    build --only renders one package's pages and the root pages, which link
+    only the packages that have pages, and leaves the next full build to
+    check the rest
+    """
+    pytest.dbgfunc()
+    cfgfile = fx_cfgfile['tstcfg']
+    root = pypath(fx_cfgfile['root'])
+    kw = command_kw(["build", cfgfile.strpath, "-q"])
+    (cfg, cfghash) = pmain.load_cfg(cfgfile.strpath)
+    pmain.run_build(cfgfile.strpath, cfg, kw, cfghash)
+    cfgfile.write(cfgfile.read().replace("0.1.0", "0.1.1")
+                  .replace("2.0.0", "2.0.1"))
+    cfgfile.write("package  newpkg\n"
+                  "    version  1.0\n"
+                  "    url  http://x/newpkg-1.0\n", mode='a')
+    monkeypatch.setattr(pmain, 'read_cfg_file', None)
+    kw = command_kw(["build", cfgfile.strpath, "-q", "--only", "tbx"])
+    pmain.run_only(cfgfile.strpath, "tbx", kw)                        # payload
+    assert "tbx-0.1.1" in root.join("tbx", "index.html").read()
+    assert "dtm-2.0.0" in root.join("dtm", "index.html").read()
+    assert "/newpkg/" not in root.join("index.html").read()
+    assert "/dtm/" in root.join("index.html").read()
+    assert not root.join("newpkg").exists()
+    manifest = pmain.read_manifest(root)
+    assert manifest['config'] == pmain.PARTIAL_CFGHASH
+    assert "dtm/index.html" in manifest['pages']
+
+    kw = command_kw(["build", cfgfile.strpath, "-q", "--only", "newpkg"])
+    pmain.run_only(cfgfile.strpath, "newpkg", kw)                     # payload
+    assert "/newpkg/" in root.join("index.html").read()
+    assert "newpkg-1.0" in root.join("newpkg", "index.html").read()
+
+    cfgfile.write(cfgfile.read().replace("package       dtm\n", "")
+                  .replace("    version   2.0.1\n", "")
+                  .replace("    url       {}/dtm#egg=dtm-2.0.1\n".format(
+                      "git+https://github.com/tbarron"), ""))
+    kw = command_kw(["build", cfgfile.strpath, "-q", "--only", "dtm"])
+    pmain.run_only(cfgfile.strpath, "dtm", kw)                        # payload
+    assert not root.join("dtm").exists()
+    assert "/dtm/" not in root.join("index.html").read()
+    monkeypatch.undo()
+    assert pmain.index_out_of_date(cfgfile.strpath,
+                                   *pmain.load_cfg(cfgfile.strpath))
+
+
+# -----------------------------------------------------------------------------
+@pytest.mark.parametrize("fsync", ['none', 'pages', 'all'])
+def test_write_atomic(tmpdir, fsync):
+    """
+    write_atomic() replaces the file rather than rewriting it, so a hard link
+    to the old file still sees the old content
+    """
+    pytest.dbgfunc()
+    target = tmpdir.join("sub", "page.html")
+    pmain.write_atomic(target.strpath, b"old", fsync)                 # payload
+    tmpdir.join("link.html").mklinkto(target)
+    pmain.write_atomic(target.strpath, b"new", fsync)                 # payload
+    assert target.read() == "new"
+    assert tmpdir.join("link.html").read() == "old"
+    assert tmpdir.join("sub").listdir() == [target]
+
+
+# -----------------------------------------------------------------------------
+@pytest.mark.parametrize("symlink", [False, True])
+def test_build_staged(tmpdir, fx_cfgfile, symlink):
+    """
+    A staged build leaves the live tree alone until the new tree is complete,
+    then swaps it into place and removes the old one
+    """
+    pytest.dbgfunc()
+    cfg = fx_cfgfile
+    root = pypath(cfg['root'])
+    if symlink:
+        tmpdir.join("gen0").ensure(dir=True)
+        root.mksymlinkto("gen0")
+    pmain.build_staged(cfg, cfghash="x", quiet=True)                  # payload
+    old = root.join("foobar", "index.html").realpath()
+    held = old.open()
+
+    cfg['packages']['foobar'][0]['version'] = "0.0.9"
+    pmain.build_staged(cfg, cfghash="y", quiet=True)                  # payload
+    assert "foobar-0.0.9" in root.join("foobar", "index.html").read()
+    assert "foobar-0.0.9" not in held.read()
+    held.close()
+    assert pmain.read_manifest(root)['config'] == "y"
+    assert root.islink() == symlink
+    exp = ["pypi", "test.cfg"]
+    if symlink:
+        exp[:0] = [root.realpath().basename, "gen0"]
+    assert sorted(_.basename for _ in tmpdir.listdir()) == exp
+
+
+# -----------------------------------------------------------------------------
+def test_build_staged_user_link(tmpdir, fx_cfgfile):
+    """
+    A staged build through a symlink the user made leaves the tree it
+    pointed at in place, and removes only generations it made itself
+    """
+    pytest.dbgfunc()
+    cfg = fx_cfgfile
+    root = pypath(cfg['root'])
+    mytree = tmpdir.join("data", "mytree").ensure(dir=True)
+    mytree.join("keep.txt").write("mine")
+    root.mksymlinkto("data/mytree")
+    pmain.build_staged(cfg, cfghash="x", quiet=True)                  # payload
+    first = root.realpath()
+    assert first.basename.startswith(".pypi.")
+    cfg['packages']['foobar'][0]['version'] = "0.0.9"
+    pmain.build_staged(cfg, cfghash="y", quiet=True)                  # payload
+    assert mytree.join("keep.txt").read() == "mine"
+    assert not first.exists()
+    assert "foobar-0.0.9" in root.join("foobar", "index.html").read()
+
+
+# -----------------------------------------------------------------------------
+def test_build_staged_fails(tmpdir, fx_cfgfile):
+    """
+    When a staged build fails, the live tree is untouched and the staging
+    directory is removed
+    """
+    pytest.dbgfunc()
+    cfg = fx_cfgfile
+    root = pypath(cfg['root'])
+    pmain.build_staged(cfg, cfghash="x", quiet=True)
+    before = root.join("tbx", "index.html").read()
+    cfg['packages']['tbx'][0]['url'] = "changed"
+    del cfg['packages']['dtm'][0]['url']
+    with pytest.raises(pyppi_error):
+        pmain.build_staged(cfg, cfghash="y", quiet=True)              # payload
+    assert root.join("tbx", "index.html").read() == before
+    assert pmain.read_manifest(root)['config'] == "x"
+    assert sorted(_.basename for _ in tmpdir.listdir()) == ["pypi",
+                                                            "test.cfg"]
+
+
+# -----------------------------------------------------------------------------
+def test_index_out_of_date(tmpdir, fx_cfgfile):
+    """
+    index_out_of_date() compares the config file against the hash recorded in
+    the build manifest, and the page formats and codecs asked for against
+    those it records
+    """
+    pytest.dbgfunc()
+    cfg = fx_cfgfile
+    cfgfile = cfg['tstcfg']
+    assert pmain.index_out_of_date(cfgfile, cfg)                      # payload
+    pmain.build_index_htmls(cfg, cfghash=pmain.file_hash(cfgfile))
+    assert not pmain.index_out_of_date(cfgfile, cfg)                  # payload
+    assert pmain.index_out_of_date(cfgfile, cfg,
+                                   formats=['html', 'json'])          # payload
+    assert pmain.index_out_of_date(cfgfile, cfg, compress=['.gz'])    # payload
+    cfgfile.write("# edited\n", mode='a')
+    assert pmain.index_out_of_date(cfgfile, cfg)                      # payload
+
+
+# -----------------------------------------------------------------------------
+def test_serve(tmpdir, fx_server):
+    """
+    The server answers for the root and package pages with the same bytes
+    the build writes, honors If-None-Match, and gzips on request
+    """
+    pytest.dbgfunc()
+    (srv, conn) = fx_server
+    cfg = pmain.read_cfg_file(srv.filename)
+    (status, hdrs, body) = http_get(conn, "/")                        # payload
+    assert (status, body) == (200, pmain.render_root(cfg).encode())
+    exp = pmain.render_package("foobar", cfg['packages']['foobar']).encode()
+    for path in ["/foobar/", "/FooBar/", "/{}/foobar/".format(cfg['root'])]:
+        (status, hdrs, body) = http_get(conn, path)                   # payload
+        assert (status, body) == (200, exp)
+    etag = hdrs['etag']
+
+    (status, hdrs, body) = http_get(conn, "/foobar/",                 # payload
+                                    {"If-None-Match": etag})
+    assert (status, body) == (304, b"")
+    (status, hdrs, body) = http_get(conn, "/foobar/",                 # payload
+                                    {"Accept-Encoding": "gzip"})
+    assert hdrs['content-encoding'] == "gzip"
+    assert gzip.decompress(body) == exp
+    assert hdrs['etag'] != etag
+    assert http_get(conn, "/foobar")[1]['location'] == "/foobar/"     # payload
+    assert http_get(conn, "/nosuch/")[0] == 404                       # payload
+
+    accept = "text/html;q=0.2, application/vnd.pypi.simple.v1+json"
+    (status, hdrs, body) = http_get(conn, "/foobar/",                 # payload
+                                    {"Accept": accept})
+    assert hdrs['content-type'] == "application/vnd.pypi.simple.v1+json"
+    assert json.loads(body)['name'] == "foobar"
+    accept = "application/vnd.pypi.simple.v1+json;q=0.5, text/html"
+    (status, hdrs, body) = http_get(conn, "/foobar/",                 # payload
+                                    {"Accept": accept})
+    assert hdrs['content-type'].startswith("text/html")
+
+
+# -----------------------------------------------------------------------------
+def test_serve_reload(tmpdir, fx_server):
+    """
+    The server picks up changes to the config without a restart and keeps
+    its pages when the new config cannot be read
+    """
+    pytest.dbgfunc()
+    (srv, conn) = fx_server
+    srv.filename.write("package   newpkg\n"
+                       "    version 1.0\n"
+                       "    url     http://x/newpkg-1.0.tar.gz\n", mode='a')
+    wait_for(lambda: http_get(conn, "/newpkg/")[0] == 200)           # payload
+    assert b"newpkg-1.0" in http_get(conn, "/newpkg/")[2]
+
+    srv.filename.write("root:  broken\n", mode='a')
+    pages = srv.pages
+    srv.reload()                                                      # payload
+    assert srv.pages is pages
+    assert http_get(conn, "/newpkg/")[0] == 200
+
+
+# -----------------------------------------------------------------------------
+def test_serve_fragment(tmpdir, fx_fragments):
+    """
+    The server reloads the config when a fragment it includes changes
+    """
+    pytest.dbgfunc()
+    with_urls(fx_fragments)
+    fragment = fx_fragments.join("team", "a.cfg")
+    with fx_fragments.as_cwd():
+        srv = serve.index_server(fx_fragments.join("index.cfg"),
+                                 interval=0.05)
+        for (srv, conn) in running(srv):
+            assert b"alpha-1.0" in http_get(conn, "/alpha/")[2]
+            fragment.write(fragment.read().replace("1.0", "1.1"))    # payload
+            wait_for(lambda: b"alpha-1.1" in http_get(conn, "/alpha/")[2])
+
+
+# -----------------------------------------------------------------------------
+def test_serve_lazy(tmpdir, fx_server):
+    """
+    With a block index, the server renders a package's pages the first
+    time they are asked for
+    """
+    pytest.dbgfunc()
+    (srv, conn) = fx_server
+    assert isinstance(srv.pages, serve.package_pages)
+    assert list(srv.pages.rendered) == [""]
+    (status, _, body) = http_get(conn, "/TBX/")                       # payload
+    assert (status, b"tbx-0.1.0" in body) == (200, True)
+    assert sorted(srv.pages.rendered) == ["", "tbx"]
+    assert http_get(conn, "/nosuch/")[0] == 404                       # payload
+    assert sorted(srv.pages.rendered) == ["", "tbx"]
+
+
+# -----------------------------------------------------------------------------
+def test_serve_lazy_thread(tmpdir, fx_server, monkeypatch):
+    """
+    A package's pages are rendered once, in a worker thread, however many
+    connections ask for them at the same time, and other pages are served
+    while they are rendering
+    """
+    pytest.dbgfunc()
+    (srv, conn) = fx_server
+    (go, threads) = (threading.Event(), [])
+    hashed_block = pmain.hashed_block
+
+    def slow_block(*args, **kw):
+        """
+        Note the thread hashing the block and wait to be let go
+        """
+        threads.append(threading.current_thread().name)
+        assert go.wait(10)
+        return hashed_block(*args, **kw)
+
+    monkeypatch.setattr(pmain, "hashed_block", slow_block)
+    results = []
+
+    def get_tbx():
+        """
+        GET the tbx page on a connection of its own
+        """
+        other = http.client.HTTPConnection(conn.host, conn.port, timeout=10)
+        results.append(http_get(other, "/tbx/")[0])
+        other.close()
+
+    getters = [threading.Thread(target=get_tbx) for _ in range(2)]
+    for getter in getters:
+        getter.start()
+    wait_for(lambda: threads)
+    assert http_get(conn, "/")[0] == 200                              # payload
+    go.set()
+    for getter in getters:
+        getter.join()
+    assert results == [200, 200]
+    assert len(threads) == 1
+    assert threads[0].startswith("asyncio")
+
+
+# -----------------------------------------------------------------------------
+def test_proxy(tmpdir, fx_proxy):
+    """
+    serve --upstream fetches packages the config does not list, serves
+    them from its cache until the ttl passes, then revalidates, and falls
+    back to the cached page when the upstream is down
+    """
+    pytest.dbgfunc()
+    (srv, conn, upstream) = fx_proxy
+    for path in ["/remote/", "/Remote/", "/remote/"]:
+        (status, hdrs, body) = http_get(conn, path)                   # payload
+        assert (status, body) == (200, b"<a>remote-1.0</a>\n")
+    assert upstream.hits == [("/simple/remote/", None)]
+    assert http_get(conn, "/foobar/")[0] == 200                      # payload
+    assert http_get(conn, "/nosuch/")[0] == 404                       # payload
+    assert [_[0] for _ in upstream.hits] == ["/simple/remote/",
+                                             "/simple/nosuch/"]
+
+    srv.upstream.ttl = 0
+    (status, hdrs, body) = http_get(conn, "/remote/")                 # payload
+    assert (status, body) == (200, b"<a>remote-1.0</a>\n")
+    assert upstream.hits[-1] == ("/simple/remote/", '"v1"')
+    upstream.pages["/simple/remote/"] = ('"v2"', b"<a>remote-2.0</a>\n")
+    assert http_get(conn, "/remote/")[2] == b"<a>remote-2.0</a>\n"  # payload
+
+    upstream.shutdown()
+    upstream.server_close()
+    srv.upstream.pool.idle.clear()
+    assert http_get(conn, "/remote/")[2] == b"<a>remote-2.0</a>\n"  # payload
+    assert http_get(conn, "/other/")[0] == 502                        # payload
+
+
+# -----------------------------------------------------------------------------
+def test_proxy_coalesce(tmpdir, fx_proxy):
+    """
+    Concurrent requests for an uncached upstream page share one fetch
+    """
+    pytest.dbgfunc()
+    (srv, conn, upstream) = fx_proxy
+    upstream.delay = 0.3
+    port = conn.port
+    results = []
+
+    def client():
+        """
+        Fetch the remote page on a connection of its own
+        """
+        mine = http.client.HTTPConnection("127.0.0.1", port, timeout=10)
+        results.append(http_get(mine, "/remote/")[0])
+        mine.close()
+
+    threads = [threading.Thread(target=client) for _ in range(5)]
+    for thread in threads:
+        thread.start()                                                # payload
+    for thread in threads:
+        thread.join()
+    assert results == [200] * 5
+    assert len(upstream.hits) == 1
+
+
+# -----------------------------------------------------------------------------
+@pytest.mark.parametrize("on_disk", [True, False])
+def test_page_cache(tmpdir, on_disk):
+    """
+    The proxy's page cache evicts the least recently used pages to stay
+    under its size, and on disk keeps them across restarts
+    """
+    pytest.dbgfunc()
+    directory = tmpdir.join("cache").strpath if on_disk else None
+    cache = proxy.page_cache(directory, max_bytes=350)
+    for key in "abc":
+        cache.put(key, {'n': key}, key.encode() * 100)                # payload
+        time.sleep(0.01)
+    assert cache.get("a") == ({'n': "a"}, b"a" * 100)
+    cache.put("d", {'n': "d"}, b"d" * 100)                            # payload
+    assert cache.get("b") == (None, None)
+    assert [cache.get(_)[0] for _ in "acd"] == [{'n': _} for _ in "acd"]
+    assert cache.total <= 350
+    if on_disk:
+        again = proxy.page_cache(directory, max_bytes=350)
+        assert again.total == cache.total
+        assert again.get("c") == ({'n': "c"}, b"c" * 100)
+
+
+# -----------------------------------------------------------------------------
+def test_metrics(tmpdir, fx_cfgfile, capsys):
+    """
+    --metrics reports the phases and counters of a build as JSON or as a
+    summary, and --profile dumps cProfile stats
+    """
+    pytest.dbgfunc()
+    cfgfile = fx_cfgfile['tstcfg'].strpath
+    mfile = tmpdir.join("metrics.json")
+    pfile = tmpdir.join("build.prof")
+    stat = os.stat
+    pmain.dispatch(pmain.__doc__, argv=["build", cfgfile, "-q",       # payload
+                                        "--metrics", mfile.strpath,
+                                        "--profile", pfile.strpath])
+    assert os.stat is stat
+    data = json.loads(mfile.read())
+    assert data['command'] == "build"
+    names = [(_['depth'], _['name']) for _ in data['spans']]
+    assert names[:3] == [(0, "load config"), (0, "build"),
+                         (1, "hash release files")]
+    assert (1, "write pages") in names
+    assert data['counters']['pages_written'] == 4
+    assert data['counters']['files_written'] == 6
+    assert data['counters']['bytes_written'] > 0
+    assert data['counters']['stat_calls'] > 0
+    stats = pstats.Stats(pfile.strpath)
+    assert any(_[2] == "build_index_htmls" for _ in stats.stats)
+
+    pmain.dispatch(pmain.__doc__, argv=["build", cfgfile, "-q",       # payload
+                                        "--metrics", "-"])
+    err = capsys.readouterr().err
+    assert err.startswith("pyppi build: ")
+    assert re.search(r"\n +4  pages_unchanged\n", err)
+
+    assert pmain.metrics.span("idle") is pmain.metrics.NULL_SPAN
+    pmain.metrics.count("idle")
+
+
+# -----------------------------------------------------------------------------
+def test_bench_suite(tmpdir):
+    """
+    The benchmark suite runs on a small generated config and reports each
+    operation in its JSON
+    """
+    pytest.dbgfunc()
+    report = tmpdir.join("report.json")
+    cmd = [sys.executable, "bench/bench_suite.py", "-p", "5", "-v", "1:4",
+           "-r", "1", "--no-cpush", "-o", report.strpath]
+    subprocess.run(cmd, check=True)                                   # payload
+    data = json.loads(report.read())
+    assert data['shape']['packages'] == 5
+    assert data['pyppi'] == version._v
+    assert set(data['results']) == {"read_cfg_file.fast",
+                                    "read_cfg_file.reference",
+                                    "load_cfg.cached", "build_dirs",
+                                    "build.full", "build.noop",
+                                    "index_out_of_date"}
+    assert all(len(_['rounds']) == 1 for _ in data['results'].values())
+
+
+# -----------------------------------------------------------------------------
+def test_build_changed(tmpdir, fx_cfgfile):
+    """
+    A build told which packages changed renders only their pages, keeps the
+    manifest entries of the rest, and removes the pages of changed packages
+    that left the config
+    """
+    pytest.dbgfunc()
+    cfg = fx_cfgfile
+    root = pypath(cfg['root'])
+    pmain.build_index_htmls(cfg)
+    cfg['packages']['tbx'][0]['version'] = "0.1.1"
+    cfg['packages']['dtm'][0]['version'] = "2.0.1"
+    del cfg['packages']['foobar']
+    pmain.build_index_htmls(cfg, changed={'tbx', 'foobar'})           # payload
+
+    assert "tbx-0.1.1" in root.join("tbx", "index.html").read()
+    assert "dtm-2.0.0" in root.join("dtm", "index.html").read()
+    assert not root.join("foobar").exists()
+    assert "/foobar/" not in root.join("index.html").read()
+    manifest = pmain.read_manifest(root)
+    assert sorted(manifest['pages']) == ["dtm/index.html", "index.html",
+                                         "tbx/index.html"]
+
+
+# -----------------------------------------------------------------------------
+def test_changed_packages():
+    """
+    changed_packages() names the packages added, removed, or edited
+    """
+    pytest.dbgfunc()
+    old = {'packages': {'a': [{'version': "1"}], 'b': [{'version': "1"}],
+                        'c': [{'version': "1"}]}}
+    new = {'packages': {'a': [{'version': "1"}], 'b': [{'version': "2"}],
+                        'd': [{'version': "1"}]}}
+    assert watch.changed_packages(old, new) == {'b', 'c', 'd'}       # payload
+
+
+# -----------------------------------------------------------------------------
+@pytest.mark.parametrize("inotify", [True, False])
+def test_watch(tmpdir, fx_cfgfile, monkeypatch, inotify):
+    """
+    build --watch rebuilds the changed package once the config is replaced
+    the way editors save it, with inotify or by polling
+    """
+    pytest.dbgfunc()
+    if not inotify:
+        monkeypatch.setattr(watch, "inotify_watcher", no_inotify)
+    cfgfile = fx_cfgfile['tstcfg']
+    page = pypath(fx_cfgfile['root']).join("tbx", "index.html")
+    kw = command_kw(["build", cfgfile.strpath, "-q", "--watch",
+                     "--debounce", "0.05", "--interval", "0.05"])
+    (cfg, _) = pmain.load_cfg(cfgfile.strpath)
+    pmain.run_build(cfgfile.strpath, cfg, kw)
+    stop = threading.Event()
+    thread = threading.Thread(target=watch.run,
+                              args=(cfgfile.strpath, cfg, kw),
+                              kwargs={'stop': stop})
+    thread.start()
+    try:
+        time.sleep(0.1)
+        tmpdir.join("new.cfg").write(cfgfile.read().replace("0.1.0", "0.1.1"))
+        tmpdir.join("new.cfg").rename(cfgfile)                        # payload
+        wait_for(lambda: "tbx-0.1.1" in page.read())
+    finally:
+        stop.set()
+        thread.join()
+    assert not pmain.index_out_of_date(cfgfile.strpath, cfg)
+
+
+# -----------------------------------------------------------------------------
+@pytest.mark.parametrize("inotify", [True, False])
+def test_watch_fragment(tmpdir, fx_fragments, monkeypatch, inotify):
+    """
+    build --watch rebuilds when a fragment the config includes changes,
+    with inotify or by polling
+    """
+    pytest.dbgfunc()
+    if not inotify:
+        monkeypatch.setattr(watch, "inotify_watcher", no_inotify)
+    with_urls(fx_fragments)
+    kw = command_kw(["build", "index.cfg", "-q", "--watch",
+                     "--debounce", "0.05", "--interval", "0.05"])
+    page = fx_fragments.join("pypi", "alpha", "index.html")
+    fragment = fx_fragments.join("team", "a.cfg")
+    stop = threading.Event()
+    with fx_fragments.as_cwd():
+        files = []
+        (cfg, _) = pmain.load_cfg("index.cfg", files=files)
+        pmain.run_build("index.cfg", cfg, kw)
+        thread = threading.Thread(target=watch.run,
+                                  args=("index.cfg", cfg, kw),
+                                  kwargs={'stop': stop, 'files': files})
+        thread.start()
+        try:
+            time.sleep(0.1)
+            fragment.write(fragment.read().replace("1.0", "1.1"))    # payload
+            wait_for(lambda: "alpha-1.1" in page.read())
+        finally:
+            stop.set()
+            thread.join()
+
+
+# -----------------------------------------------------------------------------
+def test_watch_cpush(tmpdir, fx_gitwork):
+    """
+    cpush --watch commits and pushes the pages rebuilt after a change
+    """
+    pytest.dbgfunc()
+    (work, remote) = fx_gitwork
+    cfgfile = work.join("index.cfg")
+    cfgfile.write("root  pypi\n\npackage  foo\n"
+                  "    version  1.0\n    url  http://x/foo\n")
+    kw = command_kw(["cpush", "-q", "-m", "watched", "index.cfg", "--watch",
+                     "--debounce", "0.05", "--push-interval", "0"])
+    stop = threading.Event()
+    with work.as_cwd():
+        (cfg, _) = pmain.load_cfg("index.cfg")
+        pmain.run_build("index.cfg", cfg, kw)
+        thread = threading.Thread(target=watch.run,
+                                  args=("index.cfg", cfg, kw, True),
+                                  kwargs={'stop': stop})
+        thread.start()
+        try:
+            time.sleep(0.1)
+            cfgfile.write(cfgfile.read().replace("1.0", "1.1"))       # payload
+            wait_for(lambda: "watched" in git_out(remote, "log", "--all"))
+        finally:
+            stop.set()
+            thread.join()
+    assert "foo-1.1" in git_out(remote, "show", "HEAD:pypi/foo/index.html")
+
+
+# -----------------------------------------------------------------------------
+def test_watch_cpush_retry(tmpdir, fx_gitwork, monkeypatch, capsys):
+    """
+    cpush --watch keeps running when a push fails, and pushes the commit it
+    made once the remote is back
+    """
+    pytest.dbgfunc()
+    (work, remote) = fx_gitwork
+    monkeypatch.setattr(watch, "PUSH_RETRY", 0.05)
+    cfgfile = work.join("index.cfg")
+    cfgfile.write("root  pypi\n\npackage  foo\n"
+                  "    version  1.0\n    url  http://x/foo\n")
+    kw = command_kw(["cpush", "-q", "-m", "watched", "index.cfg", "--watch",
+                     "--debounce", "0.05", "--push-interval", "0"])
+    stop = threading.Event()
+    away = tmpdir.join("remote.away")
+    with work.as_cwd():
+        (cfg, _) = pmain.load_cfg("index.cfg")
+        pmain.run_build("index.cfg", cfg, kw)
+        thread = threading.Thread(target=watch.run,
+                                  args=("index.cfg", cfg, kw, True),
+                                  kwargs={'stop': stop})
+        thread.start()
+        try:
+            time.sleep(0.1)
+            remote.rename(away)
+            cfgfile.write(cfgfile.read().replace("1.0", "1.1"))       # payload
+            wait_for(lambda: "watched" in git_out(work, "log", "--all"))
+            time.sleep(0.2)
+            assert thread.is_alive()
+            away.rename(remote)
+            wait_for(lambda: "watched" in git_out(remote, "log", "--all"))
+        finally:
+            stop.set()
+            thread.join()
+    assert "git push failed" in capsys.readouterr().err
+    assert "foo-1.1" in git_out(remote, "show", "HEAD:pypi/foo/index.html")
+
+
+# -----------------------------------------------------------------------------
+def test_store_import_export(tmpdir, fx_cfgfile):
+    """
+    A config imported into a store loads and exports unchanged, and build
+    takes the store in place of the config
+    """
+    pytest.dbgfunc()
+    cfgfile = fx_cfgfile['tstcfg']
+    dbfile = tmpdir.join("index.db")
+    output = tmpdir.join("exported.cfg")
+    pmain.dispatch(pmain.__doc__, argv=["import", cfgfile.strpath,
+                                        dbfile.strpath])              # payload
+    (cfg, digest) = pmain.load_cfg(dbfile.strpath)
+    assert cfg == pmain.read_cfg_file(cfgfile.strpath)
+    pmain.dispatch(pmain.__doc__, argv=["export", dbfile.strpath, "-o",
+                                        output.strpath])              # payload
+    assert pmain.read_cfg_file(output.strpath) == cfg
+    pmain.dispatch(pmain.__doc__, argv=["build", dbfile.strpath, "-q"])
+    assert not pmain.index_out_of_date(dbfile.strpath, cfg, digest)
+    assert "tbx-0.1.0" in pypath(cfg['root']).join("tbx", "index.html").read()
+    with pytest.raises(pyppi_error) as err:
+        pmain.dispatch(pmain.__doc__, argv=["import", cfgfile.strpath,
+                                            output.strpath])          # payload
+    assert "is not a pyppi store" in str(err.value)
+
+
+# -----------------------------------------------------------------------------
+def test_store_add_remove(tmpdir, fx_cfgfile, capsys):
+    """
+    add and remove change one package in the store, and with --build
+    render only its pages and the root pages
+    """
+    pytest.dbgfunc()
+    dbfile = tmpdir.join("index.db").strpath
+    root = pypath(fx_cfgfile['root'])
+    pmain.dispatch(pmain.__doc__, argv=["import",
+                                        fx_cfgfile['tstcfg'].strpath, dbfile])
+    pmain.dispatch(pmain.__doc__, argv=["build", dbfile, "-q"])
+    root.join("dtm", "index.html").write("untouched")
+
+    pmain.dispatch(pmain.__doc__, argv=["add", dbfile, "tbx", "0.2.0",
+                                        "http://x/tbx-0.2.0", "--minpy",
+                                        "3.9", "--build", "-q"])      # payload
+    page = root.join("tbx", "index.html").read()
+    assert "tbx-0.1.0" in page and "tbx-0.2.0" in page
+    assert 'data-requires-python="&gt;=3.9"' in page
+    pmain.dispatch(pmain.__doc__, argv=["remove", dbfile, "foobar",
+                                        "--build", "-q"])             # payload
+    pmain.dispatch(pmain.__doc__, argv=["remove", dbfile, "tbx", "0.1.0",
+                                        "--build", "-q"])             # payload
+    assert root.join("dtm", "index.html").read() == "untouched"
+    assert not root.join("foobar").exists()
+    assert "/foobar/" not in root.join("index.html").read()
+    assert "tbx-0.1.0" not in root.join("tbx", "index.html").read()
+    (cfg, digest) = pmain.load_cfg(dbfile)
+    assert not pmain.index_out_of_date(dbfile, cfg, digest)
+
+    capsys.readouterr()
+    pmain.dispatch(pmain.__doc__, argv=["list", dbfile])              # payload
+    assert capsys.readouterr().out == "tbx\ndtm\n"
+    pmain.dispatch(pmain.__doc__, argv=["list", dbfile, "tbx"])       # payload
+    assert capsys.readouterr().out == ("package         tbx\n"
+                                       "    version     0.2.0\n"
+                                       "    url         http://x/tbx-0.2.0\n"
+                                       "    minpy       3.9\n")
+
+
+# -----------------------------------------------------------------------------
+@pytest.mark.parametrize("argv, msg", [
+    (["add", "{db}", "tbx", "0.1.0"], "tbx 0.1.0 is already in the store"),
+    (["remove", "{db}", "tbx", "9.9"], "tbx 9.9 is not in the store"),
+    (["remove", "{db}", "nosuch"], "nosuch is not in the store"),
+    (["list", "{db}", "nosuch"], "nosuch is not in the store"),
+    (["list", "{cfg}"], "is not a pyppi store"),
+])
+def test_store_errors(tmpdir, fx_cfgfile, argv, msg):
+    """
+    Adding what is there, removing or listing what is not, and treating a
+    config file as a store are reported as pyppi_error
+    """
+    pytest.dbgfunc()
+    dbfile = tmpdir.join("index.db").strpath
+    cfgfile = fx_cfgfile['tstcfg'].strpath
+    pmain.dispatch(pmain.__doc__, argv=["import", cfgfile, dbfile])
+    argv = [_.format(db=dbfile, cfg=cfgfile) for _ in argv]
+    with pytest.raises(pyppi_error) as err:
+        pmain.dispatch(pmain.__doc__, argv=argv)                      # payload
+    assert msg in str(err.value)
+
+
+# -----------------------------------------------------------------------------
+def test_store_variants(tmpdir, fx_variants):
+    """
+    Importing a config with variants into a store is refused, leaving the
+    store as it was
+    """
+    pytest.dbgfunc()
+    dbfile = tmpdir.join("index.db").strpath
+    (cfg, _) = pmain.load_cfg(fx_variants.strpath)
+    cfg.pop('variants')
+    cfgfile = tmpdir.join("plain.cfg")
+    cfgfile.write("".join(pmain.cfg_lines(cfg)))
+    pmain.dispatch(pmain.__doc__, argv=["import", cfgfile.strpath, dbfile])
+    with pytest.raises(pyppi_error) as err:
+        pmain.dispatch(pmain.__doc__, argv=["import", fx_variants.strpath,
+                                            dbfile])                  # payload
+    assert "a store cannot hold variants (py36, only)" in str(err.value)
+    assert pmain.load_cfg(dbfile)[0] == cfg
+
+
+# -----------------------------------------------------------------------------
+def test_cpush(tmpdir, fx_gitwork):
+    """
+    cpush stages new and changed pages, and the deletions of removed ones,
+    including a path that plain 'git status' would quote, commits them with
+    a message holding shell metacharacters, and pushes
+    """
+    pytest.dbgfunc()
+    (work, remote) = fx_gitwork
+    cfgfile = work.join("index.cfg")
+    cfgfile.write_text("root   pypi\n\npackage  foo\n"
+                       "    version  1.0\n    url  http://x/foo\n"
+                       "\npackage  caf\u00e9\n    version  2.0\n"
+                       "    url  http://x/cafe\n", encoding='utf-8')
+    message = 'say "hi" to $HOME `and` it\'s'
+    with work.as_cwd():
+        pmain.dispatch(pmain.__doc__, argv=["cpush", "-q", "-m", message,
+                                            "index.cfg"])
+        cfgfile.write("root   pypi\n\npackage  foo\n"
+                      "    version  1.1\n    url  http://x/foo\n")
+        pmain.dispatch(pmain.__doc__, argv=["cpush", "-q", "-m", "update",
+                                            "index.cfg"])         # payload
+        assert pmain.git_status()[1:] == ([], [])
+    log = git_out(remote, "log", "--format=%s")
+    assert log == "update\n{}\n".format(message)
+    changed = git_out(remote, "show", "-z", "--name-only", "--format=", "HEAD")
+    assert "pypi/caf\u00e9/index.html" in changed.split("\0")
+    files = git_out(remote, "ls-tree", "-r", "--name-only", "HEAD")
+    assert files.split("\n") == ["pypi/.pyppi-manifest", "pypi/foo/index.html",
+                                 "pypi/index.html", ""]
+    assert "foo-1.1" in git_out(remote, "show", "HEAD:pypi/foo/index.html")
+
+
+# -----------------------------------------------------------------------------
+def test_cpush_options(tmpdir, fx_gitwork):
+    """
+    A cpush asking for other page formats or codecs than the last build
+    builds again and pushes the pages they add, though the config has not
+    changed
+    """
+    pytest.dbgfunc()
+    (work, remote) = fx_gitwork
+    work.join("index.cfg").write("root  pypi\n\npackage  foo\n"
+                                 "    version  1.0\n    url  http://x/foo\n")
+    with work.as_cwd():
+        pmain.dispatch(pmain.__doc__, argv=["cpush", "-q", "-m", "plain",
+                                            "index.cfg"])
+        pmain.dispatch(pmain.__doc__, argv=["cpush", "-q", "-m", "json",
+                                            "--json", "index.cfg"])  # payload
+        pmain.dispatch(pmain.__doc__,
+                       argv=["cpush", "-q", "-m", "gz", "--json",
+                             "--precompress", "gz", "index.cfg"])  # payload
+    files = git_out(remote, "ls-tree", "-r", "--name-only", "HEAD").split()
+    assert "pypi/foo/index.json" in files
+    assert "pypi/foo/index.html.gz" in files
+    manifest = pmain.read_manifest(work.join("pypi"))
+    assert (manifest['formats'], manifest['compress']) == (["html", "json"],
+                                                           [".gz"])
+
+
+# -----------------------------------------------------------------------------
+def test_cpush_staged_others(tmpdir, fx_gitwork):
+    """
+    cpush refuses to commit when files other than pages are staged
+    """
+    pytest.dbgfunc()
+    (work, _) = fx_gitwork
+    work.join("index.cfg").write("root  pypi\n\npackage  foo\n"
+                                 "    version  1.0\n    url  http://x/foo\n")
+    work.join("other").write("other")
+    with work.as_cwd():
+        git_out(work, "add", "other")
+        with pytest.raises(SystemExit) as err:
+            pmain.dispatch(pmain.__doc__, argv=["cpush", "-q", "-m", "x",
+                                                "index.cfg"])     # payload
+    assert "You have files staged" in str(err.value)
+
+
+# -----------------------------------------------------------------------------
+@pytest.mark.parametrize("args, allowed", [
+    (["version"], []),
+    (["build", "{cfg}", "-q"], ["docopt", "hashlib", "_hashlib", "_blake2",
+                                "json", "_json"]),
+])
+def test_import_budget(tmpdir, fx_cfgfile, args, allowed):
+    """
+    'pyppi version' and a 'pyppi build' from a cached config import no more
+    than they need, and importing pyppi stays within IMPORT_BUDGET_US
+    """
+    pytest.dbgfunc()
+    cfgfile = fx_cfgfile['tstcfg'].strpath
+    pmain.load_cfg(cfgfile)
+    args = [_.format(cfg=cfgfile) for _ in args]
+    (base, _) = import_times([])
+    (mods, budget) = import_times(args)                               # payload
+    extra = {_.split(".")[0] for _ in set(mods) - set(base)}
+    assert extra - {"pyppi", "docopt_dispatch", "mmap", "zlib"} <= set(allowed)
+    assert mods['pyppi.__main__'] < IMPORT_BUDGET_US
+
+
+# -----------------------------------------------------------------------------
+def test_debuggable():
+    """
+    Verify that all functions have a __doc__
+    """
+    pytest.dbgfunc()
+    rval = ""
+    func_d = dict(inspect.getmembers(sys.modules['test_pyppi'],
+                                     inspect.isfunction))
+    for func in func_d:
+        if func.startswith('test_'):
+            mem_d = dict(inspect.getmembers(func_d[func]))
+            cobj = mem_d['__code__']
+            if 'dbgfunc' not in cobj.co_names:
+                rval += "    {}\n".format(func)
+    assert rval == ""
+
+
+# -----------------------------------------------------------------------------
+def test_version(capsys):
+    """
+    Check what the pyppi_version() function returns
+    """
+    pytest.dbgfunc()
+    kw = {'build': False, 'd': False, 'FILENAME': None, 'version': True}
+    pmain.pyppi_version(**kw)                                         # payload
+    (result, err) = capsys.readouterr()
+    assert "pyppi version" in result
+    assert version._v in result
+
+
+# -----------------------------------------------------------------------------
+def test_deployable():
+    """
+    Check that 1) no untracked files are hanging out, 2) no staged but
+    uncommitted updates are outstanding, 3) no unstaged, uncommitted changes
+    are outstanding, 4) the most recent git tag matches HEAD, and 5) the most
+    recent git tag matches the current version.
+    """
+    pytest.dbgfunc()
+    staged, changed, untracked = tbx.git_status()
+    assert untracked == [], "You have untracked files"
+    assert changed == [], "You have unstaged updates"
+    assert staged == [], "You have updates staged but not committed"
+
+    if tbx.git_current_branch() != 'master':
+        return True
+
+    last_tag = tbx.git_last_tag()
+    msg = "Version ({}) does not match tag ({})".format(version._v,
+                                                        last_tag)
+    assert version._v == last_tag, msg
+    assert tbx.git_hash() == tbx.git_hash(last_tag), "Tag != HEAD"
+
+
+# -----------------------------------------------------------------------------
+@pytest.fixture
+def fx_extra_root(tmpdir):
+    """
+    Set up a config file with an extra root line to trigger the exception
+    """
+    lines = ["root            foobar",
+             "",
+             "package         whatever",
+             "    version     0.0.0",
+             "    url         git+https://someplace.com/foobar/foobar/",
+             "",
+             "root            throwthatexception",
+             "",
+             ]
+    tstcfg = tmpdir.join("test.cfg")
+    tstcfg.write("\n".join(lines) + "\n")
+
+
+# -----------------------------------------------------------------------------
+@pytest.fixture
+def fx_oddities(tmpdir):
+    """
+    Set up a config file with comments, tabs, and '#' inside values
+    """
+    lines = ["# a comment line",
+             "root\tfoobar    # trailing comment",
+             "   ",
+             "package         foo",
+             "    version     1.0",
+             "    url         http://x/foo#egg=foo",
+             "\tversion\t1.1#\tcomment glued to the value",
+             "    url         http://x/foo-1.1#",
+             "    minpy       3.6 #",
+             "#",
+             ]
+    tstcfg = tmpdir.join("test.cfg")
+    tstcfg.write("\n".join(lines) + "\n")
+
+
+# -----------------------------------------------------------------------------
+def with_urls(directory):
+    """
+    Give every release in the .cfg files under *directory* a url, so their
+    pages can be rendered
+    """
+    for cfgfile in directory.visit("*.cfg"):
+        cfgfile.write(re.sub(r"(\n *)version  (\S+)\n",
+                             r"\1version  \2\1url  http://x/\2\n",
+                             cfgfile.read()))
+
+
+# -----------------------------------------------------------------------------
+def no_inotify(filenames):
+    """
+    Stand in for inotify_watcher where inotify is not available
+    """
+    raise OSError("no inotify here")
+
+
+# -----------------------------------------------------------------------------
+def make_test_cfg(tmpdir, colons=False):
+    """
+    Set up a config file we can test read_cfg_file on
+    """
+    urlpfx = "git+https://github.com/tbarron"
+    data = {'root': "{}/pypi".format(tmpdir.strpath),
+            'tstcfg': tmpdir.join("test.cfg"),
+            'packages':
+            {'foobar': [{'version': "0.0.0",
+                         'url': "{}/foobar#egg=foobar-0.0.0".format(urlpfx)},
+                        {'version': "0.0.1",
+                         'url': "{}/foobar#egg=foobar-0.0.1".format(urlpfx)},
+                        ],
+             'tbx': [{'version': "0.1.0",
+                      'url': "{}/tbx#egg=tbx-0.1.0".format(urlpfx),
+                      'minpy': "3.8.0"},
+                     ],
+             'dtm': [{'version': "2.0.0",
+                      'url': "{}/dtm#egg=dtm-2.0.0".format(urlpfx)},
+                     ]}
+            }
+    colchr = ":" if colons else ""
+    cfgs = "root{}       {}\n\n".format(colchr, data['root'])
+    pkg_l = data['packages']
+    for pkg in pkg_l:
+        cfgs += "package{}       {}\n".format(colchr, pkg)
+        for rel in pkg_l[pkg]:
+            cfgs += "    version{}   {}\n".format(colchr, rel['version'])
+            cfgs += "    url{}       {}\n".format(colchr, rel['url'])
+            if 'minpy' in rel:
+                cfgs += "    minpy{}     {}\n".format(colchr, rel['minpy'])
+        cfgs += "\n"
+
+    data['tstcfg'].write(cfgs)
+    return data
+
+
+# -----------------------------------------------------------------------------
+@pytest.fixture
+def fx_cfgfile(tmpdir):
+    """
+    Set up a config file we can test read_cfg_file on
+    """
+    return make_test_cfg(tmpdir, colons=False)
+
+
+# -----------------------------------------------------------------------------
+@pytest.fixture
+def fx_colons(tmpdir):
+    """
+    Set up a config file we can test read_cfg_file on with colons
+    """
+    return make_test_cfg(tmpdir, colons=True)
+
+
+# -----------------------------------------------------------------------------
+@pytest.fixture
+def fx_wheelhouse(tmpdir):
+    """
+    Set up a directory holding a wheel, a .tar.gz sdist, a .zip sdist in a
+    subdirectory, and a file that only looks like a wheel
+    """
+    wheels = tmpdir.ensure_dir("wheels")
+    make_dist(wheels.join("Foo_Bar-1.0-py3-none-any.whl"), "Foo_Bar", "1.0",
+              ">=3.7")
+    make_dist(wheels.join("foo-bar-0.9.tar.gz"), "foo-bar", "0.9",
+              ">=3.6, <4")
+    make_dist(wheels.ensure_dir("sub").join("bar-2.0.zip"), "bar", "2.0")
+    wheels.join("junk.whl").write("not a zip file")
+    return wheels
+
+
+# -----------------------------------------------------------------------------
+def make_dist(path, name, version, requires=None):
+    """
+    Write a distribution archive at *path* holding just the metadata for
+    *name* and *version*, in the form its suffix calls for
+    """
+    meta = "Metadata-Version: 2.1\nName: {}\nVersion: {}\n".format(name,
+                                                                   version)
+    if requires:
+        meta += "Requires-Python: {}\n".format(requires)
+    meta = (meta + "\nlong description\n").encode()
+    top = "{}-{}".format(name, version)
+    if path.ext == ".whl":
+        with zipfile.ZipFile(path.strpath, 'w') as archive:
+            archive.writestr("{}/__init__.py".format(name), "")
+            archive.writestr("{}.dist-info/METADATA".format(top), meta)
+    elif path.ext == ".zip":
+        with zipfile.ZipFile(path.strpath, 'w') as archive:
+            archive.writestr("{}/PKG-INFO".format(top), meta)
+    else:
+        with tarfile.open(path.strpath, 'w:gz') as tarball:
+            info = tarfile.TarInfo("{}/PKG-INFO".format(top))
+            info.size = len(meta)
+            tarball.addfile(info, io.BytesIO(meta))
+
+
+# -----------------------------------------------------------------------------
+@pytest.fixture
+def fx_gitwork(tmpdir, monkeypatch):
+    """
+    Set up a git work tree cloned from an empty bare repository and return
+    both
+    """
+    for (var, val) in [('GIT_AUTHOR_NAME', "pyppi test"),
+                       ('GIT_AUTHOR_EMAIL', "test@localhost"),
+                       ('GIT_COMMITTER_NAME', "pyppi test"),
+                       ('GIT_COMMITTER_EMAIL', "test@localhost")]:
+        monkeypatch.setenv(var, val)
+    git_out(tmpdir, "init", "-q", "--bare", "remote.git")
+    git_out(tmpdir, "clone", "-q", "remote.git", "work")
+    return (tmpdir.join("work"), tmpdir.join("remote.git"))
+
+
+# -----------------------------------------------------------------------------
+@pytest.fixture
+def fx_server(tmpdir, fx_cfgfile):
+    """
+    Run pyppi.serve on the test config in a background thread and return
+    the server and a connection to it
+    """
+    srv = serve.index_server(fx_cfgfile['tstcfg'], interval=0.05)
+    yield from running(srv)
+
+
+# -----------------------------------------------------------------------------
+@pytest.fixture
+def fx_variants(tmpdir):
+    """
+    Write a config with a root and two variants and return its path
+    """
+    cfgfile = tmpdir.join("variants.cfg")
+    cfgfile.write("root  pypi\n"
+                  "\n"
+                  "variant  py36\n"
+                  "    maxpy  3.6\n"
+                  "    deny  Old_Pkg\n"
+                  "variant  only\n"
+                  "    allow  new\n"
+                  "    allow  pinned\n"
+                  "\n"
+                  "package  old_pkg\n"
+                  "    version  0.1\n"
+                  "    url  http://x/old_pkg-0.1\n"
+                  "package  new\n"
+                  "    version  2.0\n"
+                  "    url  http://x/new-2.0\n"
+                  "    minpy  3.8\n"
+                  "package  pinned\n"
+                  "    version  1.0\n"
+                  "    url  http://x/pinned-1.0\n"
+                  "    minpy  3.6\n")
+    return cfgfile
+
+
+# -----------------------------------------------------------------------------
+@pytest.fixture
+def fx_fragments(tmpdir):
+    """
+    Write a config, index.cfg, that includes a glob of two fragments and a
+    fragment by name, and return the directory holding it
+    """
+    tmpdir.join("index.cfg").write("root  pypi\n"
+                                   "\n"
+                                   "package  first\n"
+                                   "    version  0.1\n"
+                                   "include  team/[ab].cfg   # each team's\n"
+                                   "package  last\n"
+                                   "include  team/single.cfg\n")
+    team = tmpdir.mkdir("team")
+    team.join("a.cfg").write("package  alpha\n"
+                             "    version  1.0\n"
+                             "    url  http://x/alpha-1.0\n")
+    team.join("b.cfg").write("package  beta\n"
+                             "package  gamma\n"
+                             "    version  3.0\n")
+    team.join("single.cfg").write("package  single\n")
+    return tmpdir
+
+
+# -----------------------------------------------------------------------------
+@pytest.fixture
+def fx_proxy(tmpdir, fx_cfgfile, fx_upstream):
+    """
+    Run pyppi.serve on the test config with fx_upstream as its upstream and
+    return the server, a connection to it, and the upstream server
+    """
+    upstream = proxy.upstream(fx_upstream.url, tmpdir.join("cache").strpath)
+    srv = serve.index_server(fx_cfgfile['tstcfg'], upstream=upstream)
+    for (srv, conn) in running(srv):
+        yield (srv, conn, fx_upstream)
+
+
+# -----------------------------------------------------------------------------
+@pytest.fixture
+def fx_upstream():
+    """
+    Run a stand-in upstream simple index with one package, remote, in a
+    background thread. The handler is local so that test_function_doc does
+    not look at the methods it inherits.
+    """
+    class upstream_handler(http.server.BaseHTTPRequestHandler):
+        """
+        Answer for the stand-in upstream: the pages in self.server.pages, with
+        ETags, 304s and gzip, each request noted in self.server.hits
+        """
+        protocol_version = "HTTP/1.1"
+
+        def do_GET(self):
+            """
+            Send the page asked for, or 304 or 404
+            """
+            self.server.hits.append((self.path,
+                                     self.headers.get("If-None-Match")))
+            time.sleep(self.server.delay)
+            (etag, body) = self.server.pages.get(self.path, (None, None))
+            if body is None:
+                self.send_response(404)
+                body = b""
+            elif self.headers.get("If-None-Match") == etag:
+                self.send_response(304)
+                body = b""
+            else:
+                self.send_response(200)
+                self.send_header("ETag", etag)
+                self.send_header("Content-Type", "text/html")
+                if "gzip" in self.headers.get("Accept-Encoding", ""):
+                    body = gzip.compress(body)
+                    self.send_header("Content-Encoding", "gzip")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            """
+            Keep quiet
+            """
+
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0),
+                                             upstream_handler)
+    server.daemon_threads = True
+    server.pages = {"/simple/remote/": ('"v1"', b"<a>remote-1.0</a>\n")}
+    server.hits = []
+    server.delay = 0
+    server.url = "http://127.0.0.1:{}/simple".format(server.server_port)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+    thread.join()
+
+
+# -----------------------------------------------------------------------------
+def running(srv):
+    """
+    Run index_server *srv* in a background thread, generating it once with
+    a connection to it, and stop it when resumed
+    """
+    loop = asyncio.new_event_loop()
+    server = loop.run_until_complete(srv.start("127.0.0.1", 0))
+    thread = threading.Thread(target=loop.run_forever)
+    thread.start()
+    port = server.sockets[0].getsockname()[1]
+    conn = http.client.HTTPConnection("127.0.0.1", port, timeout=10)
+    yield (srv, conn)
+    conn.close()
+    asyncio.run_coroutine_threadsafe(srv.stop(), loop).result()
+    loop.call_soon_threadsafe(loop.stop)
+    thread.join()
+    loop.close()
+
+
+# -----------------------------------------------------------------------------
+def http_get(conn, path, headers=None):
+    """
+    GET *path* on *conn* and return (status, headers, body)
+    """
+    conn.request("GET", path, headers=headers or {})
+    rsp = conn.getresponse()
+    body = rsp.read()
+    return (rsp.status, {k.lower(): v for (k, v) in rsp.getheaders()}, body)
+
+
+# -----------------------------------------------------------------------------
+def wait_for(condition, timeout=10):
+    """
+    Poll *condition* until it is true or *timeout* seconds pass
+    """
+    end = time.time() + timeout
+    while not condition():
+        assert time.time() < end, "timed out"
+        time.sleep(0.05)
+
+
+# -----------------------------------------------------------------------------
+def command_kw(argv):
+    """
+    Return the keyword arguments dispatch would pass the command function
+    for *argv*
+    """
+    opts = docopt.docopt(pmain.__doc__, argv=argv)
+    return {key.lstrip("-").replace("-", "_"): val
+            for (key, val) in opts.items()}
+
+
+# -----------------------------------------------------------------------------
+def tree_content(root):
+    """
+    Return the content of each file under *root* by its relative path
+    """
+    return {_.relto(root): _.read_binary()
+            for _ in root.visit() if _.isfile()}
+
+
+# -----------------------------------------------------------------------------
+def git_out(where, *args):
+    """
+    Run git with *args* in directory *where* and return its output
+    """
+    result = subprocess.run(("git",) + args, cwd=str(where), check=True,
+                            stdout=subprocess.PIPE, universal_newlines=True)
+    return result.stdout
+
+
+# -----------------------------------------------------------------------------
+def import_times(args):
+    """
+    Run pyppi with *args* (or just start python if *args* is empty) under
+    -X importtime and return the cumulative import time in microseconds of
+    each module it imported, along with the command's output
+    """
+    code = "from pyppi.__main__ import main; main()" if args else "pass"
+    cmd = [sys.executable, "-X", "importtime", "-c", code] + args
+    result = subprocess.run(cmd, stdout=subprocess.PIPE,
+                            stderr=subprocess.PIPE, universal_newlines=True,
+                            check=True)
+    rval = {}
+    for line in result.stderr.splitlines():
+        match = re.match(r"import time:\s+\d+ \|\s+(\d+) \| ( *)(\S+)$",
+                         line)
+        if match:
+            rval[match.group(3)] = int(match.group(1))
+    return (rval, result.stdout)
+
+
+# -----------------------------------------------------------------------------
+def lglob(*args, dupl_allowed=False):
+    """
+    glob a list of paths and return the results in a single list
+    """
+    rval = []
+    [rval.extend(y) for y in [glob.glob(x) for x in args]]
+    if not dupl_allowed:
+        rval = list(set(rval))
+    return rval
+
+
+# -----------------------------------------------------------------------------
+def doc_missing(obj):
+    """
+    Check *obj* for a non-empty __doc__ element
+    """
+    if any([not hasattr(obj, '__doc__'),
+            obj.__doc__ is None,
+            obj.__doc__.strip() == ""]):
+        return True
+    else:
+        return False
 
 # ==TAGGABLE==